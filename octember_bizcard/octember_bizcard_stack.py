@@ -19,13 +19,17 @@ from aws_cdk import (
   aws_kinesisfirehose,
   aws_elasticache,
   aws_neptune,
-  aws_sagemaker
+  aws_sagemaker,
+  aws_sns,
+  aws_events,
+  aws_events_targets
 )
 from constructs import Construct
 
 from aws_cdk.aws_lambda_event_sources import (
   S3EventSource,
-  KinesisEventSource
+  KinesisEventSource,
+  SnsEventSource
 )
 
 class OctemberBizcardStack(Stack):
@@ -264,6 +268,14 @@ class OctemberBizcardStack(Stack):
 
     img_kinesis_stream = kinesis.Stream(self, "BizcardImagePath", stream_name="octember-bizcard-image")
 
+    #XXX: the code several functions share (ex: the Kinesis producer) ships as one layer,
+    # built from this repository like the function code, so the copies cannot drift apart
+    common_lib_layer = _lambda.LayerVersion(self, "CommonLib",
+      layer_version_name="octember-common-lib",
+      compatible_runtimes=[_lambda.Runtime.PYTHON_3_7],
+      code=_lambda.Code.from_asset("./src/main/python/CommonLib")
+    )
+
     # create lambda function
     trigger_textract_lambda_fn = _lambda.Function(self, "TriggerTextExtractorFromImage",
       runtime=_lambda.Runtime.PYTHON_3_7,
@@ -276,7 +288,8 @@ class OctemberBizcardStack(Stack):
         'DDB_TABLE_NAME': ddb_table.table_name,
         'KINESIS_STREAM_NAME': img_kinesis_stream.stream_name
       },
-      timeout=cdk.Duration.minutes(5)
+      timeout=cdk.Duration.minutes(5),
+      layers=[common_lib_layer]
     )
 
     ddb_table_rw_policy_statement = aws_iam.PolicyStatement(
@@ -293,6 +306,7 @@ class OctemberBizcardStack(Stack):
         "dynamodb:DeleteItem",
         "dynamodb:PutItem",
         "dynamodb:UpdateItem",
+        "dynamodb:ConditionCheckItem",
         "dax:Describe*",
         "dax:List*",
         "dax:GetItem",
@@ -323,6 +337,11 @@ class OctemberBizcardStack(Stack):
     s3_event_source = S3EventSource(s3_bucket, events=[s3.EventType.OBJECT_CREATED], filters=[s3_event_filter])
     trigger_textract_lambda_fn.add_event_source(s3_event_source)
 
+    # multi-page card sheets are processed by asynchronous Textract jobs
+    s3_pdf_event_filter = s3.NotificationKeyFilter(prefix="bizcard-raw-img/", suffix=".pdf")
+    s3_pdf_event_source = S3EventSource(s3_bucket, events=[s3.EventType.OBJECT_CREATED], filters=[s3_pdf_event_filter])
+    trigger_textract_lambda_fn.add_event_source(s3_pdf_event_source)
+
     #XXX: https://github.com/aws/aws-cdk/issues/2240
     # To avoid to create extra Lambda Functions with names like LogRetentionaae0aa3c5b4d4f87b02d85b201efdd8a
     # if log_retention=aws_logs.RetentionDays.THREE_DAYS is added to the constructor props
@@ -334,6 +353,15 @@ class OctemberBizcardStack(Stack):
 
     text_kinesis_stream = kinesis.Stream(self, "BizcardTextData", stream_name="octember-bizcard-txt")
 
+    textract_job_topic = aws_sns.Topic(self, "TextractJobCompletion",
+      topic_name="AmazonTextract-octember-bizcard-job-completion")
+
+    textract_sns_publish_role = aws_iam.Role(self, "TextractSnsPublishRole",
+      role_name="TextractSnsPublishRole-OctemberBizcard",
+      assumed_by=aws_iam.ServicePrincipal("textract.amazonaws.com")
+    )
+    textract_job_topic.grant_publish(textract_sns_publish_role)
+
     textract_lambda_fn = _lambda.Function(self, "GetTextFromImage",
       runtime=_lambda.Runtime.PYTHON_3_7,
       function_name="GetTextFromImage",
@@ -343,9 +371,17 @@ class OctemberBizcardStack(Stack):
       environment={
         'REGION_NAME': cdk.Aws.REGION,
         'DDB_TABLE_NAME': ddb_table.table_name,
-        'KINESIS_STREAM_NAME': text_kinesis_stream.stream_name
+        'KINESIS_STREAM_NAME': text_kinesis_stream.stream_name,
+        'MAX_WORKERS': '10',
+        'TEXTRACT_TPS': '10',
+        'TEXTRACT_MODE': 'auto',
+        'TEXTRACT_SNS_TOPIC_ARN': textract_job_topic.topic_arn,
+        'TEXTRACT_SNS_ROLE_ARN': textract_sns_publish_role.role_arn
       },
-      timeout=cdk.Duration.minutes(5)
+      timeout=cdk.Duration.minutes(5),
+      layers=[common_lib_layer],
+      #XXX: in the VPC to reach the Redis that holds the shared Textract token bucket
+      vpc=vpc
     )
 
     textract_lambda_fn.add_to_role_policy(ddb_table_rw_policy_statement)
@@ -376,6 +412,11 @@ class OctemberBizcardStack(Stack):
       resources=["*"],
       actions=["textract:*"]))
 
+    textract_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=[textract_sns_publish_role.role_arn],
+      actions=["iam:PassRole"]))
+
     img_kinesis_event_source = KinesisEventSource(img_kinesis_stream, batch_size=100, starting_position=_lambda.StartingPosition.LATEST)
     textract_lambda_fn.add_event_source(img_kinesis_event_source)
 
@@ -385,6 +426,59 @@ class OctemberBizcardStack(Stack):
       removal_policy=cdk.RemovalPolicy.DESTROY)
     log_group.grant_write(textract_lambda_fn)
 
+    textract_job_lambda_fn = _lambda.Function(self, "GetTextFromTextractJob",
+      runtime=_lambda.Runtime.PYTHON_3_7,
+      function_name="GetTextFromTextractJob",
+      handler="get_text_from_s3_image.textract_job_completion_handler",
+      description="collect the text of finished asynchronous textract jobs",
+      code=_lambda.Code.from_asset("./src/main/python/GetTextFromS3Image"),
+      environment={
+        'REGION_NAME': cdk.Aws.REGION,
+        'DDB_TABLE_NAME': ddb_table.table_name,
+        'KINESIS_STREAM_NAME': text_kinesis_stream.stream_name,
+        'TEXTRACT_TPS': '10'
+      },
+      timeout=cdk.Duration.minutes(5),
+      layers=[common_lib_layer],
+      vpc=vpc
+    )
+
+    textract_job_lambda_fn.add_to_role_policy(ddb_table_rw_policy_statement)
+    textract_job_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=[text_kinesis_stream.stream_arn],
+      actions=["kinesis:Get*",
+        "kinesis:List*",
+        "kinesis:Describe*",
+        "kinesis:PutRecord",
+        "kinesis:PutRecords"
+      ]
+    ))
+
+    textract_job_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(**{
+      "effect": aws_iam.Effect.ALLOW,
+      "resources": [s3_bucket.bucket_arn, "{}/*".format(s3_bucket.bucket_arn)],
+      "actions": ["s3:AbortMultipartUpload",
+        "s3:GetBucketLocation",
+        "s3:GetObject",
+        "s3:ListBucket",
+        "s3:ListBucketMultipartUploads",
+        "s3:PutObject"]
+    }))
+
+    textract_job_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=["*"],
+      actions=["textract:GetDocumentTextDetection"]))
+
+    textract_job_lambda_fn.add_event_source(SnsEventSource(textract_job_topic))
+
+    log_group = aws_logs.LogGroup(self, "GetTextFromTextractJobLogGroup",
+      log_group_name="/aws/lambda/GetTextFromTextractJob",
+      retention=aws_logs.RetentionDays.THREE_DAYS,
+      removal_policy=cdk.RemovalPolicy.DESTROY)
+    log_group.grant_write(textract_job_lambda_fn)
+
     sg_use_bizcard_es = aws_ec2.SecurityGroup(self, "BizcardSearchClientSG",
       vpc=vpc,
       allow_all_outbound=True,
@@ -627,6 +721,17 @@ class OctemberBizcardStack(Stack):
     # https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/aws-properties-elasticache-cache-cluster.html#cfn-elasticache-cachecluster-cachesubnetgroupname
     es_query_cache.add_dependency(es_query_cache_subnet_group)
 
+    #XXX: the search index writer invalidates the cached search responses of the owners it writes cards for
+    upsert_to_es_lambda_fn.add_environment('ELASTICACHE_HOST', es_query_cache.attr_redis_endpoint_address)
+    upsert_to_es_lambda_fn.add_layers(redis_lib_layer)
+    upsert_to_es_lambda_fn.connections.add_security_group(sg_use_bizcard_es_cache)
+
+    #XXX: the text extractors share one Textract token bucket in the search query cache
+    for fn in (textract_lambda_fn, textract_job_lambda_fn):
+      fn.add_environment('ELASTICACHE_HOST', es_query_cache.attr_redis_endpoint_address)
+      fn.add_layers(redis_lib_layer)
+      fn.connections.add_security_group(sg_use_bizcard_es_cache)
+
     #XXX: add more than 2 security groups
     # https://github.com/aws/aws-cdk/blob/ea10f0d141a48819ec0000cd7905feda993870a9/packages/%40aws-cdk/aws-lambda/lib/function.ts#L387
     # https://github.com/aws/aws-cdk/issues/1555
@@ -644,7 +749,7 @@ class OctemberBizcardStack(Stack):
         'ELASTICACHE_HOST': es_query_cache.attr_redis_endpoint_address
       },
       timeout=cdk.Duration.minutes(1),
-      layers=[es_lib_layer, redis_lib_layer],
+      layers=[es_lib_layer, redis_lib_layer, common_lib_layer],
       security_groups=[sg_use_bizcard_es, sg_use_bizcard_es_cache],
       vpc=vpc
     )
@@ -747,10 +852,11 @@ class OctemberBizcardStack(Stack):
       environment={
         'REGION_NAME': cdk.Aws.REGION,
         'NEPTUNE_ENDPOINT': bizcard_graph_db.attr_endpoint,
-        'NEPTUNE_PORT': bizcard_graph_db.attr_port
+        'NEPTUNE_PORT': bizcard_graph_db.attr_port,
+        'GRAPH_WRITE_CHUNK_SIZE': '50'
       },
       timeout=cdk.Duration.minutes(5),
-      layers=[gremlinpython_lib_layer],
+      layers=[gremlinpython_lib_layer, common_lib_layer],
       security_groups=[sg_use_bizcard_graph_db],
       vpc=vpc
     )
@@ -805,6 +911,41 @@ class OctemberBizcardStack(Stack):
 
     recomm_query_cache.add_dependency(recomm_query_cache_subnet_group)
 
+    #XXX: the graph writer publishes new 'knows' edges to the recommendation cache, and invalidates
+    # the cached recommendations of the users they affect
+    upsert_to_neptune_lambda_fn.add_environment('ELASTICACHE_HOST', recomm_query_cache.attr_redis_endpoint_address)
+    upsert_to_neptune_lambda_fn.add_layers(redis_lib_layer)
+    upsert_to_neptune_lambda_fn.connections.add_security_group(sg_use_bizcard_neptune_cache)
+
+    update_pymk_scores_lambda_fn = _lambda.Function(self, "UpdatePymkScores",
+      runtime=_lambda.Runtime.PYTHON_3_7,
+      function_name="UpdatePymkScores",
+      handler="update_pymk_scores.lambda_handler",
+      description="Apply new knows edges to the precomputed PYMK(People You May Know)",
+      code=_lambda.Code.from_asset("./src/main/python/UpdatePymkScores"),
+      environment={
+        'REGION_NAME': cdk.Aws.REGION,
+        'ELASTICACHE_HOST': recomm_query_cache.attr_redis_endpoint_address
+      },
+      timeout=cdk.Duration.minutes(1),
+      #XXX: a single consumer owns the tail of the edge delta list
+      reserved_concurrent_executions=1,
+      layers=[redis_lib_layer],
+      security_groups=[sg_use_bizcard_neptune_cache],
+      vpc=vpc
+    )
+
+    update_pymk_scores_schedule = aws_events.Rule(self, "UpdatePymkScoresSchedule",
+      schedule=aws_events.Schedule.rate(cdk.Duration.minutes(1))
+    )
+    update_pymk_scores_schedule.add_target(aws_events_targets.LambdaFunction(update_pymk_scores_lambda_fn))
+
+    log_group = aws_logs.LogGroup(self, "UpdatePymkScoresLogGroup",
+      log_group_name="/aws/lambda/UpdatePymkScores",
+      retention=aws_logs.RetentionDays.THREE_DAYS,
+      removal_policy=cdk.RemovalPolicy.DESTROY)
+    log_group.grant_write(update_pymk_scores_lambda_fn)
+
     bizcard_recomm_lambda_fn = _lambda.Function(self, "BizcardRecommender",
       runtime=_lambda.Runtime.PYTHON_3_7,
       function_name="BizcardRecommender",
@@ -818,7 +959,7 @@ class OctemberBizcardStack(Stack):
         'ELASTICACHE_HOST': recomm_query_cache.attr_redis_endpoint_address
       },
       timeout=cdk.Duration.minutes(1),
-      layers=[gremlinpython_lib_layer, redis_lib_layer],
+      layers=[gremlinpython_lib_layer, redis_lib_layer, common_lib_layer],
       security_groups=[sg_use_bizcard_graph_db, sg_use_bizcard_neptune_cache],
       vpc=vpc
     )
@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import os
+
+import boto3
+
+AWS_REGION = os.getenv('REGION_NAME', 'us-east-1')
+
+#XXX: boto3 clients are kept for the lifetime of the container, so warm invocations
+# skip the endpoint resolution and credential lookup of creating new ones
+AWS_CLIENTS = {}
+
+
+def get_aws_client(service_name):
+  client = AWS_CLIENTS.get(service_name)
+  if client is None:
+    client = AWS_CLIENTS.setdefault(service_name, boto3.client(service_name, region_name=AWS_REGION))
+  return client
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Kinesis producer shared by the functions that write to the image and text streams.
+
+Records are sent in PutRecords batches within the request limits, and only the records that
+failed (ex: throttled by a hot shard) are sent again, with jittered exponential backoff.
+"""
+
+import sys
+import json
+import os
+import traceback
+import hashlib
+import uuid
+import time
+import random
+
+KINESIS_MAX_BATCH_RECORDS = 500
+KINESIS_MAX_BATCH_BYTES = 5 * 1024 * 1024
+KINESIS_MAX_RETRY_COUNT = int(os.getenv('KINESIS_MAX_RETRY_COUNT', '5'))
+KINESIS_RETRY_BASE_DELAY = float(os.getenv('KINESIS_RETRY_BASE_DELAY', '0.1'))
+KINESIS_RETRY_MAX_DELAY = float(os.getenv('KINESIS_RETRY_MAX_DELAY', '5.0'))
+
+
+def _content_partition_key(rec):
+  return hashlib.md5(rec['s3_key'].encode('utf-8')).hexdigest()
+
+
+def _owner_partition_key(rec):
+  #XXX: records of the same owner go to the same shard, so the graph writer sees them in order
+  owner = rec.get('owner') or os.path.basename(rec['s3_key']).split('_')[0]
+  return hashlib.md5(owner.encode('utf-8')).hexdigest()
+
+
+def _random_partition_key(rec):
+  return uuid.uuid4().hex
+
+
+PARTITION_KEY_STRATEGIES = {
+  'content': _content_partition_key,
+  'owner': _owner_partition_key,
+  'random': _random_partition_key
+}
+
+
+def gen_partition_key(rec, strategy='content'):
+  if strategy not in PARTITION_KEY_STRATEGIES:
+    raise ValueError('unknown partition key strategy: {}'.format(strategy))
+  return PARTITION_KEY_STRATEGIES[strategy](rec)
+
+
+def split_into_batches(record_list, max_records=KINESIS_MAX_BATCH_RECORDS, max_bytes=KINESIS_MAX_BATCH_BYTES):
+  #XXX: PutRecords accepts up to 500 records and 5 MB per request,
+  # counting both the data blob and the partition key of each record
+  batch, batch_bytes = [], 0
+  for rec in record_list:
+    rec_bytes = len(rec['Data']) + len(rec['PartitionKey'].encode('utf-8'))
+    if batch and (len(batch) >= max_records or batch_bytes + rec_bytes > max_bytes):
+      yield batch
+      batch, batch_bytes = [], 0
+    batch.append(rec)
+    batch_bytes += rec_bytes
+  if batch:
+    yield batch
+
+
+def _backoff_delay(attempt, base_delay=KINESIS_RETRY_BASE_DELAY, max_delay=KINESIS_RETRY_MAX_DELAY):
+  # exponential backoff with full jitter
+  return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def put_records_batch(kinesis_client, kinesis_stream_name, batch, max_retry_count=KINESIS_MAX_RETRY_COUNT):
+  stats = {'records': len(batch), 'success': 0, 'throttled': 0, 'failed': 0, 'retries': 0}
+  pending = batch
+  for attempt in range(max_retry_count):
+    if attempt > 0:
+      stats['retries'] += 1
+      time.sleep(_backoff_delay(attempt))
+
+    try:
+      response = kinesis_client.put_records(Records=pending, StreamName=kinesis_stream_name)
+    except Exception as ex:
+      traceback.print_exc()
+      continue
+
+    if response.get('FailedRecordCount', 0) == 0:
+      stats['success'] += len(pending)
+      pending = []
+      break
+
+    #XXX: the result entries are in the same order as the request records,
+    # so only the entries with an ErrorCode need to be sent again
+    retry_records = []
+    for rec, result in zip(pending, response['Records']):
+      error_code = result.get('ErrorCode')
+      if error_code is None:
+        stats['success'] += 1
+        continue
+      if error_code == 'ProvisionedThroughputExceededException':
+        stats['throttled'] += 1
+      retry_records.append(rec)
+    print('[DEBUG] {} of {} records failed, retrying...'.format(len(retry_records), len(pending)), file=sys.stderr)
+    pending = retry_records
+
+  stats['failed'] = len(pending)
+  return stats, pending
+
+
+def write_records_to_kinesis(kinesis_client, kinesis_stream_name, records, partition_key_strategy='content'):
+  """Put the records (dicts, sent as json) into the stream; returns the ones that could not be put."""
+  record_list = []
+  for rec in records:
+    payload = json.dumps(rec, ensure_ascii=False).encode('utf-8')
+    record_list.append({'Data': payload, 'PartitionKey': gen_partition_key(rec, partition_key_strategy)})
+
+  failed_records = []
+  for i, batch in enumerate(split_into_batches(record_list)):
+    stats, failed = put_records_batch(kinesis_client, kinesis_stream_name, batch)
+    print('[INFO] kinesis put_records batch={},'.format(i), ', '.join(['{}={}'.format(k, v) for k, v in stats.items()]), file=sys.stderr)
+    failed_records.extend(json.loads(rec['Data'].decode('utf-8')) for rec in failed)
+
+  if failed_records:
+    print('[ERROR] Failed to put {} records into kinesis stream: {}'.format(len(failed_records), kinesis_stream_name), file=sys.stderr)
+  return failed_records
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Neptune connections shared by the functions that read or write the graph.
+
+gremlin_python is imported on first use, so a cold start that never touches
+the graph (ex: answered from the cache) does not pay for it.
+"""
+
+import sys
+import os
+import time
+import random
+import collections
+import threading
+
+NEPTUNE_PORT = int(os.getenv('NEPTUNE_PORT', '8182'))
+
+#XXX: each pooled connection is a websocket opened up front, so keep the pool small
+NEPTUNE_POOL_SIZE = int(os.getenv('NEPTUNE_POOL_SIZE', '1'))
+NEPTUNE_CONNECT_MAX_RETRY_COUNT = int(os.getenv('NEPTUNE_CONNECT_MAX_RETRY_COUNT', '3'))
+NEPTUNE_PING_INTERVAL = float(os.getenv('NEPTUNE_PING_INTERVAL', '30'))
+NEPTUNE_PING_TIMEOUT = float(os.getenv('NEPTUNE_PING_TIMEOUT', '3'))
+
+
+def remote_connection(neptune_endpoint=None, neptune_port=NEPTUNE_PORT, show_endpoint=True, pool_size=NEPTUNE_POOL_SIZE,
+    protocol='wss'):
+  from gremlin_python.driver.driver_remote_connection import DriverRemoteConnection
+
+  neptune_gremlin_endpoint = '{protocol}://{neptune_endpoint}:{neptune_port}/{suffix}'.format(protocol=protocol,
+    neptune_endpoint=neptune_endpoint, neptune_port=neptune_port, suffix='gremlin')
+
+  if show_endpoint:
+    print('[INFO] gremlin: {}'.format(neptune_gremlin_endpoint), file=sys.stderr)
+  retry_count = 0
+  while True:
+    try:
+      return DriverRemoteConnection(neptune_gremlin_endpoint, 'g', pool_size=pool_size)
+    except Exception as ex:
+      #XXX: a failed handshake surfaces as a socket, HTTP or tornado error depending on where it breaks
+      if retry_count >= NEPTUNE_CONNECT_MAX_RETRY_COUNT:
+        raise ex
+      delay = random.uniform(0, min(2.0, 0.1 * (2 ** retry_count)))
+      retry_count += 1
+      print('[WARNING] connecting to {} failed: {}. Retrying in {:.3f}s...'.format(neptune_gremlin_endpoint, ex, delay), file=sys.stderr)
+      time.sleep(delay)
+
+
+def graph_traversal(neptune_endpoint=None, neptune_port=NEPTUNE_PORT, show_endpoint=True, connection=None, protocol='wss'):
+  from gremlin_python.process.anonymous_traversal import traversal
+
+  if connection is None:
+    connection = remote_connection(neptune_endpoint, neptune_port, show_endpoint, protocol=protocol)
+  return traversal().withRemote(connection)
+
+
+class NeptuneConnectionManager:
+  """Keeps one remote connection for the lifetime of the container.
+
+  Warm invocations reuse the websocket instead of opening a new one. The connection is
+  pinged before use when it has been idle for ping_interval seconds or a caller marked it
+  stale, and is replaced when the ping fails.
+  """
+
+  def __init__(self, neptune_endpoint, neptune_port=NEPTUNE_PORT, pool_size=NEPTUNE_POOL_SIZE,
+      ping_interval=NEPTUNE_PING_INTERVAL, ping_timeout=NEPTUNE_PING_TIMEOUT, protocol='wss'):
+    self.neptune_endpoint = neptune_endpoint
+    self.neptune_port = neptune_port
+    self.pool_size = pool_size
+    self.ping_interval = ping_interval
+    self.ping_timeout = ping_timeout
+    self.protocol = protocol
+    self.connection = None
+    self.g = None
+    self.last_used_at = 0
+    self.stale = False
+    self.lock = threading.Lock()
+    self.stats = collections.OrderedDict([('connects', 0), ('pings', 0), ('reconnects', 0)])
+
+  def _connect(self):
+    from gremlin_python.process.anonymous_traversal import traversal
+
+    self.connection = remote_connection(self.neptune_endpoint, self.neptune_port,
+      show_endpoint=(self.stats['connects'] == 0), pool_size=self.pool_size, protocol=self.protocol)
+    self.g = traversal().withRemote(self.connection)
+    self.stats['connects'] += 1
+    self.stale = False
+
+  def _close(self):
+    connection, self.connection, self.g = (self.connection, None, None)
+    if connection is not None:
+      try:
+        connection.close()
+      except Exception as ex:
+        print('[WARNING] closing the stale connection failed: {}'.format(ex), file=sys.stderr)
+
+  def ping(self):
+    self.stats['pings'] += 1
+    try:
+      self.connection.submitAsync(self.g.inject(1).bytecode).result(timeout=self.ping_timeout)
+      return True
+    except Exception as ex:
+      print('[WARNING] neptune connection is not healthy: {}'.format(ex), file=sys.stderr)
+      return False
+
+  def mark_stale(self):
+    self.stale = True
+
+  def traversal(self):
+    with self.lock:
+      if self.g is None:
+        self._connect()
+      elif self.stale or time.time() - self.last_used_at >= self.ping_interval:
+        if not self.ping():
+          self._close()
+          self.stats['reconnects'] += 1
+          self._connect()
+        self.stale = False
+      self.last_used_at = time.time()
+      return self.g
+
+  def close(self):
+    with self.lock:
+      self._close()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Process status of the images in the DynamoDB table, shared by the functions of the OCR pipeline."""
+
+import sys
+import os
+import traceback
+import datetime
+import collections
+import time
+import random
+
+#XXX: a transition is never overwritten by an earlier one (ex: a late PROCESS after END)
+PROCESS_STATUS_RANK = {'START': 1, 'PROCESS': 2, 'END': 3, 'FAILED': 3}
+DDB_TRANSACT_MAX_ITEMS = 100
+DDB_MAX_RETRY_COUNT = int(os.getenv('DDB_MAX_RETRY_COUNT', '5'))
+
+
+def process_status_update(table_name, item):
+  s3_bucket = item['s3_bucket']
+  s3_key = item['s3_key']
+  image_id = os.path.basename(s3_key)
+  status = item['status']
+  modified_time = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+
+  # optional string attributes (ex: etag, duplicate_of, bizcard_data)
+  extra_attrs = {k: v for k, v in item.items() if k not in ('s3_bucket', 's3_key', 'status')}
+  update_expr = "SET s3_bucket = :s3_bucket, s3_key = :s3_key, mts = :mts, #status = :status, status_rank = :status_rank"
+  update_expr += ''.join([', {k} = :{k}'.format(k=k) for k in extra_attrs])
+
+  params = {
+    'TableName': table_name,
+    'Key': {
+      "image_id": {
+        "S": image_id
+      }
+    },
+    'UpdateExpression': update_expr,
+    'ExpressionAttributeNames': {
+      '#status': 'status'
+    },
+    'ExpressionAttributeValues': {
+      ":s3_bucket": {
+        "S": s3_bucket
+      },
+      ":s3_key": {
+        "S":  s3_key
+      },
+      ":mts": {
+        "N": "{}".format(modified_time)
+      },
+      ":status": {
+        "S": status
+      },
+      ":status_rank": {
+        "N": "{}".format(PROCESS_STATUS_RANK[status])
+      },
+      **{':{}'.format(k): {"S": v} for k, v in extra_attrs.items()}
+    }
+  }
+
+  if status == 'START':
+    #XXX: the trigger writes START after the batch is in the stream, so it can land after GetTextFromS3Image
+    # has moved the image on; it only begins a run for a new image, a failed one or new content
+    condition = "attribute_not_exists(status_rank) OR #status = :failed"
+    params['ExpressionAttributeValues'][':failed'] = {"S": "FAILED"}
+    if 'etag' in extra_attrs:
+      condition += " OR etag <> :etag"
+    params['ConditionExpression'] = condition
+  else:
+    params['ConditionExpression'] = "attribute_not_exists(status_rank) OR status_rank <= :status_rank"
+  return params
+
+
+def update_process_status(ddb_client, table_name, item):
+  try:
+    res = ddb_client.update_item(**process_status_update(table_name, item))
+    print('[DEBUG]', res, file=sys.stderr)
+  except ddb_client.exceptions.ConditionalCheckFailedException as ex:
+    print('[INFO] skip stale status {} of {}'.format(item['status'], item['s3_key']), file=sys.stderr)
+  except Exception as ex:
+    traceback.print_exc()
+    raise ex
+
+
+class StatusTracker:
+  """Buffers the status transitions of a batch and writes them with a few TransactWriteItems calls.
+
+  Only the latest transition of each image is kept, and a transition whose
+  condition fails because the item has already moved on is dropped.
+  """
+
+  def __init__(self, ddb_client, table_name):
+    import threading
+
+    self.ddb_client = ddb_client
+    self.table_name = table_name
+    self.pending = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.stats = collections.OrderedDict([('transitions', 0), ('writes', 0), ('calls', 0), ('stale', 0), ('retries', 0)])
+
+  def transition(self, item):
+    image_id = os.path.basename(item['s3_key'])
+    with self.lock:
+      self.stats['transitions'] += 1
+      prev = self.pending.get(image_id)
+      if prev is None or PROCESS_STATUS_RANK[prev['status']] <= PROCESS_STATUS_RANK[item['status']]:
+        self.pending[image_id] = item
+
+  def flush(self):
+    with self.lock:
+      items, self.pending = list(self.pending.values()), collections.OrderedDict()
+
+    for i in range(0, len(items), DDB_TRANSACT_MAX_ITEMS):
+      self._write(items[i:i + DDB_TRANSACT_MAX_ITEMS])
+    print('[INFO] status tracker', ', '.join(['{}={}'.format(k, v) for k, v in self.stats.items()]), file=sys.stderr)
+
+  def _write(self, items):
+    from botocore.exceptions import ClientError
+
+    for attempt in range(DDB_MAX_RETRY_COUNT):
+      if not items:
+        return
+      if attempt > 0:
+        self.stats['retries'] += 1
+        time.sleep(random.uniform(0, min(2.0, 0.05 * (2 ** attempt))))
+
+      try:
+        self.stats['calls'] += 1
+        self.ddb_client.transact_write_items(TransactItems=[{'Update': process_status_update(self.table_name, e)} for e in items])
+        self.stats['writes'] += len(items)
+        return
+      except ClientError as ex:
+        if ex.response['Error']['Code'] != 'TransactionCanceledException':
+          traceback.print_exc()
+          continue
+
+        #XXX: the whole transaction is rolled back; drop the stale transitions and retry the others
+        reasons = ex.response.get('CancellationReasons', [])
+        if len(reasons) != len(items):
+          traceback.print_exc()
+          continue
+        retry_items = []
+        for item, reason in zip(items, reasons):
+          if reason.get('Code') == 'ConditionalCheckFailed':
+            self.stats['stale'] += 1
+            print('[INFO] skip stale status {} of {}'.format(item['status'], item['s3_key']), file=sys.stderr)
+          else:
+            retry_items.append(item)
+        items = retry_items
+
+    if items:
+      print('[ERROR] failed to write {} status transitions'.format(len(items)), file=sys.stderr)
+      for item in items:
+        try:
+          update_process_status(self.ddb_client, self.table_name, item)
+        except Exception as ex:
+          print('[ERROR] failed to write status {} of {}: {}'.format(item['status'], item['s3_key'], ex), file=sys.stderr)
+
+
+def claim_content_hash(ddb_client, table_name, item):
+  """Record the etag of an image with a conditional write.
+
+  Returns None if this image is the first one with the etag, otherwise
+  the item of the image that claimed the etag earlier.
+  """
+  from botocore.exceptions import ClientError
+
+  etag_id = 'etag:{}'.format(item['etag'])
+  image_id = os.path.basename(item['s3_key'])
+  modified_time = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+  try:
+    ddb_client.put_item(
+      TableName=table_name,
+      Item={
+        "image_id": {"S": etag_id},
+        "origin_image_id": {"S": image_id},
+        "s3_bucket": {"S": item['s3_bucket']},
+        "s3_key": {"S": item['s3_key']},
+        "mts": {"N": "{}".format(modified_time)}
+      },
+      ConditionExpression="attribute_not_exists(image_id)"
+    )
+    return None
+  except ClientError as ex:
+    if ex.response['Error']['Code'] != 'ConditionalCheckFailedException':
+      raise ex
+
+  res = ddb_client.get_item(TableName=table_name, Key={"image_id": {"S": etag_id}}, ConsistentRead=True)
+  return {k: list(v.values())[0] for k, v in res.get('Item', {}).items()}
+
+
+def get_process_status(ddb_client, table_name, image_id):
+  res = ddb_client.get_item(TableName=table_name, Key={"image_id": {"S": image_id}},
+    ProjectionExpression="#status", ExpressionAttributeNames={"#status": "status"}, ConsistentRead=True)
+  return res.get('Item', {}).get('status', {}).get('S')
+
+
+def release_content_hash(ddb_client, table_name, item):
+  # let S3 redeliveries and re-uploads retry an image that never made it to the end of the pipeline
+  from botocore.exceptions import ClientError
+
+  try:
+    ddb_client.delete_item(
+      TableName=table_name,
+      Key={"image_id": {"S": 'etag:{}'.format(item['etag'])}},
+      ConditionExpression="origin_image_id = :image_id",
+      ExpressionAttributeValues={":image_id": {"S": os.path.basename(item['s3_key'])}}
+    )
+  except ClientError as ex:
+    if ex.response['Error']['Code'] != 'ConditionalCheckFailedException':
+      traceback.print_exc()
+    # otherwise the etag was claimed by another image, or has been released already
+  except Exception as ex:
+    traceback.print_exc()
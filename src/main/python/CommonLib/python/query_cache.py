@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import sys
+import os
+import json
+import time
+import uuid
+import zlib
+import collections
+
+#XXX: msgpack is smaller and faster than json; without it in the layer, entries are json
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+#XXX: an entry is fresh for the soft TTL, then served stale while one request refreshes it,
+# and gone after the hard TTL. The writers bump the versions an entry depends on, so the TTLs
+# only bound how long an entry can miss a change that no version covers
+CACHE_SOFT_TTL = int(os.getenv('CACHE_SOFT_TTL', '3600'))
+CACHE_HARD_TTL = int(os.getenv('CACHE_HARD_TTL', '21600'))
+CACHE_LOCK_TTL = int(os.getenv('CACHE_LOCK_TTL', '10'))
+CACHE_LOCK_WAIT = float(os.getenv('CACHE_LOCK_WAIT', '1.0'))
+
+# results that cache_if() rejects, like empty ones, are kept this long when negative caching is asked for
+CACHE_NEGATIVE_TTL = int(os.getenv('CACHE_NEGATIVE_TTL', '60'))
+
+#XXX: the in-process tier of a warm container cannot see version bumps without a round trip to
+# Redis, so its TTL bounds how long it can serve a response after a writer invalidated it; 0 bytes
+# disables it
+LOCAL_CACHE_MAX_BYTES = int(os.getenv('LOCAL_CACHE_MAX_BYTES', str(16*1024*1024)))
+LOCAL_CACHE_TTL = float(os.getenv('LOCAL_CACHE_TTL', '5'))
+
+# entries larger than this many bytes are stored zlib-compressed
+CACHE_COMPRESS_THRESHOLD = int(os.getenv('CACHE_COMPRESS_THRESHOLD', '1024'))
+CACHE_COMPRESS_LEVEL = int(os.getenv('CACHE_COMPRESS_LEVEL', '6'))
+
+#XXX: a payload is ENTRY_MAGIC, the format version, a flags byte and the body. 0xc1 is never used
+# by msgpack and cannot start a json document, so entries written before the format read as json
+ENTRY_MAGIC = 0xc1
+ENTRY_FORMAT_VERSION = 1
+ENTRY_FLAG_MSGPACK = 0x01
+ENTRY_FLAG_ZLIB = 0x02
+
+# deletes the lock only if this request still holds it
+RELEASE_LOCK_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+'''
+
+
+def encode_entry(entry, use_msgpack=(msgpack is not None), compress_threshold=CACHE_COMPRESS_THRESHOLD):
+  """Returns the payload of entry and the size of its body before compression."""
+  flags = 0
+  if use_msgpack:
+    body = msgpack.packb(entry, use_bin_type=True)
+    flags |= ENTRY_FLAG_MSGPACK
+  else:
+    body = json.dumps(entry, separators=(',', ':')).encode('utf-8')
+  size = len(body)
+  if size > compress_threshold:
+    body = zlib.compress(body, CACHE_COMPRESS_LEVEL)
+    flags |= ENTRY_FLAG_ZLIB
+  return bytes([ENTRY_MAGIC, ENTRY_FORMAT_VERSION, flags]) + body, size
+
+
+def decode_entry(payload):
+  """Returns the entry in payload and the size of its body before compression, or (None, 0)."""
+  if payload[:1] != bytes([ENTRY_MAGIC]):
+    try:
+      return json.loads(payload.decode('utf-8')), len(payload)
+    except ValueError:
+      return None, 0
+  #XXX: a format from a newer release, or msgpack written by a container that has it, is a miss
+  if len(payload) < 3 or payload[1] != ENTRY_FORMAT_VERSION:
+    return None, 0
+  flags, body = (payload[2], payload[3:])
+  if flags & ENTRY_FLAG_MSGPACK and msgpack is None:
+    return None, 0
+  try:
+    if flags & ENTRY_FLAG_ZLIB:
+      body = zlib.decompress(body)
+    if flags & ENTRY_FLAG_MSGPACK:
+      return msgpack.unpackb(body, raw=False), len(body)
+    return json.loads(body.decode('utf-8')), len(body)
+  except Exception as ex:
+    print('[WARNING] failed to decode a cache entry: {}'.format(ex), file=sys.stderr)
+    return None, 0
+
+
+def pack_records(records):
+  """Store a list of dicts as their field names and one row of values per dict.
+
+  A dict whose fields differ from the first one is kept in its row as it is, and an empty list
+  stays empty, so that it is still not worth caching.
+  """
+  if not records:
+    return []
+  fields = list(records[0].keys())
+  rows = [[record[k] for k in fields] if len(record) == len(fields) and all(k in record for k in fields) else record
+    for record in records]
+  return {'fields': fields, 'rows': rows}
+
+
+def unpack_records(packed, start=0, stop=None):
+  """The records[start:stop] of pack_records(); a plain list, as cached before packing, is sliced as it is."""
+  if isinstance(packed, list):
+    return packed[start:stop]
+  fields = packed['fields']
+  return [dict(zip(fields, row)) if isinstance(row, list) else row for row in packed['rows'][start:stop]]
+
+
+class LocalCache:
+  """LRU of the values QueryCache found fresh in Redis, bounded by the size of their uncompressed encoding."""
+
+  def __init__(self, max_bytes=LOCAL_CACHE_MAX_BYTES, ttl=LOCAL_CACHE_TTL):
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self.size_in_bytes = 0
+    self.entries = collections.OrderedDict()
+    self.stats = collections.OrderedDict([('hits', 0), ('misses', 0), ('expired', 0), ('evictions', 0)])
+
+  def get(self, key):
+    entry = self.entries.get(key)
+    if entry is None:
+      self.stats['misses'] += 1
+      return None
+    expires_at, size, value = entry
+    if expires_at < time.time():
+      self._remove(key)
+      self.stats['expired'] += 1
+      self.stats['misses'] += 1
+      return None
+    self.entries.move_to_end(key)
+    self.stats['hits'] += 1
+    return value
+
+  def put(self, key, value, size, refresh_at):
+    """Keep value for the TTL, but never past refresh_at, when Redis would refresh it."""
+    if size > self.max_bytes:
+      return
+    if key in self.entries:
+      self._remove(key)
+    self.entries[key] = (min(time.time() + self.ttl, refresh_at), size, value)
+    self.size_in_bytes += size
+    while self.size_in_bytes > self.max_bytes:
+      self._remove(next(iter(self.entries)))
+      self.stats['evictions'] += 1
+
+  def _remove(self, key):
+    _, size, _ = self.entries.pop(key)
+    self.size_in_bytes -= size
+
+  def clear(self):
+    self.entries.clear()
+    self.size_in_bytes = 0
+
+
+class QueryCache:
+  """Single-flight read-through cache of query results in Redis.
+
+  On a miss or a stale entry, only the request that takes the per-key lock runs the query.
+  The others get the stale value, or wait up to lock_wait seconds for the new one.
+
+  An entry records the values of its version keys when it was computed, and is read with them
+  in one MGET; once a writer has bumped one of them, the entry is invalidated. Unlike an entry
+  past its soft TTL, it is never served, so requests without the lock wait for the new one.
+
+  With a local_cache, the values found fresh in Redis, or stored there, are also kept in process
+  and served without a round trip until the local TTL expires.
+  """
+
+  def __init__(self, redis_client, soft_ttl=CACHE_SOFT_TTL, hard_ttl=CACHE_HARD_TTL,
+      lock_ttl=CACHE_LOCK_TTL, lock_wait=CACHE_LOCK_WAIT, wait_interval=0.05, local_cache=None):
+    self.redis_client = redis_client
+    self.local_cache = local_cache
+    self.soft_ttl = soft_ttl
+    self.hard_ttl = max(hard_ttl, soft_ttl)
+    self.lock_ttl = lock_ttl
+    self.lock_wait = lock_wait
+    self.wait_interval = wait_interval
+    self.release_lock = redis_client.register_script(RELEASE_LOCK_SCRIPT)
+    self.stats = collections.OrderedDict([('hits', 0), ('stale', 0), ('invalidated', 0), ('misses', 0),
+      ('recomputes', 0), ('waits', 0), ('errors', 0), ('negative', 0)])
+
+  def load(self, key, version_keys=()):
+    """Returns the entry of key, or None, the current values of version_keys, and the entry size."""
+    payload, *versions = self.redis_client.mget([key] + list(version_keys))
+    versions = [v.decode('utf-8') if v is not None else None for v in versions]
+    if payload is None:
+      return None, versions, 0
+    entry, size = decode_entry(payload)
+    #XXX: entries written before the envelope are treated as misses
+    return (entry if isinstance(entry, dict) and 'refresh_at' in entry else None), versions, size
+
+  def store(self, key, value, versions=(), ttl=None):
+    """Store value for the soft and hard TTL, or, with ttl, for that long and without a stale period."""
+    entry = {'refresh_at': time.time() + (ttl or self.soft_ttl), 'versions': list(versions), 'value': value}
+    payload, size = encode_entry(entry)
+    self.redis_client.set(key, payload, ex=(ttl or self.hard_ttl))
+    self._keep_local(key, entry, size)
+
+  def _keep_local(self, key, entry, size):
+    if self.local_cache is not None:
+      self.local_cache.put(key, entry['value'], size, entry['refresh_at'])
+
+  def get_or_compute(self, key, compute, cache_if=bool, version_keys=(), negative_ttl=None):
+    """Return the cached value of key, or compute() it.
+
+    Values for which cache_if() is false are not stored, or only for negative_ttl seconds if it is given.
+    """
+    if self.local_cache is not None:
+      value = self.local_cache.get(key)
+      if value is not None:
+        return value
+
+    entry, versions, size = self.load(key, version_keys)
+    stale_entry = None
+    if entry is not None:
+      if entry.get('versions', []) != versions:
+        self.stats['invalidated'] += 1
+      elif entry['refresh_at'] > time.time():
+        self.stats['hits'] += 1
+        self._keep_local(key, entry, size)
+        return entry['value']
+      else:
+        stale_entry = entry
+
+    lock_key, token = ('{}:lock'.format(key), uuid.uuid4().hex)
+    if self.redis_client.set(lock_key, token, nx=True, ex=self.lock_ttl):
+      self.stats['stale' if stale_entry is not None else 'misses'] += 1
+      try:
+        return self._recompute(key, compute, cache_if, stale_entry, versions, negative_ttl)
+      finally:
+        self.release_lock(keys=[lock_key], args=[token])
+
+    if stale_entry is not None:
+      self.stats['stale'] += 1
+      return stale_entry['value']
+
+    self.stats['misses'] += 1
+    self.stats['waits'] += 1
+    deadline = time.time() + self.lock_wait
+    while time.time() < deadline:
+      time.sleep(self.wait_interval)
+      entry, versions, size = self.load(key, version_keys)
+      if entry is not None and entry.get('versions', []) == versions:
+        self._keep_local(key, entry, size)
+        return entry['value']
+
+    #XXX: the lock holder is too slow or gone; answer this request without storing, the holder will
+    print('[WARNING] timed out waiting for {}, running the query'.format(key), file=sys.stderr)
+    self.stats['recomputes'] += 1
+    return compute()
+
+  def _recompute(self, key, compute, cache_if, stale_entry, versions, negative_ttl=None):
+    self.stats['recomputes'] += 1
+    try:
+      value = compute()
+    except Exception as ex:
+      if stale_entry is None:
+        raise ex
+      self.stats['errors'] += 1
+      print('[WARNING] refreshing {} failed, serving the stale value: {}'.format(key, ex), file=sys.stderr)
+      return stale_entry['value']
+    if cache_if(value):
+      self.store(key, value, versions)
+    elif negative_ttl:
+      self.stats['negative'] += 1
+      self.store(key, value, versions, ttl=negative_ttl)
+    return value
@@ -9,43 +9,82 @@ import re
 import base64
 import traceback
 import datetime
+import hashlib
+import time
+import random
+import collections
 
-import boto3
+from aws_clients import get_aws_client
+from kinesis_producer import write_records_to_kinesis
+from process_status import StatusTracker, release_content_hash
 
-AWS_REGION = os.getenv('REGION_NAME', 'us-east-1')
 KINESIS_STREAM_NAME = os.getenv('KINESIS_STREAM_NAME', 'octember-bizcard-text')
 DDB_TABLE_NAME = os.getenv('DDB_TABLE_NAME', 'OctemberBizcardImg')
+PARTITION_KEY_STRATEGY = os.getenv('PARTITION_KEY_STRATEGY', 'owner')
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', '10'))
+TEXTRACT_ARCHIVE_PREFIX = os.getenv('TEXTRACT_ARCHIVE_PREFIX', 'bizcard-textract-raw/')
+
+# sync: detect_document_text, async: start_document_text_detection,
+# auto: async only for multi-page documents and large images
+TEXTRACT_MODE = os.getenv('TEXTRACT_MODE', 'sync')
+TEXTRACT_ASYNC_MIN_BYTES = int(os.getenv('TEXTRACT_ASYNC_MIN_BYTES', str(5 * 1024 * 1024)))
+TEXTRACT_ASYNC_SUFFIXES = ('.pdf', '.tif', '.tiff')
+TEXTRACT_SNS_TOPIC_ARN = os.getenv('TEXTRACT_SNS_TOPIC_ARN')
+TEXTRACT_SNS_ROLE_ARN = os.getenv('TEXTRACT_SNS_ROLE_ARN')
+
+#XXX: the Textract quota is shared by every concurrent instance of this function
+TEXTRACT_TPS = float(os.getenv('TEXTRACT_TPS', '10'))
+#XXX: without Redis each instance only gets its share of the quota, so that together they stay under it
+TEXTRACT_MAX_INSTANCES = int(os.getenv('TEXTRACT_MAX_INSTANCES', '4'))
+TEXTRACT_LOCAL_TPS = float(os.getenv('TEXTRACT_LOCAL_TPS', str(TEXTRACT_TPS / max(TEXTRACT_MAX_INSTANCES, 1))))
+RATE_LIMITER_RETRY_INTERVAL = float(os.getenv('RATE_LIMITER_RETRY_INTERVAL', '30'))
+TEXTRACT_MAX_RETRY_COUNT = int(os.getenv('TEXTRACT_MAX_RETRY_COUNT', '5'))
+ELASTICACHE_HOST = os.getenv('ELASTICACHE_HOST')
+ELASTICACHE_PORT = int(os.getenv('ELASTICACHE_PORT', '6379'))
+
+TEXTRACT_RATE_LIMITER = None
+
+EMAIL_RE = re.compile(r'[a-zA-Z0-9+_\-\.]+@[0-9a-zA-Z][.-0-9a-zA-Z]*.[a-zA-Z]+')
+#PHONE_NUMBER_RE = re.compile(r'(?:\+ *)?\d[\d\- ]{7,}\d')
+PHONE_NUMBER_RE = re.compile(r'\({0,1}\+{0,1}[\d ]*[\d]{2,}\){0,1}[\d\- ]{7,}')
+KO_ADDR_KEYWORDS = ('-gu', '-ro', '-do', ' gu', ' ro', ' do', ' seoul', ' korea')
+KO_ADDR_MIN_SCORE = 3
+
+
+def _classify_line(line):
+  """Extract (email, addr, phone_number) from a line in a single pass; '' if not found."""
+  email = ''
+  if '@' in line:
+    match = EMAIL_RE.search(line)
+    email = match.group(0) if match else ''
+
+  match = PHONE_NUMBER_RE.search(line)
+  phone_number = match.group(0) if match else ''
+
+  #XXX: a handful of substring tests on the lowercased line beats both a
+  # keyword alternation regex and a pure python Aho-Corasick automaton here
+  addr_txt = line.lower()
+  score = 0
+  for keyword in KO_ADDR_KEYWORDS:
+    if keyword in addr_txt:
+      score += 1
+      if score >= KO_ADDR_MIN_SCORE:
+        break
+  addr = line if score >= KO_ADDR_MIN_SCORE else ''
+
+  return email, addr, phone_number
 
-def parse_textract_data(lines):
-  def _get_email(s):
-    email_re = re.compile(r'[a-zA-Z0-9+_\-\.]+@[0-9a-zA-Z][.-0-9a-zA-Z]*.[a-zA-Z]+')
-    emails = email_re.findall(s)
-    return emails[0] if emails else ''
-
-  def _get_addr(s):
-    ko_addr_stopwords = ['-gu', '-ro', '-do', ' gu', ' ro', ' do', ' seoul', ' korea']
-    addr_txt = s.lower()
-    score = sum([1 if e in addr_txt else 0 for e in ko_addr_stopwords])
-    return s if score >= 3 else ''
-
-  def _get_phone_number(s):
-    #phone_number_re = re.compile(r'(?:\+ *)?\d[\d\- ]{7,}\d')
-    phone_number_re = re.compile(r'\({0,1}\+{0,1}[\d ]*[\d]{2,}\){0,1}[\d\- ]{7,}')
-    phones = phone_number_re.findall(s)
-    return phones[0] if phones else ''
-
-  funcs = {
-    'email': _get_email,
-    'addr': _get_addr,
-    'phone_number': _get_phone_number
-  }
 
+def parse_textract_data(lines):
   doc = {}
   for line in lines:
-    for k in ['email', 'addr', 'phone_number']:
-      ret = funcs[k](line)
-      if ret:
-        doc[k] = ret
+    email, addr, phone_number = _classify_line(line)
+    if email:
+      doc['email'] = email
+    if addr:
+      doc['addr'] = addr
+    if phone_number:
+      doc['phone_number'] = phone_number
 
   #TODO: assume that a biz card dispaly company, name, job title in order
   company_name, name, job_title = lines[:3]
@@ -56,93 +95,238 @@ def parse_textract_data(lines):
   return doc
 
 
-def get_textract_data(textract_client, bucketName, documentKey):
-  print('[DEBUG] Loading get_textract_data', file=sys.stderr)
+class LocalTokenBucket:
+  """In-process token bucket, used when no Redis is available or reachable."""
+
+  def __init__(self, rate, capacity=None):
+    import threading
+
+    self.rate = float(rate)
+    self.capacity = float(capacity or rate)
+    self.tokens = self.capacity
+    self.ts = time.monotonic()
+    self.lock = threading.Lock()
+
+  def try_acquire(self, tokens=1):
+    """Take tokens if available, otherwise return the seconds to wait."""
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+      self.ts = now
+      if self.tokens >= tokens:
+        self.tokens -= tokens
+        return 0
+      return (tokens - self.tokens) / self.rate
+
+  def acquire(self, tokens=1):
+    while True:
+      wait_secs = self.try_acquire(tokens)
+      if wait_secs <= 0:
+        return
+      time.sleep(wait_secs)
+
+
+class RedisTokenBucket:
+  """Token bucket shared by all instances through Redis.
+
+  Refill and take happen atomically in a Lua script that uses the Redis
+  server clock, so instances do not have to agree on their own clocks.
+  Falls back to a local bucket while Redis cannot be reached, and only
+  tries Redis again every retry_interval seconds meanwhile.
+  """
+
+  LUA_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate / 1000)
+local wait_ms = 0
+if tokens >= requested then
+  tokens = tokens - requested
+else
+  wait_ms = math.ceil((requested - tokens) * 1000 / rate)
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity * 1000 / rate) + 1000)
+return wait_ms
+"""
+
+  def __init__(self, redis_client, key, rate, capacity=None, fallback=None, retry_interval=RATE_LIMITER_RETRY_INTERVAL):
+    self.redis_client = redis_client
+    self.key = key
+    self.rate = float(rate)
+    self.capacity = float(capacity or rate)
+    self.fallback = fallback or LocalTokenBucket(rate, capacity)
+    self.script = redis_client.register_script(self.LUA_SCRIPT)
+    self.retry_interval = retry_interval
+    self.degraded = False
+    self.retry_at = 0
+
+  def try_acquire(self, tokens=1):
+    #XXX: do not wait for a connect timeout on every acquire while Redis is down
+    if self.degraded and time.time() < self.retry_at:
+      return self.fallback.try_acquire(tokens)
+    try:
+      wait_ms = self.script(keys=[self.key], args=[self.rate, self.capacity, tokens])
+      if self.degraded:
+        print('[INFO] redis rate limiter is available again', file=sys.stderr)
+        self.degraded = False
+      return int(wait_ms) / 1000.0
+    except Exception as ex:
+      if not self.degraded:
+        print('[WARNING] redis rate limiter is unavailable, using the local one: {}'.format(ex), file=sys.stderr)
+        self.degraded = True
+      self.retry_at = time.time() + self.retry_interval
+      return self.fallback.try_acquire(tokens)
+
+  def acquire(self, tokens=1):
+    while True:
+      wait_secs = self.try_acquire(tokens)
+      if wait_secs <= 0:
+        return
+      time.sleep(wait_secs)
+
+
+def get_textract_rate_limiter():
+  global TEXTRACT_RATE_LIMITER
+
+  if TEXTRACT_RATE_LIMITER is None:
+    local_limiter = LocalTokenBucket(TEXTRACT_LOCAL_TPS)
+    TEXTRACT_RATE_LIMITER = local_limiter
+    if ELASTICACHE_HOST:
+      try:
+        import redis
+
+        redis_client = redis.Redis(host=ELASTICACHE_HOST, port=ELASTICACHE_PORT, db=0,
+          socket_timeout=1, socket_connect_timeout=1)
+        TEXTRACT_RATE_LIMITER = RedisTokenBucket(redis_client, 'ratelimit:textract', TEXTRACT_TPS,
+          fallback=local_limiter)
+      except ImportError as ex:
+        print('[WARNING] redis is not installed, using the local rate limiter', file=sys.stderr)
+  return TEXTRACT_RATE_LIMITER
+
+
+def detect_document_text(textract_client, bucketName, documentKey):
+  print('[DEBUG] Loading detect_document_text', file=sys.stderr)
+
+  rate_limiter = get_textract_rate_limiter()
+  for attempt in range(TEXTRACT_MAX_RETRY_COUNT):
+    rate_limiter.acquire()
+    try:
+      response = textract_client.detect_document_text(
+      Document={
+        'S3Object': {
+        'Bucket': bucketName,
+        'Name': documentKey
+        }
+      })
+      break
+    except (textract_client.exceptions.ProvisionedThroughputExceededException,
+        textract_client.exceptions.ThrottlingException) as ex:
+      if attempt + 1 == TEXTRACT_MAX_RETRY_COUNT:
+        raise ex
+      print('[WARNING] Textract throttled, retrying {}...'.format(documentKey), file=sys.stderr)
+      time.sleep(random.uniform(0, min(5.0, 0.1 * (2 ** attempt))))
+  return response
 
-  response = textract_client.detect_document_text(
-  Document={
-    'S3Object': {
-    'Bucket': bucketName,
-    'Name': documentKey
-    }
-  })
 
-  detected_text_list = [item['Text'] for item in response['Blocks'] if item['BlockType'] == 'LINE']
-  return detected_text_list
+def get_text_lines(blocks):
+  return [item['Text'] for item in blocks if item['BlockType'] == 'LINE']
 
 
-def write_records_to_kinesis(kinesis_client, kinesis_stream_name, records):
-  import random
-  random.seed(47)
+def get_textract_data(textract_client, bucketName, documentKey):
+  response = detect_document_text(textract_client, bucketName, documentKey)
+  return get_text_lines(response['Blocks'])
+
+
+def archive_textract_response(s3_client, params, response):
+  """Store the whole detect_document_text response as gzip-compressed JSON.
+
+  Cards can be re-parsed from the archive later without paying for OCR again.
+  """
+  import gzip
+
+  image_id = os.path.basename(params['s3_key'])
+  archive = {
+    'version': 1,
+    'image_id': image_id,
+    's3_bucket': params['s3_bucket'],
+    's3_key': params['s3_key'],
+    'owner': params['owner'],
+    'DocumentMetadata': response.get('DocumentMetadata', {}),
+    'Blocks': response['Blocks']
+  }
+  body = gzip.compress(json.dumps(archive, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+  archive_key = '{prefix}{image_id}.json.gz'.format(prefix=TEXTRACT_ARCHIVE_PREFIX, image_id=image_id)
+  s3_client.put_object(Bucket=params['s3_bucket'], Key=archive_key, Body=body,
+    ContentType='application/json', ContentEncoding='gzip')
+  return {'s3_bucket': params['s3_bucket'], 's3_key': archive_key}
 
-  def gen_records():
-    record_list = []
-    for rec in records:
-      payload = json.dumps(rec, ensure_ascii=False)
-      partition_key = 'part-{:05}'.format(random.randint(1, 1024))
-      record_list.append({'Data': payload, 'PartitionKey': partition_key})
-    return record_list
 
-  MAX_RETRY_COUNT = 3
+def use_async_textract(params, mode=None):
+  mode = mode or TEXTRACT_MODE
+  if mode == 'auto':
+    return (params['s3_key'].lower().endswith(TEXTRACT_ASYNC_SUFFIXES)
+      or int(params.get('size', 0)) >= TEXTRACT_ASYNC_MIN_BYTES)
+  return mode == 'async'
 
-  record_list = gen_records()
-  for i in range(MAX_RETRY_COUNT):
-    try:
-      response = kinesis_client.put_records(Records=record_list, StreamName=kinesis_stream_name)
-      print('[DEBUG]', response, file=sys.stderr)
-      break
-    except Exception as ex:
-      import time
 
-      traceback.print_exc()
-      time.sleep(2)
-  else:
-    raise RuntimeError('[ERROR] Failed to put_records into kinesis stream: {}'.format(kinesis_stream_name))
-
-
-def update_process_status(ddb_client, table_name, item):
-  def ddb_update_item():
-    s3_bucket = item['s3_bucket']
-    s3_key = item['s3_key']
-    image_id = os.path.basename(s3_key)
-    status = item['status']
-    modified_time = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
-
-    response = ddb_client.update_item(
-      TableName=table_name,
-      Key={
-        "image_id": {
-          "S": image_id
-        }
-      },
-      UpdateExpression="SET s3_bucket = :s3_bucket, s3_key = :s3_key, mts = :mts, #status = :status",
-      ExpressionAttributeNames={
-        '#status': 'status'
-      },
-      ExpressionAttributeValues={
-        ":s3_bucket": {
-          "S": s3_bucket
-        },
-        ":s3_key": {
-          "S":  s3_key
-        },
-        ":mts": {
-          "N": "{}".format(modified_time)
-        },
-        ":status": {
-          "S": status
-        }
+def start_text_detection_job(textract_client, bucketName, documentKey, etag=None):
+  print('[DEBUG] Loading start_document_text_detection', file=sys.stderr)
+
+  params = {
+    'DocumentLocation': {
+      'S3Object': {
+        'Bucket': bucketName,
+        'Name': documentKey
       }
-    )
-    return response
+    },
+    #XXX: the same token returns the same JobId, so redelivered records do not start a second job;
+    # the etag is part of it, so new content uploaded under the same key gets a job of its own
+    'ClientRequestToken': hashlib.md5('{}/{}/{}'.format(bucketName, documentKey, etag or '').encode('utf-8')).hexdigest()
+  }
+  if etag:
+    #XXX: comes back in the completion message, so a failed job can release the etag claim its image holds
+    params['JobTag'] = etag
+  if TEXTRACT_SNS_TOPIC_ARN:
+    params['NotificationChannel'] = {
+      'SNSTopicArn': TEXTRACT_SNS_TOPIC_ARN,
+      'RoleArn': TEXTRACT_SNS_ROLE_ARN
+    }
+
+  get_textract_rate_limiter().acquire()
+  response = textract_client.start_document_text_detection(**params)
+  return response['JobId']
+
+
+def get_text_detection_job_result(textract_client, job_id):
+  """Page through get_document_text_detection and merge the Blocks of every page."""
+  blocks, document_metadata = [], {}
+  params = {'JobId': job_id, 'MaxResults': 1000}
+  while True:
+    response = textract_client.get_document_text_detection(**params)
+    if response['JobStatus'] != 'SUCCEEDED':
+      raise RuntimeError('[ERROR] Textract job {} is {}: {}'.format(job_id, response['JobStatus'], response.get('StatusMessage', '')))
+    blocks.extend(response['Blocks'])
+    document_metadata = response.get('DocumentMetadata', document_metadata)
+    if 'NextToken' not in response:
+      break
+    params['NextToken'] = response['NextToken']
+  return {'DocumentMetadata': document_metadata, 'Blocks': blocks}
 
-  try:
-    res = ddb_update_item()
-    print('[DEBUG]', res, file=sys.stderr)
-  except Exception as ex:
-    traceback.print_exc()
-    print('[ERROR]', res, file=sys.stderr)
-    raise ex
+
+def get_text_lines_by_page(blocks):
+  pages = {}
+  for item in blocks:
+    if item['BlockType'] == 'LINE':
+      pages.setdefault(item.get('Page', 1), []).append(item['Text'])
+  return [pages[k] for k in sorted(pages.keys())]
 
 
 def copy_bizcard_to_user_photo_album(s3_client, params):
@@ -159,46 +343,208 @@ def copy_bizcard_to_user_photo_album(s3_client, params):
   return {'s3_bucket': dest_s3_bucket, 's3_key': dest_s3_key, 'owner': owner}
 
 
-def lambda_handler(event, context):
-  import collections
+def emit_bizcard_text(clients, status_tracker, params, response):
+  """Archive, parse and publish the text of a card whose OCR has finished."""
+  textract_client, kinesis_client, ddb_client, s3_client = clients
+  bucket, key, owner = (params['s3_bucket'], params['s3_key'], params['owner'])
 
-  textract_client = boto3.client('textract', region_name=AWS_REGION)
-  kinesis_client = boto3.client('kinesis', region_name=AWS_REGION)
-  ddb_client = boto3.client('dynamodb', region_name=AWS_REGION)
-  s3_client = boto3.client('s3', region_name=AWS_REGION)
+  try:
+    archive_textract_response(s3_client, params, response)
+  except Exception as ex:
+    traceback.print_exc()
 
-  counter = collections.OrderedDict([('reads', 0),
-      ('writes', 0), ('errors', 0)])
+  #XXX: a multi-page document (ex: a PDF sheet of cards) yields one card per page
+  pages = [lines for lines in get_text_lines_by_page(response['Blocks']) if len(lines) >= 3]
+  if not pages:
+    raise RuntimeError('[ERROR] not enough text in {}'.format(key))
 
-  for record in event['Records']:
+  return publish_bizcard_docs(clients, status_tracker, params, [parse_textract_data(lines) for lines in pages])
+
+
+def publish_bizcard_docs(clients, status_tracker, params, docs):
+  """Publish the parsed cards of an image, one per page, and keep them for re-uploads of the image."""
+  textract_client, kinesis_client, ddb_client, s3_client = clients
+  bucket, key, owner = (params['s3_bucket'], params['s3_key'], params['owner'])
+
+  text_data_list = []
+  for i, doc in enumerate(docs):
+    doc = dict(doc, created_at=datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+    text_data = {'s3_bucket': bucket, 's3_key': key, 'owner': owner, 'data': doc}
+    if len(docs) > 1:
+      text_data['page'] = i + 1
+    print('[DEBUG]', json.dumps(text_data), file=sys.stderr)
+    text_data_list.append(text_data)
+
+  #XXX: a card that did not make it into the text stream must not end up as END
+  failed_records = write_records_to_kinesis(kinesis_client, KINESIS_STREAM_NAME, text_data_list, PARTITION_KEY_STRATEGY)
+  if failed_records:
+    raise RuntimeError('[ERROR] failed to put {} of {} cards of {} into {}'.format(len(failed_records),
+      len(text_data_list), key, KINESIS_STREAM_NAME))
+  ret = copy_bizcard_to_user_photo_album(s3_client, {'s3_bucket': bucket, 's3_key': key, 'owner': owner})
+
+  #XXX: keep the parse result so that re-uploads of the same image can reuse it
+  docs = [e['data'] for e in text_data_list]
+  status_tracker.transition({'s3_bucket': ret['s3_bucket'], 's3_key': ret['s3_key'], 'status': 'END',
+    'bizcard_data': json.dumps(docs[0] if len(docs) == 1 else docs, ensure_ascii=False)})
+  return text_data_list
+
+
+def fail_bizcard(clients, status_tracker, params):
+  """Mark an image FAILED, and let a redelivery or re-upload of it go through the pipeline again."""
+  textract_client, kinesis_client, ddb_client, s3_client = clients
+  status_item = {'s3_bucket': params['s3_bucket'], 's3_key': params['s3_key'], 'status': 'FAILED'}
+  if params.get('textract_job_id'):
+    status_item['textract_job_id'] = params['textract_job_id']
+  status_tracker.transition(status_item)
+  if params.get('etag') and not params.get('duplicate_of'):
+    release_content_hash(ddb_client, DDB_TABLE_NAME, params)
+
+
+def get_bizcard_docs(ddb_client, image_id):
+  """The cards parsed from an image that has finished, or None if its parse result is not there yet."""
+  res = ddb_client.get_item(TableName=DDB_TABLE_NAME, Key={"image_id": {"S": image_id}}, ConsistentRead=True)
+  bizcard_data = res.get('Item', {}).get('bizcard_data', {}).get('S')
+  if not bizcard_data:
+    return None
+  docs = json.loads(bizcard_data)
+  return docs if isinstance(docs, list) else [docs]
+
+
+def decode_record(record):
+  payload = base64.b64decode(record['kinesis']['data']).decode('utf-8')
+  return json.loads(payload)
+
+
+def process_record(clients, status_tracker, json_data):
+  textract_client, kinesis_client, ddb_client, s3_client = clients
+
+  bucket, key = (json_data['s3_bucket'], json_data['s3_key'])
+  try:
+    owner = os.path.basename(key).split('_')[0]
+
+    #XXX: a re-upload of an image that has already been parsed gets the earlier cards under its own
+    # key and owner without a Textract call; until the earlier image has finished (it may be in this
+    # very batch, or its async job may still run), the re-upload goes through the OCR like any image
+    if json_data.get('duplicate_of'):
+      docs = get_bizcard_docs(ddb_client, json_data['duplicate_of'])
+      if docs:
+        print('[INFO] reuse the cards of {} for {}'.format(json_data['duplicate_of'], key), file=sys.stderr)
+        return publish_bizcard_docs(clients, status_tracker, {'s3_bucket': bucket, 's3_key': key, 'owner': owner}, docs)
+
+    if use_async_textract(json_data):
+      job_id = start_text_detection_job(textract_client, bucket, key, json_data.get('etag'))
+      print('[INFO] started textract job {} for {}'.format(job_id, key), file=sys.stderr)
+      status_tracker.transition({'s3_bucket': bucket, 's3_key': key, 'status': 'PROCESS', 'textract_job_id': job_id})
+      return {'s3_bucket': bucket, 's3_key': key, 'owner': owner, 'textract_job_id': job_id}
+
+    response = detect_document_text(textract_client, bucket, key)
+    return emit_bizcard_text(clients, status_tracker, {'s3_bucket': bucket, 's3_key': key, 'owner': owner}, response)
+  except Exception as ex:
+    print('[ERROR] getting object {} from bucket {}. Make sure they exist and your bucket is in the same region as this function.'.format(key, bucket), file=sys.stderr)
+    traceback.print_exc()
+    fail_bizcard(clients, status_tracker, json_data)
+    return None
+
+
+def process_records(clients, records, max_workers=MAX_WORKERS):
+  from concurrent.futures import ThreadPoolExecutor
+
+  textract_client, kinesis_client, ddb_client, s3_client = clients
+  status_tracker = StatusTracker(ddb_client, DDB_TABLE_NAME)
+
+  json_data_list = []
+  for record in records:
     try:
-      counter['reads'] += 1
+      json_data = decode_record(record)
+      status_tracker.transition({'s3_bucket': json_data['s3_bucket'], 's3_key': json_data['s3_key'], 'status': 'PROCESS'})
+      json_data_list.append(json_data)
+    except Exception as ex:
+      traceback.print_exc()
+      json_data_list.append(None)
 
-      payload = base64.b64decode(record['kinesis']['data']).decode('utf-8')
-      json_data = json.loads(payload)
+  # all PROCESS transitions of the batch go out together, and so do the END transitions
+  status_tracker.flush()
 
-      bucket, key = (json_data['s3_bucket'], json_data['s3_key'])
-      update_process_status(ddb_client, DDB_TABLE_NAME, {'s3_bucket': bucket, 's3_key': key, 'status': 'PROCESS'})
+  def _process(json_data):
+    return process_record(clients, status_tracker, json_data) if json_data is not None else None
 
-      detected_text = get_textract_data(textract_client, bucket, key)
+  #XXX: each record spends most of its time waiting on DynamoDB, Textract, Kinesis and S3,
+  # so overlapping the records makes a batch take about as long as its slowest record.
+  # boto3 clients are thread-safe; executor.map() yields the results in the input order.
+  if max_workers <= 1 or len(json_data_list) <= 1:
+    results = [_process(e) for e in json_data_list]
+  else:
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(json_data_list))) as executor:
+      results = list(executor.map(_process, json_data_list))
 
-      doc = parse_textract_data(detected_text)
-      doc['created_at'] = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+  status_tracker.flush()
+  return results
+
+
+def lambda_handler(event, context):
+  import collections
+
+  textract_client = get_aws_client('textract')
+  kinesis_client = get_aws_client('kinesis')
+  ddb_client = get_aws_client('dynamodb')
+  s3_client = get_aws_client('s3')
+  clients = (textract_client, kinesis_client, ddb_client, s3_client)
+
+  counter = collections.OrderedDict([('reads', 0),
+      ('writes', 0), ('jobs', 0), ('errors', 0)])
+
+  records = event['Records']
+  counter['reads'] = len(records)
+  if records:
+    results = process_records(clients, records)
+    counter['jobs'] = sum([1 for e in results if isinstance(e, dict) and 'textract_job_id' in e])
+    counter['writes'] = sum([1 for e in results if isinstance(e, list)])
+    counter['errors'] = len(results) - counter['writes'] - counter['jobs']
+  print('[INFO]', ', '.join(['{}={}'.format(k, v) for k, v in counter.items()]), file=sys.stderr)
 
-      owner = os.path.basename(key).split('_')[0]
-      text_data = {'s3_bucket': bucket, 's3_key': key, 'owner': owner, 'data': doc}
-      print('[DEBUG]', json.dumps(text_data), file=sys.stderr)
 
-      write_records_to_kinesis(kinesis_client, KINESIS_STREAM_NAME, [text_data])
-      ret = copy_bizcard_to_user_photo_album(s3_client, {'s3_bucket': bucket, 's3_key': key, 'owner': owner})
+def textract_job_completion_handler(event, context):
+  """Finish asynchronous Textract jobs announced on the SNS completion topic."""
+  import collections
 
-      update_process_status(ddb_client, DDB_TABLE_NAME, {'s3_bucket': ret['s3_bucket'], 's3_key': ret['s3_key'], 'status': 'END'})
+  textract_client = get_aws_client('textract')
+  kinesis_client = get_aws_client('kinesis')
+  ddb_client = get_aws_client('dynamodb')
+  s3_client = get_aws_client('s3')
+  clients = (textract_client, kinesis_client, ddb_client, s3_client)
+
+  counter = collections.OrderedDict([('reads', 0),
+      ('writes', 0), ('errors', 0)])
 
+  status_tracker = StatusTracker(ddb_client, DDB_TABLE_NAME)
+  for record in event['Records']:
+    bucket, key = (None, None)
+    try:
+      counter['reads'] += 1
+      message = json.loads(record['Sns']['Message'])
+      job_id = message['JobId']
+      bucket, key = (message['DocumentLocation']['S3Bucket'], message['DocumentLocation']['S3ObjectName'])
+
+      if message['Status'] != 'SUCCEEDED':
+        print('[ERROR] textract job {} for {} is {}'.format(job_id, key, message['Status']), file=sys.stderr)
+        fail_bizcard(clients, status_tracker, {'s3_bucket': bucket, 's3_key': key, 'textract_job_id': job_id,
+          'etag': message.get('JobTag')})
+        counter['errors'] += 1
+        continue
+
+      response = get_text_detection_job_result(textract_client, job_id)
+      owner = os.path.basename(key).split('_')[0]
+      emit_bizcard_text(clients, status_tracker, {'s3_bucket': bucket, 's3_key': key, 'owner': owner}, response)
       counter['writes'] += 1
     except Exception as ex:
       counter['errors'] += 1
-      print('[ERROR] getting object {} from bucket {}. Make sure they exist and your bucket is in the same region as this function.'.format(key, bucket), file=sys.stderr)
+      print('[ERROR] finishing textract job for object {} from bucket {}.'.format(key, bucket), file=sys.stderr)
       traceback.print_exc()
+      if bucket and key:
+        fail_bizcard(clients, status_tracker, {'s3_bucket': bucket, 's3_key': key, 'textract_job_id': job_id,
+          'etag': message.get('JobTag')})
+  status_tracker.flush()
   print('[INFO]', ', '.join(['{}={}'.format(k, v) for k, v in counter.items()]), file=sys.stderr)
 
 
@@ -9,94 +9,142 @@ import hashlib
 import traceback
 import pprint
 
-import boto3
-import redis
-
-from gremlin_python import statics
-from gremlin_python.structure.graph import Graph
-from gremlin_python.process.graph_traversal import __
-from gremlin_python.process.strategies import *
-from gremlin_python.process.traversal import T, P, Operator, Scope, Column, Order
-from gremlin_python.process.anonymous_traversal import traversal
-from gremlin_python.driver.driver_remote_connection import DriverRemoteConnection
+from neptune_connection import NeptuneConnectionManager
+from query_cache import QueryCache, LocalCache, LOCAL_CACHE_MAX_BYTES, pack_records, unpack_records
 
 AWS_REGION = os.getenv('REGION_NAME', 'us-east-1')
 NEPTUNE_ENDPOINT = os.getenv('NEPTUNE_ENDPOINT')
 NEPTUNE_PORT = int(os.getenv('NEPTUNE_PORT', '8182'))
 
+ELASTICACHE_HOST = os.getenv('ELASTICACHE_HOST')
+
+#XXX: a user's ranking is cached once this deep and every limit/offset is a slice of it;
+# pages beyond it go to the graph without the cache
+PYMK_CACHE_DEPTH = int(os.getenv('PYMK_CACHE_DEPTH', '100'))
+
+#XXX: the gremlin_python and redis imports and their connections are deferred to
+# first use, so a cold start that is answered from the cache never pays for them
 NEPTUNE_CONN = None
+REDIS_CLIENT = None
+QUERY_CACHE = None
 
-ELASTICACHE_HOST = os.getenv('ELASTICACHE_HOST')
-redis_client = redis.Redis(host=ELASTICACHE_HOST, port=6379, db=0)
-
-def graph_traversal(neptune_endpoint=None, neptune_port=NEPTUNE_PORT, show_endpoint=True, connection=None):
-  def _remote_connection(neptune_endpoint=None, neptune_port=None, show_endpoint=True):
-    neptune_gremlin_endpoint = '{protocol}://{neptune_endpoint}:{neptune_port}/{suffix}'.format(protocol='ws',
-      neptune_endpoint=neptune_endpoint, neptune_port=neptune_port, suffix='gremlin')
-
-    if show_endpoint:
-      print('[INFO] gremlin: {}'.format(neptune_gremlin_endpoint), file=sys.stderr)
-    retry_count = 0
-    while True:
-      try:
-        return DriverRemoteConnection(neptune_gremlin_endpoint, 'g')
-      except HTTPError as ex:
-        exc_info = sys.exc_info()
-        if retry_count < 3:
-          retry_count += 1
-          print('[DEBUG] Connection timeout. Retrying...', file=sys.stderr)
-        else:
-          raise exc_info[0].with_traceback(exc_info[1], exc_info[2])
-
-  if connection is None:
-    connection = _remote_connection(neptune_endpoint, neptune_port, show_endpoint)
-  return traversal().withRemote(connection)
-
-
-def people_you_may_know(g, user_name, limit=10):
-  from gremlin_python.process.traversal import Scope, Column, Order
 
+def get_redis_client():
+  global REDIS_CLIENT
+
+  if REDIS_CLIENT is None:
+    import redis
+
+    REDIS_CLIENT = redis.Redis(host=ELASTICACHE_HOST, port=6379, db=0)
+  return REDIS_CLIENT
+
+
+def get_query_cache():
+  global QUERY_CACHE
+
+  if QUERY_CACHE is None:
+    QUERY_CACHE = QueryCache(get_redis_client(), local_cache=LocalCache() if LOCAL_CACHE_MAX_BYTES > 0 else None)
+  return QUERY_CACHE
+
+
+def get_graph_traversal():
+  global NEPTUNE_CONN
+
+  if NEPTUNE_CONN is None:
+    NEPTUNE_CONN = NeptuneConnectionManager(NEPTUNE_ENDPOINT, NEPTUNE_PORT, protocol='ws')
+  return NEPTUNE_CONN.traversal()
+
+
+def people_you_may_know(g, user_name, limit=10, offset=0):
+  from gremlin_python.process.graph_traversal import __
+  from gremlin_python.process.traversal import P, Scope, Column, Order
+
+  #XXX: rank, cut and fetch the properties on the server, so a request is one round trip
+  # and only the top candidates come back instead of the whole groupCount() map
   recommendations = (g.V().hasLabel('person').has('_name', user_name.lower()).as_('person').
     both('knows').aggregate('friends').
     both('knows').
       where(P.neq('person')).where(P.without('friends')).
-    groupCount().by('id').
+    groupCount().
     order(Scope.local).by(Column.values, Order.decr).
-    next())
+    range_(Scope.local, offset, offset + limit).
+    unfold().
+    project('properties', 'score').
+      by(__.select(Column.keys).valueMap()).
+      by(__.select(Column.values)).
+    toList())
+
+  res = []
+  for recommendation in recommendations:
+    value = {k: v for k, v in recommendation['properties'].items() if not (k == 'id' or k.startswith('_'))}
+    value['score'] = float(recommendation['score'])
+    res.append(value)
+  return res
 
-  vertex_scores = [(key, score) for key, score in recommendations.items()][:limit]
+
+def materialized_people_you_may_know(redis_client, query_hash_code, limit=10, offset=0):
+  """Read the recommendations precomputed by tools/materialize_pymk.py.
+
+  Returns None when the user has not been materialized yet, or when several persons share
+  the name, so the caller falls back to the live traversal.
+  """
+  #XXX: key formats must stay in sync with tools/materialize_pymk.py
+  person_ids = redis_client.smembers('pymk:name:{}'.format(query_hash_code))
+  if len(person_ids) != 1:
+    return None
+
+  person_id = person_ids.pop().decode('utf-8')
+  if limit <= 0:
+    return []
+  vertex_scores = redis_client.zrevrange('pymk:zset:{}'.format(person_id), offset, offset + limit - 1, withscores=True)
+  if not vertex_scores:
+    return []
+
+  profiles = redis_client.mget(['pymk:profile:{}'.format(key.decode('utf-8')) for key, _ in vertex_scores])
   res = []
-  for key, score in vertex_scores:
-    value = {k: v for k, v in g.V(key).valueMap().next().items() if not (k == 'id' or k.startswith('_'))}
+  for (key, score), profile in zip(vertex_scores, profiles):
+    if profile is None:
+      continue
+    value = json.loads(profile)
     value['score'] = float(score)
     res.append(value)
   return res
 
 
 def lambda_handler(event, context):
-  global NEPTUNE_CONN
-
-  if NEPTUNE_CONN is None:
-    NEPTUNE_CONN = graph_traversal(NEPTUNE_ENDPOINT, NEPTUNE_PORT, connection=None)
-  graph_db = NEPTUNE_CONN
- 
   try:
     user_name = event['queryStringParameters']['user']
-    limit = int(event['queryStringParameters'].get('limit', 10))
+    limit = max(0, int(event['queryStringParameters'].get('limit', 10)))
+    offset = max(0, int(event['queryStringParameters'].get('offset', 0)))
 
     query_hash_code = hashlib.md5(user_name.lower().encode('utf-8')).hexdigest()[:8]
     query_id = 'pymk:query_id:{}'.format(query_hash_code)
     print('[DEBUG] PYMK query id: {}'.format(query_id))
 
-    results = redis_client.get(query_id)
-    results = results.decode('utf-8') if results != None else None
-    if results is None:
-      ret = people_you_may_know(graph_db, user_name, limit)
-      total_count = len(ret)
-      print("[INFO] Got {} Hits:".format(total_count), file=sys.stderr)
-      results = json.dumps(ret)
-      if total_count > 0:
-        redis_client.set(query_id, results, ex=10*60, nx=True)
+    def _rank(limit, offset):
+      ret = materialized_people_you_may_know(get_redis_client(), query_hash_code, limit, offset)
+      if ret is not None:
+        print("[INFO] Got {} materialized Hits:".format(len(ret)), file=sys.stderr)
+        return ret
+      ret = people_you_may_know(get_graph_traversal(), user_name, limit, offset)
+      print("[INFO] Got {} Hits:".format(len(ret)), file=sys.stderr)
+      return ret
+
+    if offset + limit > PYMK_CACHE_DEPTH:
+      ret = _rank(limit, offset)
+    else:
+      #XXX: UpsertBizcardToGraphDB bumps the version of every user a new edge changes the PYMK of,
+      # and tools/materialize_pymk.py the global one
+      version_keys = ['pymk:version:all', 'pymk:version:{}'.format(query_hash_code)]
+      query_cache = get_query_cache()
+      ranking = query_cache.get_or_compute(query_id, lambda: pack_records(_rank(PYMK_CACHE_DEPTH, 0)), version_keys=version_keys)
+      print('[INFO] query cache:', ', '.join(['{}={}'.format(k, v) for k, v in query_cache.stats.items()]), file=sys.stderr)
+      if query_cache.local_cache is not None:
+        local_cache = query_cache.local_cache
+        print('[INFO] local cache: size={}, bytes={},'.format(len(local_cache.entries), local_cache.size_in_bytes),
+          ', '.join(['{}={}'.format(k, v) for k, v in local_cache.stats.items()]), file=sys.stderr)
+      ret = unpack_records(ranking, offset, offset + limit)
+    results = json.dumps(ret)
 
     #XXX: https://aws.amazon.com/ko/premiumsupport/knowledge-center/malformed-502-api-gateway/
     response = {
@@ -107,6 +155,8 @@ def lambda_handler(event, context):
     return response
   except Exception as ex:
     traceback.print_exc()
+    if NEPTUNE_CONN is not None:
+      NEPTUNE_CONN.mark_stale()
 
     response = {
       'statusCode': 200,
@@ -8,85 +8,196 @@ import os
 import hashlib
 import traceback
 import pprint
+import unicodedata
 
-import boto3
-from elasticsearch import Elasticsearch
-from elasticsearch import RequestsHttpConnection
-from requests_aws4auth import AWS4Auth
-import redis
+from query_cache import QueryCache, LocalCache, LOCAL_CACHE_MAX_BYTES, CACHE_NEGATIVE_TTL, pack_records, unpack_records
 
 ELASTICACHE_HOST = os.getenv('ELASTICACHE_HOST')
-redis_client = redis.Redis(host=ELASTICACHE_HOST, port=6379, db=0)
 
 ES_INDEX, ES_TYPE = (os.getenv('ES_INDEX', 'octember_bizcard'), os.getenv('ES_TYPE', 'bizcard'))
 ES_HOST = os.getenv('ES_HOST')
 
 AWS_REGION = os.getenv('REGION_NAME', 'us-east-1')
 
-session = boto3.Session(region_name=AWS_REGION)
-credentials = session.get_credentials()
-credentials = credentials.get_frozen_credentials()
-access_key = credentials.access_key
-secret_key = credentials.secret_key
-token = credentials.token
-
-aws_auth = AWS4Auth(
-  access_key,
-  secret_key,
-  AWS_REGION,
-  'es',
-  session_token=token
-)
-
-es_client = Elasticsearch(
-  hosts = [{'host': ES_HOST, 'port': 443}],
-  http_auth=aws_auth,
-  use_ssl=True,
-  verify_certs=True,
-  connection_class=RequestsHttpConnection
-)
-print('[INFO] ElasticSearch Service', json.dumps(es_client.info(), indent=2), file=sys.stderr)
+# the _source fields of a hit in the response; the rest of a document is neither returned nor cached
+SEARCH_SOURCE_FIELDS = ['doc_id', 'name', 'phone_number', 'email', 'job_title', 'company', 'addr',
+  'is_alive', 'owner', 'image_id', 'content_id', 'created_at']
 
+#XXX: a query is cached once with this many hits and every limit/offset is a slice of it;
+# pages beyond it go to elasticsearch without the cache
+SEARCH_CACHE_DEPTH = int(os.getenv('SEARCH_CACHE_DEPTH', '100'))
 
-def lambda_handler(event, context):
-  try:
-    query_params = event['queryStringParameters']
-    query_keywords = query_params.get('query', '')
+#XXX: clients are built on first use instead of at import time, so a cold start
+# does not pay for imports and connections that a cache hit never needs
+REDIS_CLIENT = None
+ES_CLIENT = None
+QUERY_CACHE = None
+
+
+def get_redis_client():
+  global REDIS_CLIENT
+
+  if REDIS_CLIENT is None:
+    import redis
+
+    REDIS_CLIENT = redis.Redis(host=ELASTICACHE_HOST, port=6379, db=0)
+  return REDIS_CLIENT
+
+
+def get_query_cache():
+  global QUERY_CACHE
+
+  if QUERY_CACHE is None:
+    QUERY_CACHE = QueryCache(get_redis_client(), local_cache=LocalCache() if LOCAL_CACHE_MAX_BYTES > 0 else None)
+  return QUERY_CACHE
+
+
+def get_es_client():
+  global ES_CLIENT
+
+  if ES_CLIENT is None:
+    import boto3
+    from elasticsearch import Elasticsearch
+    from elasticsearch import RequestsHttpConnection
+    from requests_aws4auth import AWS4Auth
+
+    session = boto3.Session(region_name=AWS_REGION)
+    credentials = session.get_credentials()
+    credentials = credentials.get_frozen_credentials()
+    access_key = credentials.access_key
+    secret_key = credentials.secret_key
+    token = credentials.token
+
+    aws_auth = AWS4Auth(
+      access_key,
+      secret_key,
+      AWS_REGION,
+      'es',
+      session_token=token
+    )
+
+    print('[INFO] elasticsearch: {}'.format(ES_HOST), file=sys.stderr)
+    ES_CLIENT = Elasticsearch(
+      hosts = [{'host': ES_HOST, 'port': 443}],
+      http_auth=aws_auth,
+      use_ssl=True,
+      verify_certs=True,
+      connection_class=RequestsHttpConnection
+    )
+  return ES_CLIENT
+
+
+def canonical_keywords(query_keywords):
+  """Normalize the keywords, so that queries elasticsearch answers alike share one cache key.
+
+  A best_fields multi_match scores each term on its own and the analyzer lowercases them, so the
+  Unicode form, case, spacing and order of the terms do not change the hits. Repeated terms do,
+  so they are kept.
+  """
+  text = unicodedata.normalize('NFKC', query_keywords).casefold()
+  return ' '.join(sorted(text.split()))
 
-    limit = int(query_params.get('limit', '10'))
-    user_name = query_params.get('user', '')
 
-    es_query_body = {"query": {"bool": {}}}
+def build_query_body(query_keywords, user_name):
+  es_query_body = {"query": {"bool": {}}}
 
-    if query_keywords:
-      es_query_body['query']['bool']['must'] = [{
-          "multi_match": {
-            "query": query_keywords,
-            "fields": [
-              "name^3", "company", "job_title", "addr"
-            ]
-          }
+  if query_keywords:
+    es_query_body['query']['bool']['must'] = [{
+        "multi_match": {
+          "query": query_keywords,
+          "fields": [
+            "name^3", "company", "job_title", "addr"
+          ]
         }
-      ]
+      }
+    ]
+
+  if user_name:
+    es_query_body['query']['bool']['filter'] = [{"term": {"owner": user_name}}]
+  return es_query_body
+
+
+def query_cache_key(es_query_body):
+  #XXX: sort_keys, so that the key does not depend on how the body was built
+  canonical_body = json.dumps(es_query_body, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+  return 'es:query_id:{}'.format(hashlib.md5(canonical_body.encode('utf-8')).hexdigest()[:8])
+
+
+def project_hit(hit):
+  """The fields of a hit the response returns, in the shape elasticsearch returned them."""
+  source = hit.get('_source', {})
+  return {'_index': hit.get('_index', ES_INDEX), '_type': hit.get('_type', ES_TYPE), '_id': hit['_id'],
+    '_score': hit['_score'], '_source': {k: source[k] for k in SEARCH_SOURCE_FIELDS if k in source}}
+
+
+def pack_hits(hits):
+  """Cache the _id, _score and _source fields of each hit as one packed record.
+
+  _index and _type are the same for every hit, so they are not cached.
+  """
+  if not hits:
+    return []
+  return {'hits': pack_records([dict(project_hit(hit)['_source'], _id=hit['_id'], _score=hit['_score']) for hit in hits])}
 
-    if user_name:
-      es_query_body['query']['bool']['filter'] = [{"term": {"owner": user_name}}]
+
+def unpack_hits(packed, start, stop):
+  """The hits[start:stop] of pack_hits(), in the shape elasticsearch returned them."""
+  if isinstance(packed, list):
+    return packed[start:stop]
+  if 'meta' in packed:
+    #XXX: entries cached with the metadata and the whole _source, before the hits were projected
+    return [project_hit(dict(meta, _source=source)) for meta, source
+      in zip(unpack_records(packed['meta'], start, stop), unpack_records(packed['sources'], start, stop))]
+  hits = []
+  for record in unpack_records(packed['hits'], start, stop):
+    source = {k: v for k, v in record.items() if k not in ('_id', '_score')}
+    hits.append({'_index': ES_INDEX, '_type': ES_TYPE, '_id': record['_id'], '_score': record['_score'], '_source': source})
+  return hits
+
+
+def lambda_handler(event, context):
+  try:
+    query_params = event['queryStringParameters']
+    #XXX: elasticsearch gets the canonical keywords too, so the cached hits are always its answer to them
+    query_keywords = canonical_keywords(query_params.get('query', ''))
+
+    limit = max(0, int(query_params.get('limit', '10')))
+    offset = max(0, int(query_params.get('offset', '0')))
+    #XXX: owner is an exact term, so only the surrounding spaces are dropped
+    user_name = query_params.get('user', '').strip()
+
+    es_query_body = build_query_body(query_keywords, user_name)
     print('[DEBUG] elasticsearch query: {}'.format(json.dumps(es_query_body)))
     assert query_keywords or user_name
 
-    query_hash_code = hashlib.md5(json.dumps(es_query_body).encode('utf-8')).hexdigest()[:8]
-    query_id = 'es:query_id:{}:limit:{}'.format(query_hash_code, limit)
+    query_id = query_cache_key(es_query_body)
     print('[DEBUG] elasticsearch query id: {}'.format(query_id))
 
-    results = redis_client.get(query_id)
-    results = results.decode('utf-8') if results != None else None
-    if results is None:
-      ret = es_client.search(index=ES_INDEX, body=es_query_body, size=limit)
-      total_count = int(ret['hits']['total']['value'])
-      print("[INFO] Got {} Hits:".format(total_count), file=sys.stderr)
-      results = json.dumps(ret['hits']['hits'])
-      if total_count > 0:
-        redis_client.set(query_id, results, ex=10*60, nx=True)
+    if offset + limit > SEARCH_CACHE_DEPTH:
+      es_client = get_es_client()
+      ret = es_client.search(index=ES_INDEX, body=es_query_body, from_=offset, size=limit,
+        _source_includes=SEARCH_SOURCE_FIELDS)
+      print("[INFO] Got {} Hits:".format(int(ret['hits']['total']['value'])), file=sys.stderr)
+      hits = [project_hit(hit) for hit in ret['hits']['hits']]
+    else:
+      def _search():
+        ret = get_es_client().search(index=ES_INDEX, body=es_query_body, size=SEARCH_CACHE_DEPTH,
+          _source_includes=SEARCH_SOURCE_FIELDS)
+        print("[INFO] Got {} Hits:".format(int(ret['hits']['total']['value'])), file=sys.stderr)
+        return pack_hits(ret['hits']['hits'])
+
+      #XXX: UpsertBizcardToES bumps the version of every owner it writes cards for, and the global one
+      version_key = 'es:version:owner:{}'.format(user_name) if user_name else 'es:version:all'
+      query_cache = get_query_cache()
+      #XXX: queries without hits are cached briefly too, and a new card of the owner invalidates them anyway
+      ranking = query_cache.get_or_compute(query_id, _search, version_keys=[version_key], negative_ttl=CACHE_NEGATIVE_TTL)
+      print('[INFO] query cache:', ', '.join(['{}={}'.format(k, v) for k, v in query_cache.stats.items()]), file=sys.stderr)
+      if query_cache.local_cache is not None:
+        local_cache = query_cache.local_cache
+        print('[INFO] local cache: size={}, bytes={},'.format(len(local_cache.entries), local_cache.size_in_bytes),
+          ', '.join(['{}={}'.format(k, v) for k, v in local_cache.stats.items()]), file=sys.stderr)
+      hits = unpack_hits(ranking, offset, offset + limit)
+    results = json.dumps(hits)
 
     #XXX: https://aws.amazon.com/ko/premiumsupport/knowledge-center/malformed-502-api-gateway/
     response = {
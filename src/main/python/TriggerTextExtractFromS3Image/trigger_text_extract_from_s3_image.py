@@ -7,106 +7,101 @@ import json
 import os
 import urllib.parse
 import traceback
-import datetime
 
-import boto3
+from aws_clients import get_aws_client
+from kinesis_producer import write_records_to_kinesis
+from process_status import StatusTracker, claim_content_hash, release_content_hash, get_process_status
 
 DRY_RUN = (os.getenv('DRY_RUN', 'false') == 'true')
 
-AWS_REGION = os.getenv('REGION_NAME', 'us-east-1')
 KINESIS_STREAM_NAME = os.getenv('KINESIS_STREAM_NAME', 'octember-bizcard-img')
 DDB_TABLE_NAME = os.getenv('DDB_TABLE_NAME', 'OctemberBizcardImg')
 
-
-def write_records_to_kinesis(kinesis_client, kinesis_stream_name, records):
-  import random
-  random.seed(47)
-
-  def gen_records():
-    record_list = []
-    for rec in records:
-      payload = json.dumps(rec, ensure_ascii=False)
-      partition_key = 'part-{:05}'.format(random.randint(1, 1024))
-      record_list.append({'Data': payload, 'PartitionKey': partition_key})
-    return record_list
-
-  MAX_RETRY_COUNT = 3
- 
-  record_list = gen_records()
-  for _ in range(MAX_RETRY_COUNT):
-    try:
-      response = kinesis_client.put_records(Records=record_list, StreamName=kinesis_stream_name)
-      print("[DEBUG]", response, file=sys.stderr)
-      break
-    except Exception as ex:
-      import time
-
-      traceback.print_exc()
-      time.sleep(2)
-  else:
-    raise RuntimeError('[ERROR] Failed to put_records into kinesis stream: {}'.format(kinesis_stream_name))
-
-
-def update_process_status(ddb_client, table_name, item):
-  def ddb_update_item():
-    s3_bucket = item['s3_bucket']
-    s3_key = item['s3_key']
-    image_id = os.path.basename(s3_key)
-    status = item['status']
-    modified_time = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
-
-    response = ddb_client.update_item(
-      TableName=table_name,
-      Key={
-        "image_id": {
-          "S": image_id
-        }
-      },
-      UpdateExpression="SET s3_bucket = :s3_bucket, s3_key = :s3_key, mts = :mts, #status = :status",
-      ExpressionAttributeNames={
-        '#status': 'status'
-      },
-      ExpressionAttributeValues={
-        ":s3_bucket": {
-          "S": s3_bucket
-        },
-        ":s3_key": {
-          "S":  s3_key
-        },
-        ":mts": {
-          "N": "{}".format(modified_time)
-        },
-        ":status": {
-          "S": status
-        }
-      }
-    )
-    return response
-
-  try:
-    print("[DEBUG] try to update_process_status", file=sys.stderr)
-    res = ddb_update_item()
-    print('[DEBUG]', res, file=sys.stderr)
-  except Exception as ex:
-    traceback.print_exc()
-    raise ex
+PARTITION_KEY_STRATEGY = os.getenv('PARTITION_KEY_STRATEGY', 'content')
 
 
 def lambda_handler(event, context):
-  kinesis_client = boto3.client('kinesis', region_name=AWS_REGION)
-  ddb_client = boto3.client('dynamodb', region_name=AWS_REGION)
+  kinesis_client = get_aws_client('kinesis')
+  ddb_client = get_aws_client('dynamodb')
+  status_tracker = StatusTracker(ddb_client, DDB_TABLE_NAME)
 
+  records, etags = [], {}
   for record in event['Records']:
     try:
       bucket = record['s3']['bucket']['name']
       key = urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8')
-
-      record = {'s3_bucket': bucket, 's3_key': key}
-      print("[INFO] object created: ", record, file=sys.stderr)
-      write_records_to_kinesis(kinesis_client, KINESIS_STREAM_NAME, [record])
-      update_process_status(ddb_client, DDB_TABLE_NAME, {'s3_bucket': bucket, 's3_key': key, 'status': 'START'})
+      etag = record['s3']['object'].get('eTag')
+      size = record['s3']['object'].get('size', 0)
     except Exception as ex:
       traceback.print_exc()
+      continue
+
+    #XXX: the size lets the OCR stage choose between sync and async Textract
+    record = {'s3_bucket': bucket, 's3_key': key, 'size': size}
+    print("[INFO] object created: ", record, file=sys.stderr)
+    if etag:
+      item = {'s3_bucket': bucket, 's3_key': key, 'etag': etag}
+      try:
+        origin = claim_content_hash(ddb_client, DDB_TABLE_NAME, item)
+      except Exception as ex:
+        #XXX: without the claim the image is still worth its OCR call; dropping it would lose the card
+        traceback.print_exc()
+        records.append(record)
+        continue
+
+      if origin is not None and origin.get('origin_image_id') == os.path.basename(key):
+        #XXX: the claim is kept if a run fails after it was put into the stream (ex: Textract failed),
+        # so only a redelivery of an image that has made it to the end is skipped
+        try:
+          origin_status = get_process_status(ddb_client, DDB_TABLE_NAME, os.path.basename(key))
+        except Exception as ex:
+          traceback.print_exc()
+          origin_status = None
+        if origin_status == 'END':
+          print("[INFO] skip redelivered object: ", record, file=sys.stderr)
+          continue
+        print("[INFO] retry unfinished object ({}): ".format(origin_status), record, file=sys.stderr)
+        origin = None
+      if origin is not None:
+        #XXX: the same image from another upload (often another owner) still needs its own card
+        # for this key and owner; GetTextFromS3Image republishes the earlier parse result instead
+        # of calling Textract, or runs the OCR if that result is not there yet
+        print("[INFO] duplicate of {}: ".format(origin.get('origin_image_id')), record, file=sys.stderr)
+        record['duplicate_of'] = origin['origin_image_id']
+      else:
+        etags[(bucket, key)] = etag
+      #XXX: lets GetTextFromS3Image release the claim if the image fails there
+      record['etag'] = etag
+    records.append(record)
+
+  failed_records = []
+  if records:
+    try:
+      failed_records = write_records_to_kinesis(kinesis_client, KINESIS_STREAM_NAME, records, PARTITION_KEY_STRATEGY)
+    except Exception as ex:
+      traceback.print_exc()
+      failed_records = records
+
+  failed_keys = set((rec['s3_bucket'], rec['s3_key']) for rec in failed_records)
+  for record in records:
+    bucket, key = (record['s3_bucket'], record['s3_key'])
+    etag = etags.get((bucket, key))
+    if (bucket, key) in failed_keys:
+      if etag:
+        release_content_hash(ddb_client, DDB_TABLE_NAME, {'s3_bucket': bucket, 's3_key': key, 'etag': etag})
+      continue
+
+    status_item = {'s3_bucket': bucket, 's3_key': key, 'status': 'START'}
+    if etag:
+      status_item['etag'] = etag
+    if record.get('duplicate_of'):
+      status_item['duplicate_of'] = record['duplicate_of']
+    status_tracker.transition(status_item)
+
+  try:
+    status_tracker.flush()
+  except Exception as ex:
+    traceback.print_exc()
 
 
 if __name__ == '__main__':
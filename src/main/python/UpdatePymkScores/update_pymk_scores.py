@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import sys
+import os
+import json
+import hashlib
+import traceback
+import collections
+
+ELASTICACHE_HOST = os.getenv('ELASTICACHE_HOST')
+
+#XXX: key formats must stay in sync with tools/materialize_pymk.py and neptune_recommend_bizcard.py
+PYMK_EDGE_DELTAS_KEY = 'pymk:edge_deltas'
+PYMK_SETTINGS_KEY = 'pymk:materialized'
+PYMK_PROFILE_KEY = 'pymk:profile:{}'
+PYMK_QUERY_KEY = 'pymk:query_id:{}'
+
+# deltas read from the list at a time, and the time left to the deadline when the function stops reading
+DELTA_BATCH_SIZE = int(os.getenv('DELTA_BATCH_SIZE', '100'))
+DEADLINE_MARGIN_MILLIS = int(os.getenv('DEADLINE_MARGIN_MILLIS', '5000'))
+
+#XXX: A·A changes by A·E + E·A for the new edge E between a and b, so every neighbour x of a gains
+# b as a candidate (and b gains x) by the number of a-x edges, and the other way round. Candidates
+# who are friends already are masked out, and a and b stop recommending each other. The script runs
+# atomically, so the adjacency it reads is the one before this edge.
+APPLY_EDGE_DELTA_SCRIPT = '''
+redis.replicate_commands()
+local a, b = ARGV[1], ARGV[2]
+local top_k, ttl = tonumber(ARGV[3]), tonumber(ARGV[4])
+
+local function neighbours(id)
+  local flat = redis.call('HGETALL', 'pymk:adj:' .. id)
+  local res = {}
+  for i = 1, #flat, 2 do
+    res[flat[i]] = tonumber(flat[i + 1])
+  end
+  return res
+end
+
+local touched = {}
+local function incr(user, candidate, score)
+  if redis.call('EXISTS', 'pymk:profile:' .. user) == 1 then
+    redis.call('ZINCRBY', 'pymk:zset:' .. user, score, candidate)
+    touched[user] = true
+  end
+end
+
+local na, nb = neighbours(a), neighbours(b)
+for x, w in pairs(na) do
+  if x ~= b and nb[x] == nil then
+    incr(x, b, w)
+    incr(b, x, w)
+  end
+end
+for x, w in pairs(nb) do
+  if x ~= a and na[x] == nil then
+    incr(x, a, w)
+    incr(a, x, w)
+  end
+end
+redis.call('ZREM', 'pymk:zset:' .. a, b)
+redis.call('ZREM', 'pymk:zset:' .. b, a)
+touched[a] = true
+touched[b] = true
+
+redis.call('HINCRBY', 'pymk:adj:' .. a, b, 1)
+redis.call('HINCRBY', 'pymk:adj:' .. b, a, 1)
+redis.call('EXPIRE', 'pymk:adj:' .. a, ttl)
+redis.call('EXPIRE', 'pymk:adj:' .. b, ttl)
+
+local res = {}
+for user, _ in pairs(touched) do
+  local key = 'pymk:zset:' .. user
+  redis.call('ZREMRANGEBYRANK', key, 0, -(top_k + 1))
+  local pttl = redis.call('PTTL', 'pymk:profile:' .. user)
+  if pttl > 0 then
+    redis.call('PEXPIRE', key, pttl)
+  end
+  table.insert(res, user)
+end
+return res
+'''
+
+REDIS_CLIENT = None
+APPLY_EDGE_DELTA = None
+
+
+def get_redis_client():
+  global REDIS_CLIENT, APPLY_EDGE_DELTA
+
+  if REDIS_CLIENT is None:
+    import redis
+
+    REDIS_CLIENT = redis.Redis(host=ELASTICACHE_HOST, port=6379, db=0)
+    APPLY_EDGE_DELTA = REDIS_CLIENT.register_script(APPLY_EDGE_DELTA_SCRIPT)
+  return REDIS_CLIENT
+
+
+def apply_edge_delta(redis_client, delta, top_k, ttl):
+  """Update the sorted sets for one new 'knows' edge; returns the ids of the users whose sets changed."""
+  #XXX: persons created since the last materialization get a profile here, so they can be recommended
+  for person_id, profile in delta.get('profiles', {}).items():
+    redis_client.set(PYMK_PROFILE_KEY.format(person_id), json.dumps(profile), ex=ttl, nx=True)
+  touched = APPLY_EDGE_DELTA(args=[delta['from'], delta['to'], top_k, ttl], client=redis_client)
+  return [e.decode('utf-8') for e in touched]
+
+
+def invalidate_query_cache(redis_client, person_ids):
+  """Drop the cached PYMK responses of the users whose recommendations changed."""
+  person_ids = list(person_ids)
+  if not person_ids:
+    return 0
+  profiles = redis_client.mget([PYMK_PROFILE_KEY.format(person_id) for person_id in person_ids])
+  query_ids = set()
+  for profile in profiles:
+    if profile is None:
+      continue
+    name = json.loads(profile)['name'][0]
+    #XXX: the same query id as neptune_recommend_bizcard.lambda_handler()
+    query_ids.add(PYMK_QUERY_KEY.format(hashlib.md5(name.lower().encode('utf-8')).hexdigest()[:8]))
+  return redis_client.delete(*query_ids) if query_ids else 0
+
+
+def lambda_handler(event, context):
+  counter = collections.OrderedDict([('reads', 0), ('applied', 0), ('errors', 0), ('touched', 0), ('invalidated', 0)])
+
+  redis_client = get_redis_client()
+  settings = {k.decode('utf-8'): v.decode('utf-8') for k, v in redis_client.hgetall(PYMK_SETTINGS_KEY).items()}
+  if not settings:
+    #XXX: there is nothing to update until tools/materialize_pymk.py has run, and it starts from the graph anyway
+    dropped = redis_client.llen(PYMK_EDGE_DELTAS_KEY)
+    redis_client.delete(PYMK_EDGE_DELTAS_KEY)
+    print('[INFO] PYMK is not materialized yet, dropped {} edge deltas'.format(dropped), file=sys.stderr)
+    return
+  top_k, ttl = (int(settings['top_k']), int(settings['ttl']))
+
+  remaining_time_in_millis = getattr(context, 'get_remaining_time_in_millis', lambda: sys.maxsize)
+  touched = set()
+  while remaining_time_in_millis() > DEADLINE_MARGIN_MILLIS:
+    #XXX: LPUSH puts the newest delta at the head, so the oldest ones are at the tail
+    deltas = redis_client.lrange(PYMK_EDGE_DELTAS_KEY, -DELTA_BATCH_SIZE, -1)
+    if not deltas:
+      break
+    for payload in reversed(deltas):
+      counter['reads'] += 1
+      try:
+        touched.update(apply_edge_delta(redis_client, json.loads(payload), top_k, ttl))
+        counter['applied'] += 1
+      except Exception as ex:
+        counter['errors'] += 1
+        traceback.print_exc()
+    #XXX: a single consumer (reserved concurrency 1) owns the tail, so it can trim what it has read
+    redis_client.ltrim(PYMK_EDGE_DELTAS_KEY, 0, -(len(deltas) + 1))
+
+  counter['touched'] = len(touched)
+  #XXX: UpsertBizcardToGraphDB bumps the PYMK version of these users when it writes the edge, but a
+  # request between that and this run caches the ranking without the edge under the new version
+  counter['invalidated'] = invalidate_query_cache(redis_client, touched)
+  print('[INFO]', ', '.join(['{}={}'.format(k, v) for k, v in counter.items()]), file=sys.stderr)
+
+
+if __name__ == '__main__':
+  event = {
+    "version": "0",
+    "id": "53dc4d37-cffa-4f76-80c9-8b7d4a4d2eaa",
+    "detail-type": "Scheduled Event",
+    "source": "aws.events",
+    "account": "123456789012",
+    "time": "2019-10-25T01:12:54Z",
+    "region": "us-east-1",
+    "resources": [
+      "arn:aws:events:us-east-1:123456789012:rule/UpdatePymkScoresSchedule"
+    ],
+    "detail": {}
+  }
+  lambda_handler(event, None)
@@ -8,40 +8,89 @@ import os
 import base64
 import traceback
 import hashlib
+import uuid
 
 import boto3
-from elasticsearch import Elasticsearch
-from elasticsearch import RequestsHttpConnection
-from requests_aws4auth import AWS4Auth
 
 ES_INDEX, ES_TYPE = (os.getenv('ES_INDEX', 'octember_bizcard'), os.getenv('ES_TYPE', 'bizcard'))
 ES_HOST = os.getenv('ES_HOST')
 
 AWS_REGION = os.getenv('REGION_NAME', 'us-east-1')
 
-session = boto3.Session(region_name=AWS_REGION)
-credentials = session.get_credentials()
-credentials = credentials.get_frozen_credentials()
-access_key = credentials.access_key
-secret_key = credentials.secret_key
-token = credentials.token
-
-aws_auth = AWS4Auth(
-    access_key,
-    secret_key,
-    AWS_REGION,
-    'es',
-    session_token=token
-)
-
-es_client = Elasticsearch(
-    hosts = [{'host': ES_HOST, 'port': 443}],
-    http_auth=aws_auth,
-    use_ssl=True,
-    verify_certs=True,
-    connection_class=RequestsHttpConnection
-)
-print('[INFO] ElasticSearch Service', json.dumps(es_client.info(), indent=2), file=sys.stderr)
+# the owners of the written cards get a new version, which invalidates their cached search
+# responses in SearchBizcard; nothing is invalidated unless ELASTICACHE_HOST is set
+ELASTICACHE_HOST = os.getenv('ELASTICACHE_HOST')
+ES_VERSION_OWNER_KEY = 'es:version:owner:{}'
+ES_VERSION_ALL_KEY = 'es:version:all'
+#XXX: must outlive CACHE_HARD_TTL of SearchBizcard, or an entry could outlive its version
+CACHE_VERSION_TTL = int(os.getenv('CACHE_VERSION_TTL', str(7*24*60*60)))
+
+#XXX: the client is built on first use instead of at import time, so a cold start
+# does not pay for the elasticsearch import and a cluster round trip up front
+ES_CLIENT = None
+REDIS_CLIENT = None
+
+
+def get_es_client():
+  global ES_CLIENT
+
+  if ES_CLIENT is None:
+    from elasticsearch import Elasticsearch
+    from elasticsearch import RequestsHttpConnection
+    from requests_aws4auth import AWS4Auth
+
+    session = boto3.Session(region_name=AWS_REGION)
+    credentials = session.get_credentials()
+    credentials = credentials.get_frozen_credentials()
+    access_key = credentials.access_key
+    secret_key = credentials.secret_key
+    token = credentials.token
+
+    aws_auth = AWS4Auth(
+        access_key,
+        secret_key,
+        AWS_REGION,
+        'es',
+        session_token=token
+    )
+
+    print('[INFO] elasticsearch: {}'.format(ES_HOST), file=sys.stderr)
+    ES_CLIENT = Elasticsearch(
+        hosts = [{'host': ES_HOST, 'port': 443}],
+        http_auth=aws_auth,
+        use_ssl=True,
+        verify_certs=True,
+        connection_class=RequestsHttpConnection
+    )
+  return ES_CLIENT
+
+
+def get_redis_client():
+  global REDIS_CLIENT
+
+  if REDIS_CLIENT is None and ELASTICACHE_HOST:
+    import redis
+
+    REDIS_CLIENT = redis.Redis(host=ELASTICACHE_HOST, port=6379, db=0)
+  return REDIS_CLIENT
+
+
+def bump_search_versions(redis_client, owners):
+  """Give each owner, and the searches without an owner, a new version.
+
+  The version is a random stamp rather than a counter, so a version that expired and came back
+  can never match one recorded in an old entry. Best effort: the cached responses expire anyway.
+  """
+  keys = [ES_VERSION_OWNER_KEY.format(owner) for owner in owners] + [ES_VERSION_ALL_KEY]
+  try:
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+      pipe.set(key, uuid.uuid4().hex, ex=CACHE_VERSION_TTL)
+    pipe.execute()
+    return len(keys)
+  except Exception as ex:
+    print('[WARNING] failed to bump {} search versions: {}'.format(len(keys), ex), file=sys.stderr)
+    return 0
 
 
 def lambda_handler(event, context):
@@ -53,6 +102,7 @@ def lambda_handler(event, context):
       ('errors', 0)])
 
   doc_list = []
+  owners = set()
   for record in event['Records']:
     try:
       counter['reads'] += 1
@@ -64,6 +114,9 @@ def lambda_handler(event, context):
         continue
 
       image_id = os.path.basename(json_data['s3_key'])
+      if json_data.get('page'):
+        # a multi-page document holds one card per page
+        image_id = '{}#{}'.format(image_id, json_data['page'])
       doc = json_data['data']
       doc['doc_id'] = hashlib.md5(image_id.encode('utf-8')).hexdigest()[:8]
       doc['image_id'] = image_id
@@ -77,20 +130,26 @@ def lambda_handler(event, context):
       es_index_action_meta = {"index": {"_index": ES_INDEX, "_type": ES_TYPE, "_id": doc['doc_id']}}
       doc_list.append(es_index_action_meta)
       doc_list.append(doc)
+      owners.add(doc['owner'])
 
       counter['writes'] += 1
     except Exception as ex:
       counter['errors'] += 1
       traceback.print_exc()
 
-  print('[INFO]', ', '.join(['{}={}'.format(k, v) for k, v in counter.items()]), file=sys.stderr)
-
   try:
     es_bulk_body = '\n'.join([json.dumps(e) for e in doc_list])
+    es_client = get_es_client()
     res = es_client.bulk(body=es_bulk_body, index=ES_INDEX, refresh=True)
   except Exception as ex:
     traceback.print_exc()
 
+  #XXX: after refresh=True the new cards are searchable, so the next request recomputes with them
+  redis_client = get_redis_client()
+  if owners and redis_client is not None:
+    counter['bumped_versions'] = bump_search_versions(redis_client, owners)
+  print('[INFO]', ', '.join(['{}={}'.format(k, v) for k, v in counter.items()]), file=sys.stderr)
+
 
 if __name__ == '__main__':
   kinesis_data = [
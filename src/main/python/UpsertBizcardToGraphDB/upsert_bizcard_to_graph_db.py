@@ -10,13 +10,16 @@ import time
 import traceback
 import random
 import hashlib
+import collections
+import threading
+import uuid
 
 from gremlin_python.structure.graph import Graph
 from gremlin_python.process.graph_traversal import __
 from gremlin_python.process.strategies import *
-from gremlin_python.process.traversal import T, P, Operator
-from gremlin_python.process.anonymous_traversal import traversal
-from gremlin_python.driver.driver_remote_connection import DriverRemoteConnection
+from gremlin_python.process.traversal import T, P, TextP, Operator, Cardinality, Scope
+
+from neptune_connection import NeptuneConnectionManager, remote_connection, graph_traversal
 
 random.seed(47)
 
@@ -24,61 +27,249 @@ AWS_REGION = os.getenv('REGION_NAME', 'us-east-1')
 NEPTUNE_ENDPOINT = os.getenv('NEPTUNE_ENDPOINT')
 NEPTUNE_PORT = int(os.getenv('NEPTUNE_PORT', '8182'))
 
+NEPTUNE_CONN = None
+
+# number of upserts chained into a single traversal
+GRAPH_WRITE_CHUNK_SIZE = int(os.getenv('GRAPH_WRITE_CHUNK_SIZE', '50'))
+GRAPH_WRITE_MAX_RETRY_COUNT = int(os.getenv('GRAPH_WRITE_MAX_RETRY_COUNT', '5'))
+GRAPH_WRITE_RETRY_BASE_DELAY = float(os.getenv('GRAPH_WRITE_RETRY_BASE_DELAY', '0.05'))
+GRAPH_WRITE_RETRY_MAX_DELAY = float(os.getenv('GRAPH_WRITE_RETRY_MAX_DELAY', '2.0'))
+
+# vertices and edges known to be in the graph; 0 disables the cache
+GRAPH_CACHE_MAX_SIZE = int(os.getenv('GRAPH_CACHE_MAX_SIZE', '10000'))
+GRAPH_CACHE_TTL = float(os.getenv('GRAPH_CACHE_TTL', '300'))
+
+# clear_graph() drops one id prefix per worker and adapts its batch size to the drop latency
+GRAPH_CLEAR_WORKERS = int(os.getenv('GRAPH_CLEAR_WORKERS', '8'))
+GRAPH_CLEAR_TARGET_LATENCY = float(os.getenv('GRAPH_CLEAR_TARGET_LATENCY', '2.0'))
+GRAPH_CLEAR_MAX_BATCH_SIZE = int(os.getenv('GRAPH_CLEAR_MAX_BATCH_SIZE', '5000'))
+
+# new 'knows' edges are published to the PYMK cache, where UpdatePymkScores applies them, and
+# the users they affect get a new version, which invalidates their cached PYMK responses;
+# nothing is published unless ELASTICACHE_HOST is set
+ELASTICACHE_HOST = os.getenv('ELASTICACHE_HOST')
+PYMK_EDGE_DELTAS_KEY = 'pymk:edge_deltas'
+PYMK_VERSION_KEY = 'pymk:version:{}'
+#XXX: must outlive CACHE_HARD_TTL of RecommendBizcard, or an entry could outlive its version
+CACHE_VERSION_TTL = int(os.getenv('CACHE_VERSION_TTL', str(7*24*60*60)))
+
+REDIS_CLIENT = None
+
+
+class KnownGraphCache:
+  """Bounded LRU of the vertices and edges this container has written, with a TTL.
 
-def graph_traversal(neptune_endpoint=None, neptune_port=NEPTUNE_PORT, show_endpoint=True, connection=None):
-  def _remote_connection(neptune_endpoint=None, neptune_port=None, show_endpoint=True):
-    neptune_gremlin_endpoint = '{protocol}://{neptune_endpoint}:{neptune_port}/{suffix}'.format(protocol='wss',
-      neptune_endpoint=neptune_endpoint, neptune_port=neptune_port, suffix='gremlin')
+  Keys are ('v', person_id) -> True and ('e', from_person_id, to_person_id) -> edge weight.
+  """
 
-    if show_endpoint:
-      print('[INFO] gremlin: {}'.format(neptune_gremlin_endpoint), file=sys.stderr)
+  def __init__(self, max_size=GRAPH_CACHE_MAX_SIZE, ttl=GRAPH_CACHE_TTL):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.entries = collections.OrderedDict()
+    self.stats = collections.OrderedDict([('hits', 0), ('misses', 0), ('expired', 0),
+      ('evictions', 0), ('invalidations', 0)])
+
+  def get(self, key):
+    entry = self.entries.get(key)
+    if entry is None:
+      self.stats['misses'] += 1
+      return None
+    expires_at, value = entry
+    if expires_at < time.time():
+      del self.entries[key]
+      self.stats['expired'] += 1
+      self.stats['misses'] += 1
+      return None
+    self.entries.move_to_end(key)
+    self.stats['hits'] += 1
+    return value
+
+  def has(self, key):
+    """Whether key is cached and not expired, without counting a hit or a miss."""
+    entry = self.entries.get(key)
+    return entry is not None and entry[0] >= time.time()
+
+  def put(self, key, value):
+    self.entries[key] = (time.time() + self.ttl, value)
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.max_size:
+      self.entries.popitem(last=False)
+      self.stats['evictions'] += 1
+
+  def invalidate_vertex(self, person_id):
+    """Forget a vertex and every edge that touches it, since edges go away with their vertex."""
+    keys = [k for k in self.entries if (k[0] == 'v' and k[1] == person_id) or (k[0] == 'e' and person_id in k[1:])]
+    for k in keys:
+      del self.entries[k]
+    self.stats['invalidations'] += len(keys)
+
+  def clear(self):
+    self.entries.clear()
+
+
+KNOWN_GRAPH_CACHE = KnownGraphCache() if GRAPH_CACHE_MAX_SIZE > 0 else None
+
+
+def get_graph_traversal():
+  global NEPTUNE_CONN
+
+  if NEPTUNE_CONN is None:
+    NEPTUNE_CONN = NeptuneConnectionManager(NEPTUNE_ENDPOINT, NEPTUNE_PORT)
+  return NEPTUNE_CONN.traversal()
+
+
+def get_redis_client():
+  global REDIS_CLIENT
+
+  if REDIS_CLIENT is None and ELASTICACHE_HOST:
+    import redis
+
+    REDIS_CLIENT = redis.Redis(host=ELASTICACHE_HOST, port=6379, db=0)
+  return REDIS_CLIENT
+
+
+class AdaptiveBatchSize:
+  """Grows the batch while requests are fast, and shrinks it when they are slow or fail."""
+
+  def __init__(self, size, min_size=10, max_size=GRAPH_CLEAR_MAX_BATCH_SIZE, target_latency=GRAPH_CLEAR_TARGET_LATENCY):
+    self.min_size = min_size
+    self.max_size = max(max_size, min_size)
+    self.size = min(max(size, self.min_size), self.max_size)
+    self.target_latency = target_latency
+
+  def update(self, elapsed):
+    if elapsed < self.target_latency / 2:
+      self.size = min(self.max_size, self.size * 2)
+    elif elapsed > self.target_latency:
+      self.size = max(self.min_size, self.size // 2)
+
+  def shrink(self):
+    self.size = max(self.min_size, self.size // 2)
+
+
+class DropTally:
+  """Running count of dropped elements, shared by the workers; prints progress every interval seconds."""
+
+  def __init__(self, interval=5.0):
+    self.counts = collections.OrderedDict([('edges', 0), ('vertices', 0)])
+    self.interval = interval
+    self.started_at = self.reported_at = time.time()
+    self.lock = threading.Lock()
+
+  def add(self, key, count):
+    with self.lock:
+      self.counts[key] += count
+      if time.time() - self.reported_at >= self.interval:
+        self.report()
+
+  def report(self):
+    self.reported_at = time.time()
+    print('[INFO] cleared {} in {:.1f}s'.format(', '.join(['{}={}'.format(k, v) for k, v in self.counts.items()]),
+      self.reported_at - self.started_at), file=sys.stderr)
+
+
+def drop_in_batches(make_traversal, batch, tally, key, max_retry_count=5):
+  """Drop the elements of make_traversal() batch.size at a time until none are left.
+
+  Each request drops a batch and returns how many it dropped, so a short batch means the end
+  is near; limit(1) then confirms it instead of counting what is left.
+  """
+  retry_count = 0
+  while True:
+    requested = batch.size
+    started_at = time.time()
+    try:
+      dropped = (make_traversal().limit(requested).fold().
+        sideEffect(__.unfold().drop()).
+        count(Scope.local).next())
+    except Exception as ex:
+      if retry_count >= max_retry_count:
+        raise ex
+      retry_count += 1
+      batch.shrink()
+      print('[WARNING] dropping {} {} failed, retrying with batch_size={}: {}'.format(requested, key, batch.size, ex), file=sys.stderr)
+      time.sleep(random.uniform(0, 0.1 * (2 ** retry_count)))
+      continue
     retry_count = 0
-    while True:
-      try:
-        return DriverRemoteConnection(neptune_gremlin_endpoint, 'g')
-      except HTTPError as ex:
-        exc_info = sys.exc_info()
-        if retry_count < 3:
-          retry_count += 1
-          print('[DEBUG] Connection timeout. Retrying...', file=sys.stderr)
-        else:
-          raise exc_info[0].with_traceback(exc_info[1], exc_info[2])
-
-  if connection is None:
-    connection = _remote_connection(neptune_endpoint, neptune_port, show_endpoint)
-  return traversal().withRemote(connection)
-
-
-def clear_graph(neptune_endpoint=None, neptune_port=NEPTUNE_PORT, batch_size=200, edge_batch_size=None, vertex_batch_size=None):
+    batch.update(time.time() - started_at)
+    tally.add(key, dropped)
+    if dropped < requested and not make_traversal().limit(1).toList():
+      return
+
+
+def clear_graph(neptune_endpoint=None, neptune_port=NEPTUNE_PORT, batch_size=200, edge_batch_size=None, vertex_batch_size=None,
+    workers=GRAPH_CLEAR_WORKERS, owner=None, chunk_size=500):
+  """Drop every edge and vertex, or only the subgraph of one owner.
+
+  Vertex ids are md5 hex digests, so the graph is split into 16 partitions by the first digit of
+  the 'id' property and the partitions are dropped in parallel. The ids of a partition are read
+  once, and its vertices are then looked up by id chunk_size at a time. Edges go first, each one
+  with the chunk of its out-vertex. Elements outside the partitions are swept up at the end.
+  """
+  from concurrent.futures import ThreadPoolExecutor
+
   if edge_batch_size is None:
     edge_batch_size = batch_size
 
   if vertex_batch_size is None:
     vertex_batch_size = batch_size
 
-  g = graph_traversal(neptune_endpoint, neptune_port, False) 
-
-  has_edges = True
-  edge_count = None
-  while has_edges:
-    if edge_count is None:
-      print('[DEBUG] clearing property graph data [edge_batch_size={}, edge_count=Unknown]...'.format(edge_batch_size))
-    else:
-      print('[DEBUG] clearing property graph data [edge_batch_size={}, edge_count={}]...'.format(edge_batch_size, edge_count))
-    g.E().limit(edge_batch_size).drop().toList()
-    edge_count = g.E().count().next()
-    has_edges = (edge_count > 0)
-
-  has_vertices = True
-  vertex_count = None
-  while has_vertices:
-    if vertex_count is None:
-      print('[DEBUG] clearing property graph data [vertex_batch_size={}, vertex_count=Unknown]...'.format(vertex_batch_size), file=sys.stderr)
+  connection = remote_connection(neptune_endpoint, neptune_port, False, pool_size=workers)
+  g = graph_traversal(connection=connection)
+  tally = DropTally()
+  try:
+    if owner is not None:
+      clear_owner_subgraph(g, owner, AdaptiveBatchSize(edge_batch_size), AdaptiveBatchSize(vertex_batch_size), tally)
     else:
-      print('[DEBUG] clearing property graph data [vertex_batch_size={}, vertex_count={}]...'.format(vertex_batch_size, vertex_count), file=sys.stderr)
-    g.V().limit(vertex_batch_size).drop().toList()
-    vertex_count = g.V().count().next()
-    has_vertices = (vertex_count > 0)
+      prefixes = ['{:x}'.format(i) for i in range(16)]
+
+      def _read_ids(prefix):
+        #XXX: a batch that scanned the partition again would walk past every vertex whose edges
+        # are already gone, so the partition is scanned once and each batch looks up its vertices by id
+        return g.V().has('id', TextP.startingWith(prefix)).id().toList()
+
+      def _drop_edges(ids):
+        batch = AdaptiveBatchSize(edge_batch_size)
+        for i in range(0, len(ids), chunk_size):
+          chunk = ids[i:i + chunk_size]
+          drop_in_batches(lambda: g.V(*chunk).outE(), batch, tally, 'edges')
+
+      def _drop_vertices(ids):
+        batch = AdaptiveBatchSize(vertex_batch_size)
+        for i in range(0, len(ids), chunk_size):
+          chunk = ids[i:i + chunk_size]
+          drop_in_batches(lambda: g.V(*chunk), batch, tally, 'vertices')
+
+      with ThreadPoolExecutor(max_workers=max(1, min(workers, len(prefixes)))) as executor:
+        partitions = list(executor.map(_read_ids, prefixes))
+        list(executor.map(_drop_edges, partitions))
+        list(executor.map(_drop_vertices, partitions))
+
+      drop_in_batches(lambda: g.E(), AdaptiveBatchSize(edge_batch_size), tally, 'edges')
+      drop_in_batches(lambda: g.V(), AdaptiveBatchSize(vertex_batch_size), tally, 'vertices')
+    tally.report()
+  finally:
+    connection.close()
+
+  if KNOWN_GRAPH_CACHE is not None:
+    KNOWN_GRAPH_CACHE.clear()
+  return tally.counts
+
+
+def clear_owner_subgraph(g, owner, edge_batch, vertex_batch, tally, chunk_size=500):
+  """Drop the 'knows' edges of one owner, then the vertices that are left without any edge.
+
+  Persons are shared by every owner who has their card, so a person vertex is only dropped
+  when no other owner knows it anymore.
+  """
+  owner_id = owner_person_id(owner)
+  person_ids = g.V(owner_id).out('knows').id().toList()
+  drop_in_batches(lambda: g.V(owner_id).outE('knows'), edge_batch, tally, 'edges')
+
+  candidate_ids = [owner_id] + person_ids
+  for i in range(0, len(candidate_ids), chunk_size):
+    chunk = candidate_ids[i:i + chunk_size]
+    drop_in_batches(lambda: g.V(*chunk).not_(__.bothE()), vertex_batch, tally, 'vertices')
 
 
 def get_person(g, person_id):
@@ -86,31 +277,254 @@ def get_person(g, person_id):
   return None if not person else person[-1]
 
 
-def upsert_person(g, person):
-  person_vertex = get_person(g, person['id'])
-  elem = g.addV('person').property(T.id, person['id']).next() if not person_vertex else g.V(person_vertex).next()
-  for k in ('id', 'name', 'email', 'phone_number', 'company', 'job_title'):
-    g.V(elem).property(k, person[k]).next()
-  g.V(elem).property('_name', person['name'].lower()).next()
+PERSON_PROPERTIES = ('id', 'name', 'email', 'phone_number', 'company', 'job_title')
+
+
+def owner_person_id(owner):
+  return hashlib.md5(owner.encode('utf-8')).hexdigest()[:8]
+
+
+def upsert_vertex_traversal(t, person, created_key=None):
+  """Append a person vertex upsert to t, which is either g or __.
+
+  V(id).fold().coalesce(unfold(), addV()) creates the vertex only if it does not exist yet.
+  With created_key, the id is stored in that side effect when the vertex is new.
+  """
+  add_vertex = __.addV('person').property(T.id, person['id'])
+  if created_key is not None:
+    add_vertex = add_vertex.sideEffect(__.constant(person['id']).store(created_key))
+  t = t.V(person['id']).fold().coalesce(__.unfold(), add_vertex)
+  for k in PERSON_PROPERTIES:
+    t = t.property(Cardinality.single, k, person[k])
+  return t.property(Cardinality.single, '_name', person['name'].lower())
+
 
-  _from_person_id = hashlib.md5(person['owner'].encode('utf-8')).hexdigest()[:8]
+def upsert_edge_traversal(t, from_person_id, to_person_id, weight=1.0, created_key=None, affected_key=None):
+  """Append a 'knows' edge upsert to t; nothing is written unless the owner is already in the graph.
+
+  With created_key, 'from_person_id:to_person_id' is stored in that side effect when the edge is new.
+  With affected_key, the _name of both persons and of their friends is stored in that side effect
+  when the edge is new; those are the users whose people-you-may-know changes.
+  """
+  add_edge = __.addE('knows').to(__.V(to_person_id))
+  if created_key is not None:
+    add_edge = add_edge.sideEffect(__.constant('{}:{}'.format(from_person_id, to_person_id)).store(created_key))
+  if affected_key is not None:
+    add_edge = add_edge.sideEffect(__.bothV().union(__.identity(), __.both('knows')).values('_name').store(affected_key))
+  return (t.V(from_person_id).
+    coalesce(__.outE('knows').filter(__.inV().hasId(to_person_id)), add_edge).
+    property('weight', weight))
+
+
+def upsert_person_traversal(g, person, weight=1.0):
+  """Build a single traversal that upserts a person and the owner's 'knows' edge to the person."""
+  t = upsert_vertex_traversal(g, person)
+  _from_person_id = owner_person_id(person['owner'])
   _to_person_id = person['id']
   if _from_person_id != _to_person_id:
-    from_person_vertex = get_person(g, _from_person_id)
-    to_person_vertex = get_person(g, _to_person_id)
-    weight = 1.0
-    for _ in range(3):
-      try:
-        if g.V(from_person_vertex).outE('knows').filter(__.inV().is_(to_person_vertex)).toList():
-          print('[DEBUG] Updating relationship: [{} -> {}]'.format(_from_person_id, _to_person_id), file=sys.stderr)
-          g.V(from_person_vertex).outE('knows').filter(__.inV().is_(to_person_vertex)).property('weight', weight).next()
-        else:
-          print('[DEBUG] Creating relationship: [{} -> {}]'.format(_from_person_id, _to_person_id), file=sys.stderr)
-          g.V(from_person_vertex).addE('knows').to(to_person_vertex).property('weight', weight).next()
-        break
-      except Exception as ex:
-        traceback.print_exc()
-        time.sleep(0.01)
+    t = upsert_edge_traversal(t, _from_person_id, _to_person_id, weight)
+  return t
+
+
+def upsert_person(g, person):
+  #XXX: one round trip per card instead of looking up the vertices, then writing each property
+  for retry_count in range(3):
+    try:
+      return upsert_person_traversal(g, person).toList()
+    except Exception as ex:
+      if retry_count == 2:
+        raise ex
+      traceback.print_exc()
+      time.sleep(0.01)
+
+
+def aggregate_persons(persons):
+  """Merge a batch of persons into unique vertices and 'knows' edges.
+
+  The last person with the same id wins, and duplicate owner->person edges collapse into one.
+  """
+  vertices = collections.OrderedDict()
+  edges = collections.OrderedDict()
+  for person in persons:
+    vertices[person['id']] = person
+    _from_person_id = owner_person_id(person['owner'])
+    if _from_person_id != person['id']:
+      edges[(_from_person_id, person['id'])] = 1.0
+  return vertices, edges
+
+
+def is_concurrent_modification(ex):
+  return 'ConcurrentModificationException' in str(ex)
+
+
+def submit_graph_writes(g, upserts, capture_keys=(), max_retry_count=GRAPH_WRITE_MAX_RETRY_COUNT):
+  """Run the anonymous upsert traversals as side effects of one traversal.
+
+  Returns the number of retries and, with capture_keys, a map of each key to the set of what the
+  upserts stored in that side effect, read in the same round trip.
+  """
+  for retry_count in range(max_retry_count + 1):
+    t = g.inject(0)
+    for upsert in upserts:
+      t = t.sideEffect(upsert)
+    if capture_keys:
+      t = t.cap(*capture_keys)
+    try:
+      results = t.toList()
+      if capture_keys:
+        #XXX: cap() of one key returns its collection, of several keys a map of them
+        captured = results[0] if results else {}
+        if len(capture_keys) == 1:
+          captured = {capture_keys[0]: captured or []}
+        return retry_count, {key: set(captured.get(key, [])) for key in capture_keys}
+      return retry_count, set()
+    except Exception as ex:
+      #XXX: Neptune rejects writes that race on the same vertex or edge; those are safe to retry
+      if retry_count == max_retry_count or not is_concurrent_modification(ex):
+        raise ex
+      delay = random.uniform(0, min(GRAPH_WRITE_RETRY_MAX_DELAY, GRAPH_WRITE_RETRY_BASE_DELAY * (2 ** retry_count)))
+      print('[WARNING] concurrent modification, retrying {} upserts in {:.3f}s'.format(len(upserts), delay), file=sys.stderr)
+      time.sleep(delay)
+
+
+def upsert_persons(g, persons, chunk_size=GRAPH_WRITE_CHUNK_SIZE, cache=None):
+  """Upsert a whole batch of persons with a few chunked traversals instead of one per record.
+
+  Every vertex is written through the fold/coalesce, so a property update is never lost to what
+  another container has cached. With a cache, known edges are skipped instead, and the reads that
+  tell whether a cached vertex is still there ride along with the writes: the coalesce reports
+  the vertices it had to create, and the owners of skipped edges that are not in the batch are
+  looked up in the first request. A cached vertex that turns out to be gone (ex: deleted by
+  clear_graph()) is forgotten with its edges, which are then written again.
+
+  Returns the stats, the ids of the persons whose vertex or incoming edge could not be written,
+  the (from_person_id, to_person_id) of the 'knows' edges that did not exist before, and the
+  _name of the users whose people-you-may-know those edges change.
+  """
+  vertices, edges = aggregate_persons(persons)
+  stats = collections.OrderedDict([('vertices', len(vertices)), ('edges', len(edges)),
+    ('requests', 0), ('retries', 0), ('skipped', 0), ('stale', 0), ('created_edges', 0)])
+  failed_person_ids = set()
+  created_edges = []
+  affected_names = set()
+
+  def _submit(chunk, capture_keys=()):
+    stats['requests'] += 1
+    try:
+      retry_count, captured = submit_graph_writes(g, [upsert for _, upsert in chunk], capture_keys)
+      stats['retries'] += retry_count
+      return captured
+    except Exception as ex:
+      failed_person_ids.update([person_id for person_id, _ in chunk if person_id is not None])
+      traceback.print_exc()
+      return None
+
+  #XXX: a cached edge is only as good as its owner vertex, which may not be in this batch
+  owner_ids = []
+  if cache is not None:
+    owner_ids = sorted(set([from_id for (from_id, to_id), weight in edges.items()
+      if cache.has(('e', from_id, to_id)) and from_id not in vertices]))
+
+  person_list = list(vertices.values())
+  vertex_chunks = [person_list[i:i + chunk_size] for i in range(0, len(person_list), chunk_size)] or ([[]] if owner_ids else [])
+
+  #XXX: every vertex chunk runs before the edge chunks, so edges only point at existing vertices
+  for i, chunk in enumerate(vertex_chunks):
+    if cache is None:
+      _submit([(person['id'], upsert_vertex_traversal(__, person)) for person in chunk])
+      continue
+
+    #XXX: the owners are looked up before the writes, in the same request
+    lookups = [(None, __.V(*owner_ids).id().store('existing'))] if i == 0 and owner_ids else []
+    captured = _submit(lookups + [(person['id'], upsert_vertex_traversal(__, person, 'created')) for person in chunk],
+      capture_keys=('created', 'existing') if lookups else ('created',))
+    if captured is None:
+      continue
+
+    stale_ids = set([person['id'] for person in chunk if person['id'] in captured['created'] and cache.has(('v', person['id']))])
+    if lookups:
+      stale_ids.update(set(owner_ids) - captured['existing'])
+    stats['stale'] += len(stale_ids)
+    for person_id in stale_ids:
+      cache.invalidate_vertex(person_id)
+    for person in chunk:
+      cache.put(('v', person['id']), True)
+
+  edge_upserts = []
+  for (from_id, to_id), weight in edges.items():
+    #XXX: addE().to() fails on a missing vertex, and would take the whole chunk down with it
+    if to_id in failed_person_ids or from_id in failed_person_ids:
+      continue
+    if cache is not None and cache.get(('e', from_id, to_id)) == weight:
+      stats['skipped'] += 1
+      continue
+    edge_upserts.append((from_id, to_id, weight))
+
+  for i in range(0, len(edge_upserts), chunk_size):
+    chunk = edge_upserts[i:i + chunk_size]
+    captured = _submit([(to_id, upsert_edge_traversal(__, from_id, to_id, weight, 'created', 'affected'))
+      for from_id, to_id, weight in chunk], capture_keys=('created', 'affected'))
+    if captured is None:
+      #XXX: whatever made the chunk fail, the next batch writes its vertices through the coalesce path
+      if cache is not None:
+        for from_id, to_id, _ in chunk:
+          cache.invalidate_vertex(from_id)
+          cache.invalidate_vertex(to_id)
+      continue
+    for from_id, to_id, _ in chunk:
+      if '{}:{}'.format(from_id, to_id) in captured['created']:
+        created_edges.append((from_id, to_id))
+    affected_names.update(captured['affected'])
+    stats['created_edges'] = len(created_edges)
+
+    if cache is not None:
+      for from_id, to_id, weight in chunk:
+        #XXX: the edge is only written if the owner is in the graph, so only cache it when that is known
+        if cache.has(('v', from_id)) and to_id not in failed_person_ids:
+          cache.put(('e', from_id, to_id), weight)
+  return stats, failed_person_ids, created_edges, affected_names
+
+
+def person_profile(person):
+  #XXX: the same shape as valueMap() in RecommendBizcard.people_you_may_know()
+  return {k: [person[k]] for k in PERSON_PROPERTIES if k != 'id'}
+
+
+def publish_edge_deltas(redis_client, created_edges, persons):
+  """Push the new 'knows' edges, with the profiles of the persons in this batch, for UpdatePymkScores.
+
+  PYMK freshness is best effort, so a failure is logged and the cards are not retried for it.
+  """
+  vertices = {person['id']: person for person in persons}
+  deltas = []
+  for from_id, to_id in created_edges:
+    profiles = {person_id: person_profile(vertices[person_id]) for person_id in (from_id, to_id) if person_id in vertices}
+    deltas.append(json.dumps({'from': from_id, 'to': to_id, 'profiles': profiles}))
+  try:
+    redis_client.lpush(PYMK_EDGE_DELTAS_KEY, *deltas)
+    return len(deltas)
+  except Exception as ex:
+    print('[WARNING] failed to publish {} edge deltas: {}'.format(len(deltas), ex), file=sys.stderr)
+    return 0
+
+
+def bump_pymk_versions(redis_client, affected_names):
+  """Give each affected user a new PYMK version, so that their cached responses are recomputed.
+
+  The version is a random stamp rather than a counter, so a version that expired and came back
+  can never match one recorded in an old entry. Best effort, like publish_edge_deltas().
+  """
+  try:
+    pipe = redis_client.pipeline(transaction=False)
+    for name in affected_names:
+      #XXX: the same query hash as neptune_recommend_bizcard.lambda_handler()
+      query_hash_code = hashlib.md5(name.encode('utf-8')).hexdigest()[:8]
+      pipe.set(PYMK_VERSION_KEY.format(query_hash_code), uuid.uuid4().hex, ex=CACHE_VERSION_TTL)
+    pipe.execute()
+    return len(affected_names)
+  except Exception as ex:
+    print('[WARNING] failed to bump {} PYMK versions: {}'.format(len(affected_names), ex), file=sys.stderr)
+    return 0
 
 
 def _print_all_vertices(g):
@@ -121,16 +535,14 @@ def _print_all_vertices(g):
 
 # pylint: disable=unused-argument
 def lambda_handler(event, context):
-  import collections
-
   counter = collections.OrderedDict([('reads', 0),
       ('writes', 0),
       ('invalid', 0),
       ('errors', 0)])
 
-  neptune_endpoint, neptune_port = (NEPTUNE_ENDPOINT, NEPTUNE_PORT)
-  graph_db = graph_traversal(neptune_endpoint, neptune_port)
+  graph_db = get_graph_traversal()
 
+  persons = []
   for record in event['Records']:
     try:
       counter['reads'] += 1
@@ -152,13 +564,28 @@ def lambda_handler(event, context):
         "owner": json_data['owner']
       }
       #print(json.dumps(person, indent=2))
-      upsert_person(graph_db, person)
-
-      counter['writes'] += 1
+      persons.append(person)
     except Exception as _:
       counter['errors'] += 1
       traceback.print_exc()
 
+  if persons:
+    stats, failed_person_ids, created_edges, affected_names = upsert_persons(graph_db, persons, cache=KNOWN_GRAPH_CACHE)
+    failed_count = sum([1 for person in persons if person['id'] in failed_person_ids])
+    counter['writes'] = len(persons) - failed_count
+    counter['errors'] += failed_count
+    if failed_count:
+      NEPTUNE_CONN.mark_stale()
+    counter.update(stats)
+    redis_client = get_redis_client()
+    if created_edges and redis_client is not None:
+      counter['published_deltas'] = publish_edge_deltas(redis_client, created_edges, persons)
+    if affected_names and redis_client is not None:
+      counter['bumped_versions'] = bump_pymk_versions(redis_client, affected_names)
+  print('[INFO]', ', '.join(['{}={}'.format(k, v) for k, v in counter.items()]), file=sys.stderr)
+  if KNOWN_GRAPH_CACHE is not None:
+    print('[INFO] graph cache: size={},'.format(len(KNOWN_GRAPH_CACHE.entries)),
+      ', '.join(['{}={}'.format(k, v) for k, v in KNOWN_GRAPH_CACHE.stats.items()]), file=sys.stderr)
 
 if __name__ == '__main__':
   # pylint: disable=invalid-name
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""In-memory stand-in for the DynamoDB client calls the functions in this repository make on the image table.
+
+  ddb_client = DynamoDB()
+
+Only the condition and update expressions the functions write are understood: OR-ed terms of
+attribute_not_exists(a), a = :v, a <> :v, a < :v and a <= :v, and SET a = :v, ... updates.
+Like DynamoDB, a failed condition raises a ClientError with ConditionalCheckFailedException, and
+a transaction with a failed condition is cancelled as a whole.
+"""
+
+import copy
+import re
+
+from botocore.exceptions import ClientError
+
+
+class ConditionalCheckFailedException(ClientError):
+  def __init__(self, operation_name):
+    super().__init__({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'The conditional request failed'}},
+      operation_name)
+
+
+class Exceptions:
+  ConditionalCheckFailedException = ConditionalCheckFailedException
+
+
+CONDITION_TERM_RE = re.compile(r'^attribute_not_exists\((?P<attr>[#\w]+)\)$|^(?P<lhs>[#\w]+) (?P<op>=|<>|<=|<) (?P<rhs>:\w+)$')
+
+
+def _value(typed_value):
+  type_name, value = list(typed_value.items())[0]
+  return float(value) if type_name == 'N' else value
+
+
+class DynamoDB:
+  exceptions = Exceptions
+
+  def __init__(self):
+    self.items = {}
+    self.calls = []
+
+  def item(self, image_id):
+    """The item as plain values, or None."""
+    item = self.items.get(image_id)
+    return {k: list(v.values())[0] for k, v in item.items()} if item is not None else None
+
+  def _check(self, item, condition, names, values):
+    if not condition:
+      return True
+    for term in condition.split(' OR '):
+      m = CONDITION_TERM_RE.match(term.strip())
+      if m is None:
+        raise ValueError('unsupported condition: {}'.format(term))
+      if m.group('attr'):
+        if names.get(m.group('attr'), m.group('attr')) not in item:
+          return True
+        continue
+      attr = names.get(m.group('lhs'), m.group('lhs'))
+      if attr not in item:
+        continue
+      lhs, rhs = _value(item[attr]), _value(values[m.group('rhs')])
+      if {'=': lhs == rhs, '<>': lhs != rhs, '<': lhs < rhs, '<=': lhs <= rhs}[m.group('op')]:
+        return True
+    return False
+
+  def _update(self, params):
+    key = params['Key']['image_id']['S']
+    item = copy.deepcopy(self.items.get(key, {'image_id': params['Key']['image_id']}))
+    names, values = (params.get('ExpressionAttributeNames', {}), params.get('ExpressionAttributeValues', {}))
+    if not self._check(item, params.get('ConditionExpression'), names, values):
+      return None
+    assert params['UpdateExpression'].startswith('SET ')
+    for assignment in params['UpdateExpression'][len('SET '):].split(', '):
+      attr, value = [e.strip() for e in assignment.split('=')]
+      item[names.get(attr, attr)] = values[value]
+    return key, item
+
+  def put_item(self, TableName, Item, ConditionExpression=None, **kwargs):
+    self.calls.append('put_item')
+    key = Item['image_id']['S']
+    if not self._check(self.items.get(key, {}), ConditionExpression, {}, {}):
+      raise ConditionalCheckFailedException('PutItem')
+    self.items[key] = copy.deepcopy(Item)
+    return {}
+
+  def get_item(self, TableName, Key, **kwargs):
+    self.calls.append('get_item')
+    item = self.items.get(Key['image_id']['S'])
+    return {'Item': copy.deepcopy(item)} if item is not None else {}
+
+  def delete_item(self, TableName, Key, ConditionExpression=None, ExpressionAttributeValues=None, **kwargs):
+    self.calls.append('delete_item')
+    key = Key['image_id']['S']
+    if not self._check(self.items.get(key, {}), ConditionExpression, {}, ExpressionAttributeValues or {}):
+      raise ConditionalCheckFailedException('DeleteItem')
+    self.items.pop(key, None)
+    return {}
+
+  def update_item(self, **params):
+    self.calls.append('update_item')
+    updated = self._update(params)
+    if updated is None:
+      raise ConditionalCheckFailedException('UpdateItem')
+    self.items[updated[0]] = updated[1]
+    return {}
+
+  def transact_write_items(self, TransactItems):
+    self.calls.append('transact_write_items')
+    updates = [self._update(e['Update']) for e in TransactItems]
+    if any([e is None for e in updates]):
+      raise ClientError({'Error': {'Code': 'TransactionCanceledException', 'Message': 'Transaction cancelled'},
+        'CancellationReasons': [{'Code': 'ConditionalCheckFailed' if e is None else 'None'} for e in updates]},
+        'TransactWriteItems')
+    for key, item in updates:
+      self.items[key] = item
+    return {}
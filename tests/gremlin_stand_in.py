@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""In-memory stand-in for a TinkerGraph behind Gremlin Server, to test the Lambda traversals locally.
+
+It evaluates the bytecode that gremlinpython sends, for the steps the functions in this repository
+use, instead of sending it over a websocket:
+
+  graph = Graph()
+  g = traversal().withRemote(LocalConnection(graph))
+
+Like Neptune, a request that fails leaves the graph as it was, addE().to() fails when the target
+vertex is missing, and adding a vertex with an id that exists fails with a
+ConcurrentModificationException. Set graph.fail_next to make the next requests fail that way.
+"""
+
+import copy
+import itertools
+import threading
+
+from gremlin_python.driver.remote_connection import RemoteConnection, RemoteTraversal
+from gremlin_python.process.graph_traversal import GraphTraversal
+from gremlin_python.process.traversal import Traverser, Bytecode, P, TextP, Cardinality, T, Column, Order, Scope
+
+
+class Vertex:
+  def __init__(self, id, label):
+    self.id, self.label, self.props = (id, label, {})
+    self.pending = True
+
+  def __repr__(self):
+    return 'v[{}]'.format(self.id)
+
+
+class Edge:
+  def __init__(self, id, label, out_v, in_v):
+    self.id, self.label, self.outV, self.inV, self.props = (id, label, out_v, in_v, {})
+
+  def __repr__(self):
+    return 'e[{}][{}-{}->{}]'.format(self.id, self.outV.id, self.label, self.inV.id)
+
+
+class ConcurrentModification(Exception):
+  pass
+
+
+class Graph:
+  def __init__(self):
+    self.V = {}
+    self.E = {}
+    self.eid = itertools.count(1)
+    self.requests = 0
+    self.fail_next = 0
+
+  def state(self):
+    """Vertices with their properties and (out, in, weight) of the edges, to compare two graphs."""
+    vertices = {v.id: {k: tuple(vals) for k, vals in v.props.items()} for v in self.V.values()}
+    edges = sorted([(e.outV.id, e.inV.id, e.props.get('weight')) for e in self.E.values()])
+    return vertices, edges
+
+  def drop_vertex(self, vertex_id):
+    """Delete a vertex and its edges behind the back of the writers, ex: like clear_graph()."""
+    v = self.V.pop(vertex_id)
+    for k in [k for k, e in self.E.items() if e.inV is v or e.outV is v]:
+      self.E.pop(k)
+
+
+class Traversal:
+  def __init__(self, obj, labels=None):
+    self.obj, self.labels = (obj, dict(labels or {}))
+
+  def split(self, obj):
+    return Traversal(obj, self.labels)
+
+
+def _steps(t):
+  return (t.bytecode if isinstance(t, GraphTraversal) else t).step_instructions
+
+
+def _resolve(value, t, env):
+  if isinstance(value, (GraphTraversal, Bytecode)):
+    res = run(env, _steps(value), [t.split(t.obj)])
+    return res[0].obj if res else None
+  return value
+
+
+def _test(p, value):
+  op, expected = (p.operator, p.value)
+  if op == 'eq': return value == expected
+  if op == 'neq': return value != expected
+  if op == 'within': return value in (expected if isinstance(expected, (list, tuple, set)) else [expected] + list(p.other or []))
+  if op == 'without': return value not in expected
+  if op == 'startingWith': return isinstance(value, str) and value.startswith(expected)
+  if op == 'gt': return value > expected
+  if op == 'lt': return value < expected
+  raise NotImplementedError(op)
+
+
+def _value(o, k):
+  if k == T.id: return o.id
+  if k == T.label: return o.label
+  vals = o.props.get(k)
+  if isinstance(o, Vertex):
+    return vals[-1] if vals else None
+  return vals
+
+
+def _flatten(args):
+  ids = []
+  for a in args:
+    ids.extend(a if isinstance(a, (list, tuple)) else [a])
+  return ids
+
+
+def run(env, steps, trs):
+  g = env['graph']
+  side = env.setdefault('side', {})
+  steps = list(steps)
+  i = 0
+  while i < len(steps):
+    name, args = (steps[i][0], steps[i][1:])
+    i += 1
+    bys = []
+    while name in ('project', 'order') and i < len(steps) and steps[i][0] == 'by':
+      bys.append(steps[i][1:])
+      i += 1
+
+    if name == 'V':
+      ids = _flatten([_resolve(a, trs[0], env) if trs else a for a in args])
+      vertices = [g.V[k] for k in ids if k in g.V] if ids else list(g.V.values())
+      trs = [t.split(v) for t in (trs or [Traversal(None)]) for v in vertices]
+    elif name == 'E':
+      trs = [Traversal(e) for e in list(g.E.values())]
+    elif name == 'inject':
+      trs = [Traversal(a) for a in args]
+    elif name == 'fold':
+      trs = [Traversal([t.obj for t in trs], trs[0].labels if trs else {})]
+    elif name == 'unfold':
+      out = []
+      for t in trs:
+        o = [{k: v} for k, v in t.obj.items()] if isinstance(t.obj, dict) else t.obj
+        out.extend([t.split(x) for x in o] if isinstance(o, (list, tuple)) else [t])
+      trs = out
+    elif name == 'coalesce':
+      out = []
+      for t in trs:
+        for sub in args:
+          res = run(env, _steps(sub), [t.split(t.obj)])
+          if res:
+            out.extend(res)
+            break
+      trs = out
+    elif name == 'union':
+      trs = [r for t in trs for sub in args for r in run(env, _steps(sub), [t.split(t.obj)])]
+    elif name == 'choose':
+      cond, if_true, if_false = args
+      trs = [r for t in trs for r in run(env, _steps(if_true if run(env, _steps(cond), [t.split(t.obj)]) else if_false),
+        [t.split(t.obj)])]
+    elif name == 'optional':
+      out = []
+      for t in trs:
+        res = run(env, _steps(args[0]), [t.split(t.obj)])
+        out.extend(res or [t])
+      trs = out
+    elif name == 'sideEffect':
+      for t in trs:
+        run(env, _steps(args[0]), [t.split(t.obj)])
+    elif name == 'addV':
+      trs = [t.split(Vertex(None, args[0] if args else 'vertex')) for t in trs]
+    elif name == 'property':
+      args = list(args)
+      cardinality = args.pop(0) if isinstance(args[0], Cardinality) else None
+      for t in trs:
+        k, v = (_resolve(args[0], t, env), _resolve(args[1], t, env))
+        o = t.obj
+        if k == T.id:
+          o.id = v
+        elif isinstance(o, Vertex):
+          o.props[k] = [v] if cardinality == Cardinality.single else o.props.get(k, []) + [v]
+        else:
+          o.props[k] = v
+    elif name == 'as':
+      for t in trs:
+        t.labels.update({label: t.obj for label in args})
+    elif name == 'select':
+      if isinstance(args[0], str):
+        trs = [t.split(t.labels[args[0]] if args[0] in t.labels else (t.obj.get(args[0]) if isinstance(t.obj, dict) else None)) for t in trs]
+        trs = [t for t in trs if t.obj is not None]
+      else:
+        trs = [t.split(list(t.obj.keys() if args[0] == Column.keys else t.obj.values())[0]) for t in trs]
+    elif name == 'project':
+      trs = [t.split({k: _resolve(by[0], t, env) for k, by in zip(args, bys)}) for t in trs]
+    elif name == 'constant':
+      trs = [t.split(args[0]) for t in trs]
+    elif name == 'addE':
+      trs = [t.split(('addE', args[0], t.obj, None)) for t in trs]
+    elif name in ('to', 'from'):
+      for t in trs:
+        _, label, out_v, in_v = t.obj
+        target = t.labels.get(args[0]) if isinstance(args[0], str) else _resolve(args[0], t, env)
+        if target is None:
+          raise ValueError('The provided traverser does not map to a value: {}()'.format(name))
+        out_v, in_v = (out_v, target) if name == 'to' else (target, in_v)
+        t.obj = ('addE', label, out_v, in_v)
+        if out_v is not None and in_v is not None:
+          e = Edge(next(g.eid), label, out_v, in_v)
+          g.E[e.id] = e
+          t.obj = e
+    elif name in ('outE', 'inE', 'bothE'):
+      trs = [t.split(e) for t in trs for e in list(g.E.values()) if (not args or e.label in args) and
+        ((name != 'inE' and e.outV is t.obj) or (name != 'outE' and e.inV is t.obj))]
+    elif name == 'inV':
+      trs = [t.split(t.obj.inV) for t in trs]
+    elif name == 'outV':
+      trs = [t.split(t.obj.outV) for t in trs]
+    elif name == 'bothV':
+      trs = [t.split(v) for t in trs for v in (t.obj.outV, t.obj.inV)]
+    elif name in ('out', 'in', 'both'):
+      out = []
+      for t in trs:
+        for e in list(g.E.values()):
+          if args and e.label not in args:
+            continue
+          if name != 'in' and e.outV is t.obj: out.append(t.split(e.inV))
+          if name != 'out' and e.inV is t.obj: out.append(t.split(e.outV))
+      trs = out
+    elif name == 'hasId':
+      ids = _flatten(args)
+      if len(ids) == 1 and isinstance(ids[0], P):
+        trs = [t for t in trs if _test(ids[0], t.obj.id)]
+      else:
+        trs = [t for t in trs if t.obj.id in ids]
+    elif name == 'hasLabel':
+      trs = [t for t in trs if t.obj.label in args]
+    elif name == 'has':
+      if len(args) == 1:
+        trs = [t for t in trs if _value(t.obj, args[0]) is not None]
+      else:
+        k, v = args
+        trs = [t for t in trs if (_test(v, _value(t.obj, k)) if isinstance(v, (P, TextP)) else _value(t.obj, k) == v)]
+    elif name == 'filter':
+      trs = [t for t in trs if run(env, _steps(args[0]), [t.split(t.obj)])]
+    elif name == 'not':
+      trs = [t for t in trs if not run(env, _steps(args[0]), [t.split(t.obj)])]
+    elif name == 'is':
+      trs = [t for t in trs if (_test(args[0], t.obj) if isinstance(args[0], P) else t.obj == args[0])]
+    elif name == 'where':
+      p = args[0]
+      if p.operator == 'neq':
+        trs = [t for t in trs if t.obj is not t.labels.get(p.value)]
+      elif p.operator == 'without':
+        key = p.value[0] if isinstance(p.value, list) else p.value
+        trs = [t for t in trs if all([t.obj is not x for x in side.get(key, [])])]
+      else:
+        raise NotImplementedError(p.operator)
+    elif name == 'dedup':
+      seen, out = (set(), [])
+      for t in trs:
+        key = id(t.obj) if isinstance(t.obj, (Vertex, Edge)) else t.obj
+        if key not in seen:
+          seen.add(key)
+          out.append(t)
+      trs = out
+    elif name == 'limit':
+      if args[0] == Scope.local:
+        trs = [t.split(dict(list(t.obj.items())[:args[1]])) for t in trs]
+      else:
+        trs = trs[:args[-1]]
+    elif name == 'range' and args[0] == Scope.local:
+      trs = [t.split(dict(list(t.obj.items())[args[1]:args[2]])) for t in trs]
+    elif name == 'order' and args and args[0] == Scope.local:
+      assert [tuple(by) for by in bys] == [(Column.values, Order.decr)], bys
+      trs = [t.split(dict(sorted(t.obj.items(), key=lambda kv: -kv[1]))) for t in trs]
+    elif name == 'groupCount':
+      counts = {}
+      for t in trs:
+        counts[t.obj] = counts.get(t.obj, 0) + 1
+      trs = [Traversal(counts)]
+    elif name == 'id':
+      trs = [t.split(t.obj.id) for t in trs]
+    elif name == 'count':
+      trs = [t.split(len(t.obj)) for t in trs] if args and args[0] == Scope.local else [Traversal(len(trs))]
+    elif name == 'values':
+      out = []
+      for t in trs:
+        for k in args:
+          vals = t.obj.props.get(k) if isinstance(t.obj, Vertex) else ([t.obj.props[k]] if k in t.obj.props else [])
+          out.extend([t.split(v) for v in vals or []])
+      trs = out
+    elif name == 'valueMap':
+      trs = [t.split({k: list(v) for k, v in t.obj.props.items()}) for t in trs]
+    elif name == 'drop':
+      for t in trs:
+        if isinstance(t.obj, Edge):
+          g.E.pop(t.obj.id, None)
+        elif t.obj.id in g.V:
+          g.drop_vertex(t.obj.id)
+      trs = []
+    elif name in ('store', 'aggregate'):
+      side.setdefault(args[0], []).extend([t.obj for t in trs])
+    elif name == 'cap':
+      #XXX: cap() of one key returns its collection, of several keys a map of them
+      if len(args) == 1:
+        trs = [Traversal(list(side.get(args[0], [])))]
+      else:
+        trs = [Traversal({k: list(side.get(k, [])) for k in args})]
+    elif name == 'none':
+      trs = []
+    elif name in ('identity', 'barrier'):
+      pass
+    else:
+      raise NotImplementedError(name)
+
+    # a new vertex joins the graph as soon as it has its id
+    for t in trs:
+      o = t.obj
+      if isinstance(o, Vertex) and o.pending and o.id is not None:
+        if o.id in g.V:
+          raise ConcurrentModification('ConcurrentModificationException: vertex {} already exists'.format(o.id))
+        o.pending = False
+        g.V[o.id] = o
+  return trs
+
+
+class LocalConnection(RemoteConnection):
+  #XXX: requests run one at a time, like transactions that never interleave
+  lock = threading.Lock()
+
+  def __init__(self, graph):
+    super().__init__('local://', 'g')
+    self.graph = graph
+
+  def submit(self, bytecode):
+    with LocalConnection.lock:
+      self.graph.requests += 1
+      if self.graph.fail_next:
+        self.graph.fail_next -= 1
+        raise ConcurrentModification('ConcurrentModificationException: injected by graph.fail_next')
+
+      snapshot = copy.deepcopy((self.graph.V, self.graph.E))
+      try:
+        trs = run({'graph': self.graph}, _steps(bytecode), [])
+      except Exception:
+        self.graph.V, self.graph.E = snapshot
+        raise
+      return RemoteTraversal(iter([Traverser(t.obj, 1) for t in trs]), None)
+
+  def close(self):
+    pass
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Tests of how SearchBizcard caches the elasticsearch hits.
+
+  python -m pytest tests
+"""
+
+import sys
+import os
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_SRC_DIR = os.path.join(TESTS_DIR, '..', 'src', 'main', 'python')
+sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'CommonLib', 'python'))
+sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'SearchBizcard'))
+
+import query_cache
+import es_search_bizcard as search
+
+
+def make_hit(i):
+  return {'_index': 'octember_bizcard', '_type': 'bizcard', '_id': 'doc{:05d}'.format(i), '_score': 1.0 / (i + 1),
+    '_ignored': ['addr.keyword'], '_source': {'doc_id': 'doc{:05d}'.format(i), 'name': 'Edy Kim', 'company': 'aws',
+    'owner': 'edy', 'is_alive': 1, 'ocr_lines': ['aws', 'Edy Kim', 'Solutions Architect']}}
+
+
+def test_pack_hits_caches_only_what_the_response_returns():
+  hits = [make_hit(i) for i in range(5)]
+  packed = search.pack_hits(hits)
+  assert packed['hits']['fields'] == ['doc_id', 'name', 'company', 'is_alive', 'owner', '_id', '_score']
+
+  unpacked = search.unpack_hits(packed, 1, 3)
+  assert unpacked == [search.project_hit(hit) for hit in hits[1:3]]
+  assert unpacked[0]['_index'] == 'octember_bizcard' and unpacked[0]['_type'] == 'bizcard'
+  assert 'ocr_lines' not in unpacked[0]['_source'] and '_ignored' not in unpacked[0]
+
+  #XXX: what the cache stores for hits is what it reads back
+  payload, _ = query_cache.encode_entry({'refresh_at': 0, 'versions': [], 'value': packed})
+  assert search.unpack_hits(query_cache.decode_entry(payload)[0]['value'], 0, None) == [search.project_hit(hit) for hit in hits]
+
+
+def test_unpack_hits_reads_entries_cached_before_the_projection():
+  hits = [make_hit(i) for i in range(3)]
+  packed = {
+    'meta': query_cache.pack_records([{k: v for k, v in hit.items() if k != '_source'} for hit in hits]),
+    'sources': query_cache.pack_records([hit['_source'] for hit in hits])
+  }
+  assert search.unpack_hits(packed, 0, None) == [search.project_hit(hit) for hit in hits]
+  assert search.unpack_hits(search.pack_hits([]), 0, None) == []
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Tests of the GetTextFromS3Image record processing against in-memory DynamoDB and Textract stand-ins.
+
+  python -m pytest tests
+"""
+
+import sys
+import os
+import json
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_SRC_DIR = os.path.join(TESTS_DIR, '..', 'src', 'main', 'python')
+sys.path.insert(0, TESTS_DIR)
+sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'CommonLib', 'python'))
+sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'GetTextFromS3Image'))
+
+import pytest
+
+import dynamodb_stand_in
+import textract_stand_in
+import get_text_from_s3_image
+import process_status
+
+CARD_PAGES = [
+  ['aws', 'Edy Kim', 'Solutions Architect', 'edy@amazon.com', '(+82 10) 1234 5678'],
+  ['aws', 'Poby Kim', 'SA Manager', 'poby@amazon.com']
+]
+
+
+class FailingTextract(textract_stand_in.Textract):
+  def detect_document_text(self, **params):
+    raise RuntimeError('InvalidImageFormatException')
+
+
+class StandInKinesis:
+  def __init__(self):
+    self.records = []
+
+  def put_records(self, Records, StreamName):
+    self.records.extend([json.loads(e['Data'].decode('utf-8')) for e in Records])
+    return {'FailedRecordCount': 0, 'Records': [{'SequenceNumber': '1', 'ShardId': 'shardId-000000000000'} for _ in Records]}
+
+
+class StandInS3:
+  def __init__(self):
+    self.objects = {}
+
+  def put_object(self, Bucket, Key, Body, **kwargs):
+    self.objects[(Bucket, Key)] = Body
+
+  def copy(self, copy_source, bucket, key):
+    self.objects[(bucket, key)] = self.objects.get((copy_source['Bucket'], copy_source['Key']), b'')
+
+
+@pytest.fixture
+def async_textract(monkeypatch):
+  monkeypatch.setattr(get_text_from_s3_image, 'TEXTRACT_MODE', 'async')
+  monkeypatch.setattr(get_text_from_s3_image, 'TEXTRACT_RATE_LIMITER', get_text_from_s3_image.LocalTokenBucket(1000))
+
+
+def test_failed_image_is_marked_failed_and_releases_its_claim():
+  ddb_client = dynamodb_stand_in.DynamoDB()
+  item = {'s3_bucket': 'octember-use1', 's3_key': 'bizcard-raw-img/edy_bizcard.jpg', 'etag': '0123456789abcdef'}
+  assert process_status.claim_content_hash(ddb_client, get_text_from_s3_image.DDB_TABLE_NAME, item) is None
+
+  clients = (FailingTextract(), None, ddb_client, None)
+  status_tracker = process_status.StatusTracker(ddb_client, get_text_from_s3_image.DDB_TABLE_NAME)
+  assert get_text_from_s3_image.process_record(clients, status_tracker, item) is None
+  status_tracker.flush()
+
+  assert ddb_client.item('edy_bizcard.jpg')['status'] == 'FAILED'
+  assert ddb_client.item('etag:0123456789abcdef') is None
+
+
+def test_async_job_is_started_once_per_content_and_finished_by_the_completion_handler(monkeypatch, async_textract):
+  ddb_client = dynamodb_stand_in.DynamoDB()
+  item = {'s3_bucket': 'octember-use1', 's3_key': 'bizcard-raw-img/edy_bizcards.pdf', 'etag': '0123456789abcdef'}
+  textract_client = textract_stand_in.Textract(pages={(item['s3_bucket'], item['s3_key']): CARD_PAGES})
+  kinesis_client, s3_client = (StandInKinesis(), StandInS3())
+  clients = {'textract': textract_client, 'kinesis': kinesis_client, 'dynamodb': ddb_client, 's3': s3_client}
+  monkeypatch.setattr(get_text_from_s3_image, 'get_aws_client', lambda service_name: clients[service_name])
+
+  status_tracker = process_status.StatusTracker(ddb_client, get_text_from_s3_image.DDB_TABLE_NAME)
+  clients_tuple = (textract_client, kinesis_client, ddb_client, s3_client)
+  job_id = get_text_from_s3_image.process_record(clients_tuple, status_tracker, item)['textract_job_id']
+  status_tracker.flush()
+  assert ddb_client.item('edy_bizcards.pdf')['status'] == 'PROCESS'
+
+  #XXX: a redelivery gets the same job, new content under the same key a new one
+  assert get_text_from_s3_image.process_record(clients_tuple, status_tracker, item)['textract_job_id'] == job_id
+  new_content = dict(item, etag='fedcba9876543210')
+  assert get_text_from_s3_image.process_record(clients_tuple, status_tracker, new_content)['textract_job_id'] != job_id
+  status_tracker.flush()
+
+  get_text_from_s3_image.textract_job_completion_handler(textract_client.complete_job(job_id), {})
+  #XXX: 2 PAGE + 9 LINE blocks come back 3 at a time
+  assert textract_client.calls.count('get_document_text_detection') == 4
+  assert [(e['page'], e['data']['name']) for e in kinesis_client.records] == [(1, 'Edy Kim'), (2, 'Poby Kim')]
+  assert kinesis_client.records[0]['data']['email'] == 'edy@amazon.com'
+  assert ddb_client.item('edy_bizcards.pdf')['status'] == 'END'
+  assert ('octember-use1', 'bizcard-by-user/edy/edy_bizcards.pdf') in s3_client.objects
+
+
+def test_failed_async_job_releases_its_claim(monkeypatch, async_textract):
+  ddb_client = dynamodb_stand_in.DynamoDB()
+  item = {'s3_bucket': 'octember-use1', 's3_key': 'bizcard-raw-img/edy_bizcards.pdf', 'etag': '0123456789abcdef'}
+  assert process_status.claim_content_hash(ddb_client, get_text_from_s3_image.DDB_TABLE_NAME, item) is None
+  textract_client = textract_stand_in.Textract(pages={(item['s3_bucket'], item['s3_key']): CARD_PAGES})
+  clients = {'textract': textract_client, 'kinesis': StandInKinesis(), 'dynamodb': ddb_client, 's3': StandInS3()}
+  monkeypatch.setattr(get_text_from_s3_image, 'get_aws_client', lambda service_name: clients[service_name])
+
+  status_tracker = process_status.StatusTracker(ddb_client, get_text_from_s3_image.DDB_TABLE_NAME)
+  clients_tuple = (textract_client, clients['kinesis'], ddb_client, clients['s3'])
+  job_id = get_text_from_s3_image.process_record(clients_tuple, status_tracker, item)['textract_job_id']
+  status_tracker.flush()
+
+  get_text_from_s3_image.textract_job_completion_handler(textract_client.complete_job(job_id, 'FAILED'), {})
+  assert ddb_client.item('edy_bizcards.pdf')['status'] == 'FAILED'
+  assert ddb_client.item('etag:0123456789abcdef') is None
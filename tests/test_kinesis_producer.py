@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Tests of the shared Kinesis producer and of the text records GetTextFromS3Image puts with it.
+
+  python -m pytest tests
+"""
+
+import sys
+import os
+import json
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_SRC_DIR = os.path.join(TESTS_DIR, '..', 'src', 'main', 'python')
+sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'CommonLib', 'python'))
+sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'GetTextFromS3Image'))
+
+import pytest
+
+import kinesis_producer
+import get_text_from_s3_image
+
+
+class StandInKinesis:
+  """Throttles the first put of every record whose s3_key is in throttled, or every put if always."""
+
+  def __init__(self, throttled=(), always=False):
+    self.throttled = set(throttled)
+    self.always = always
+    self.calls = []
+    self.records = []
+
+  def put_records(self, Records, StreamName):
+    self.calls.append(len(Records))
+    results = []
+    for rec in Records:
+      s3_key = json.loads(rec['Data'].decode('utf-8'))['s3_key']
+      if self.always or s3_key in self.throttled:
+        self.throttled.discard(s3_key)
+        results.append({'ErrorCode': 'ProvisionedThroughputExceededException', 'ErrorMessage': 'Rate exceeded'})
+      else:
+        self.records.append(rec)
+        results.append({'SequenceNumber': str(len(self.records)), 'ShardId': 'shardId-000000000000'})
+    return {'FailedRecordCount': sum([1 for e in results if 'ErrorCode' in e]), 'Records': results}
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+  monkeypatch.setattr(kinesis_producer, '_backoff_delay', lambda attempt: 0)
+
+
+def make_records(count):
+  return [{'s3_bucket': 'octember-use1', 's3_key': 'bizcard-raw-img/edy_bizcard_{:04d}.jpg'.format(i)} for i in range(count)]
+
+
+def test_split_into_batches_respects_the_request_limits():
+  records = [{'Data': b'x' * 1000, 'PartitionKey': 'k'} for _ in range(1200)]
+  assert [len(e) for e in kinesis_producer.split_into_batches(records)] == [500, 500, 200]
+  assert [len(e) for e in kinesis_producer.split_into_batches(records, max_bytes=100 * 1001)] == [100] * 12
+
+
+def test_write_records_to_kinesis_retries_only_the_failed_records():
+  records = make_records(10)
+  kinesis_client = StandInKinesis(throttled=[records[2]['s3_key'], records[7]['s3_key']])
+  failed_records = kinesis_producer.write_records_to_kinesis(kinesis_client, 'octember-bizcard-txt', records, 'owner')
+
+  assert failed_records == []
+  assert kinesis_client.calls == [10, 2]
+  assert sorted([json.loads(e['Data'].decode('utf-8'))['s3_key'] for e in kinesis_client.records]) == \
+    sorted([e['s3_key'] for e in records])
+
+
+def test_write_records_to_kinesis_returns_what_it_could_not_put():
+  records = make_records(3)
+  kinesis_client = StandInKinesis(always=True)
+  failed_records = kinesis_producer.write_records_to_kinesis(kinesis_client, 'octember-bizcard-txt', records)
+  assert failed_records == records
+  assert len(kinesis_client.calls) == kinesis_producer.KINESIS_MAX_RETRY_COUNT
+
+
+def test_publish_bizcard_docs_does_not_end_a_card_that_was_not_put():
+  class StatusTracker:
+    def __init__(self):
+      self.items = []
+
+    def transition(self, item):
+      self.items.append(item)
+
+  class S3:
+    def copy(self, copy_source, bucket, key):
+      pass
+
+  status_tracker = StatusTracker()
+  clients = (None, StandInKinesis(always=True), None, S3())
+  params = {'s3_bucket': 'octember-use1', 's3_key': 'bizcard-raw-img/edy_bizcard_0001.jpg', 'owner': 'edy'}
+  with pytest.raises(RuntimeError):
+    get_text_from_s3_image.publish_bizcard_docs(clients, status_tracker, params, [{'name': 'Edy Kim'}])
+  assert status_tracker.items == []
+
+  clients = (None, StandInKinesis(throttled=[params['s3_key']]), None, S3())
+  get_text_from_s3_image.publish_bizcard_docs(clients, status_tracker, params, [{'name': 'Edy Kim'}])
+  assert [e['status'] for e in status_tracker.items] == ['END']
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Tests of the status transitions the OCR pipeline writes, against the in-memory DynamoDB stand-in.
+
+  python -m pytest tests
+"""
+
+import sys
+import os
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_SRC_DIR = os.path.join(TESTS_DIR, '..', 'src', 'main', 'python')
+sys.path.insert(0, TESTS_DIR)
+sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'CommonLib', 'python'))
+
+import dynamodb_stand_in
+import process_status
+
+S3_KEY = 'bizcard-raw-img/edy_bizcard.jpg'
+
+
+def write(ddb_client, *items):
+  status_tracker = process_status.StatusTracker(ddb_client, 'OctemberBizcardImg')
+  for item in items:
+    status_tracker.transition(dict(item, s3_bucket='octember-use1', s3_key=S3_KEY))
+  status_tracker.flush()
+  return status_tracker.stats
+
+
+def test_late_start_does_not_overwrite_a_later_status():
+  ddb_client = dynamodb_stand_in.DynamoDB()
+  write(ddb_client, {'status': 'PROCESS'}, {'status': 'END', 'bizcard_data': '{}'})
+  stats = write(ddb_client, {'status': 'START', 'etag': 'a1'})
+  assert stats['stale'] == 1
+  assert ddb_client.item('edy_bizcard.jpg')['status'] == 'END'
+
+  #XXX: a late PROCESS is dropped the same way
+  write(ddb_client, {'status': 'PROCESS'})
+  assert ddb_client.item('edy_bizcard.jpg')['status'] == 'END'
+
+
+def test_start_begins_a_run_for_failed_images_and_new_content():
+  ddb_client = dynamodb_stand_in.DynamoDB()
+  write(ddb_client, {'status': 'START', 'etag': 'a1'})
+  write(ddb_client, {'status': 'START', 'etag': 'a1'}, {'status': 'FAILED'})
+  write(ddb_client, {'status': 'START', 'etag': 'a1'})
+  assert ddb_client.item('edy_bizcard.jpg')['status'] == 'START'
+
+  write(ddb_client, {'status': 'END'})
+  write(ddb_client, {'status': 'START', 'etag': 'b2'})
+  assert ddb_client.item('edy_bizcard.jpg')['status'] == 'START'
+  assert ddb_client.item('edy_bizcard.jpg')['etag'] == 'b2'
+
+
+def test_failed_fallback_writes_are_logged(monkeypatch, capsys):
+  from botocore.exceptions import ClientError
+
+  class BrokenDynamoDB(dynamodb_stand_in.DynamoDB):
+    def transact_write_items(self, TransactItems):
+      raise ClientError({'Error': {'Code': 'InternalServerError', 'Message': 'Internal server error'}}, 'TransactWriteItems')
+
+    def update_item(self, **params):
+      raise RuntimeError('update_item is down')
+
+  monkeypatch.setattr(process_status, 'DDB_MAX_RETRY_COUNT', 1)
+  write(BrokenDynamoDB(), {'status': 'START', 'etag': 'a1'})
+  assert '[ERROR] failed to write status START of {}: update_item is down'.format(S3_KEY) in capsys.readouterr().err
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Tests of the shared query cache against fakeredis.
+
+  python -m pytest tests
+"""
+
+import sys
+import os
+import time
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_SRC_DIR = os.path.join(TESTS_DIR, '..', 'src', 'main', 'python')
+sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'CommonLib', 'python'))
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+import query_cache
+
+KEY = 'pymk:query:edy'
+VERSION_KEY = 'pymk:version:edy'
+
+
+def make_cache(redis_client):
+  return query_cache.QueryCache(redis_client, lock_wait=0.1, wait_interval=0.02)
+
+
+def fail():
+  raise RuntimeError('neptune is down')
+
+
+def test_expired_entry_is_served_stale_while_another_request_refreshes_it():
+  redis_client = fakeredis.FakeStrictRedis()
+  cache = make_cache(redis_client)
+  assert cache.get_or_compute(KEY, lambda: ['old'], version_keys=[VERSION_KEY]) == ['old']
+
+  cache.soft_ttl = -1
+  cache.store(KEY, ['old'], [None])
+  redis_client.set('{}:lock'.format(KEY), 'another request')
+  assert cache.get_or_compute(KEY, lambda: ['new'], version_keys=[VERSION_KEY]) == ['old']
+  assert cache.stats['stale'] == 1
+
+  #XXX: an expired entry is also the answer when refreshing it fails
+  redis_client.delete('{}:lock'.format(KEY))
+  assert cache.get_or_compute(KEY, fail, version_keys=[VERSION_KEY]) == ['old']
+
+
+def test_invalidated_entry_is_never_served():
+  redis_client = fakeredis.FakeStrictRedis()
+  cache = make_cache(redis_client)
+  cache.get_or_compute(KEY, lambda: ['old'], version_keys=[VERSION_KEY])
+  redis_client.set(VERSION_KEY, 'v2')
+
+  #XXX: without the lock, the request waits for the lock holder, then runs the query itself
+  redis_client.set('{}:lock'.format(KEY), 'another request')
+  started_at = time.time()
+  assert cache.get_or_compute(KEY, lambda: ['new'], version_keys=[VERSION_KEY]) == ['new']
+  assert time.time() - started_at >= cache.lock_wait
+  assert cache.stats['invalidated'] == 1 and cache.stats['stale'] == 0
+
+  redis_client.delete('{}:lock'.format(KEY))
+  with pytest.raises(RuntimeError):
+    cache.get_or_compute(KEY, fail, version_keys=[VERSION_KEY])
+  assert cache.get_or_compute(KEY, lambda: ['new'], version_keys=[VERSION_KEY]) == ['new']
+  assert cache.get_or_compute(KEY, fail, version_keys=[VERSION_KEY]) == ['new']
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Tests of the Textract rate limiters of GetTextFromS3Image: the Lua token bucket on fakeredis,
+and the local fallback it uses while Redis is down.
+
+  python -m pytest tests
+"""
+
+import sys
+import os
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_SRC_DIR = os.path.join(TESTS_DIR, '..', 'src', 'main', 'python')
+sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'CommonLib', 'python'))
+sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'GetTextFromS3Image'))
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+import get_text_from_s3_image
+from get_text_from_s3_image import LocalTokenBucket, RedisTokenBucket
+
+
+class CountingScript:
+  def __init__(self, script):
+    self.script = script
+    self.calls = 0
+
+  def __call__(self, **kwargs):
+    self.calls += 1
+    return self.script(**kwargs)
+
+
+def test_redis_token_bucket_waits_once_the_capacity_is_taken():
+  redis_client = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+  bucket = RedisTokenBucket(redis_client, 'ratelimit:textract', 1, capacity=2)
+  assert [bucket.try_acquire(), bucket.try_acquire()] == [0, 0]
+
+  wait_secs = bucket.try_acquire()
+  assert 0.9 < wait_secs <= 1.0
+  assert redis_client.pttl('ratelimit:textract') > 0
+
+  #XXX: move the last refill a second back instead of sleeping
+  ts = int(redis_client.hget('ratelimit:textract', 'ts'))
+  redis_client.hset('ratelimit:textract', 'ts', str(ts - 1000))
+  assert bucket.try_acquire() == 0
+  assert bucket.try_acquire() > 0
+
+
+def test_redis_token_buckets_with_the_same_key_share_the_tokens():
+  redis_client = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+  bucket = RedisTokenBucket(redis_client, 'ratelimit:textract', 1, capacity=3)
+  other_bucket = RedisTokenBucket(redis_client, 'ratelimit:textract', 1, capacity=3)
+  assert [bucket.try_acquire(2), other_bucket.try_acquire()] == [0, 0]
+  assert other_bucket.try_acquire() > 0 and bucket.try_acquire() > 0
+
+  assert RedisTokenBucket(redis_client, 'ratelimit:other', 1, capacity=3).try_acquire(3) == 0
+
+
+def test_redis_token_bucket_falls_back_while_redis_is_down(monkeypatch):
+  now = [1000.0]
+  monkeypatch.setattr(get_text_from_s3_image.time, 'time', lambda: now[0])
+
+  server = fakeredis.FakeServer()
+  fallback = LocalTokenBucket(1, capacity=2)
+  bucket = RedisTokenBucket(fakeredis.FakeStrictRedis(server=server), 'ratelimit:textract', 1, capacity=5,
+    fallback=fallback, retry_interval=30)
+  bucket.script = script = CountingScript(bucket.script)
+
+  server.connected = False
+  assert bucket.try_acquire() == 0
+  assert bucket.degraded and bucket.retry_at == now[0] + 30 and script.calls == 1
+
+  #XXX: no Redis call until retry_interval has passed, only the local bucket is used
+  assert bucket.try_acquire() == 0
+  assert bucket.try_acquire() > 0
+  assert script.calls == 1 and fallback.tokens < 1
+
+  now[0] += 30
+  assert bucket.try_acquire() > 0
+  assert script.calls == 2 and bucket.retry_at == now[0] + 30
+
+  server.connected = True
+  now[0] += 30
+  assert bucket.try_acquire() == 0
+  assert not bucket.degraded and script.calls == 3
+  assert bucket.try_acquire() == 0 and script.calls == 4
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Tests of the TriggerTextExtractFromS3Image handler against in-memory DynamoDB and Kinesis stand-ins.
+
+  python -m pytest tests
+"""
+
+import sys
+import os
+import json
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_SRC_DIR = os.path.join(TESTS_DIR, '..', 'src', 'main', 'python')
+sys.path.insert(0, TESTS_DIR)
+sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'CommonLib', 'python'))
+sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'TriggerTextExtractFromS3Image'))
+
+import pytest
+
+import dynamodb_stand_in
+import trigger_text_extract_from_s3_image as trigger
+
+
+class StandInKinesis:
+  def __init__(self):
+    self.records = []
+
+  def put_records(self, Records, StreamName):
+    self.records.extend([json.loads(e['Data'].decode('utf-8')) for e in Records])
+    return {'FailedRecordCount': 0, 'Records': [{'SequenceNumber': '1', 'ShardId': 'shardId-000000000000'} for _ in Records]}
+
+
+def s3_event(key, etag='0123456789abcdef0123456789abcdef'):
+  return {'Records': [{'s3': {'bucket': {'name': 'octember-use1'},
+    'object': {'key': key, 'eTag': etag, 'size': 1024}}}]}
+
+
+@pytest.fixture
+def clients(monkeypatch):
+  clients = {'dynamodb': dynamodb_stand_in.DynamoDB(), 'kinesis': StandInKinesis()}
+  monkeypatch.setattr(trigger, 'get_aws_client', lambda service_name: clients[service_name])
+  return clients
+
+
+def test_redelivery_is_skipped_only_once_the_image_has_ended(clients):
+  key = 'bizcard-raw-img/edy_bizcard.jpg'
+  trigger.lambda_handler(s3_event(key), {})
+  assert [e['s3_key'] for e in clients['kinesis'].records] == [key]
+  assert clients['kinesis'].records[0]['etag'] == '0123456789abcdef0123456789abcdef'
+  assert clients['dynamodb'].item('edy_bizcard.jpg')['status'] == 'START'
+
+  #XXX: a run that failed in GetTextFromS3Image keeps the claim, so the redelivery goes through again
+  clients['dynamodb'].items['edy_bizcard.jpg']['status'] = {'S': 'FAILED'}
+  trigger.lambda_handler(s3_event(key), {})
+  assert len(clients['kinesis'].records) == 2
+
+  clients['dynamodb'].items['edy_bizcard.jpg']['status'] = {'S': 'END'}
+  trigger.lambda_handler(s3_event(key), {})
+  assert len(clients['kinesis'].records) == 2
+
+
+def test_reupload_under_another_key_is_a_duplicate(clients):
+  trigger.lambda_handler(s3_event('bizcard-raw-img/edy_bizcard.jpg'), {})
+  trigger.lambda_handler(s3_event('bizcard-raw-img/poby_bizcard.jpg'), {})
+  assert clients['kinesis'].records[1]['duplicate_of'] == 'edy_bizcard.jpg'
+  assert clients['dynamodb'].item('poby_bizcard.jpg')['duplicate_of'] == 'edy_bizcard.jpg'
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Tests of the UpsertBizcardToGraphDB person upserts against the in-memory Gremlin stand-in.
+
+  python -m pytest tests
+"""
+
+import sys
+import os
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_SRC_DIR = os.path.join(TESTS_DIR, '..', 'src', 'main', 'python')
+sys.path.insert(0, TESTS_DIR)
+sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'CommonLib', 'python'))
+sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'UpsertBizcardToGraphDB'))
+
+from gremlin_python.process.anonymous_traversal import traversal
+
+import gremlin_stand_in
+import upsert_bizcard_to_graph_db as graph_writer
+
+
+def make_person(name, owner, job_title='Solutions Architect'):
+  user = name.split()[0].lower()
+  return {
+    'id': graph_writer.owner_person_id(user),
+    'name': name,
+    'email': '{}@amazon.com'.format(user),
+    'phone_number': '(+82 10) 1234 5678',
+    'company': 'aws',
+    'job_title': job_title,
+    'owner': owner
+  }
+
+
+def make_graph():
+  graph = gremlin_stand_in.Graph()
+  return graph, traversal().withRemote(gremlin_stand_in.LocalConnection(graph))
+
+
+PERSONS = [
+  make_person('Edy Kim', 'edy'),
+  make_person('Poby Kim', 'edy'),
+  make_person('Crong Lee', 'edy'),
+  make_person('Poby Kim', 'poby'),
+  make_person('Pororo Kim', 'poby', 'SA Manager'),
+  make_person('Crong Lee', 'pororo')
+]
+
+
+def test_upsert_person_is_one_round_trip():
+  graph, g = make_graph()
+  for person in PERSONS:
+    graph_writer.upsert_person(g, person)
+
+  assert graph.requests == len(PERSONS)
+  vertices, edges = graph.state()
+  assert set(vertices) == set([person['id'] for person in PERSONS])
+  assert vertices[graph_writer.owner_person_id('pororo')]['_name'] == ('pororo kim',)
+  assert (graph_writer.owner_person_id('pororo'), graph_writer.owner_person_id('crong'), 1.0) in edges
+
+  #XXX: the owner edge is only written once the owner is in the graph
+  graph_writer.upsert_person(g, make_person('Harry Jang', 'rody'))
+  assert graph.state()[1] == edges
+
+
+def test_upsert_person_replay_is_idempotent():
+  graph, g = make_graph()
+  for person in PERSONS + PERSONS:
+    graph_writer.upsert_person(g, person)
+  replayed = graph.state()
+
+  graph, g = make_graph()
+  for person in PERSONS:
+    graph_writer.upsert_person(g, person)
+  graph_writer.upsert_person(g, PERSONS[-1])
+  assert replayed == graph.state()
+
+
+def test_upsert_person_overwrites_single_properties():
+  graph, g = make_graph()
+  graph_writer.upsert_person(g, make_person('Pororo Kim', 'pororo', 'SA Manager'))
+  graph_writer.upsert_person(g, make_person('Pororo Kim', 'pororo', 'Principal SA'))
+
+  vertices, _ = graph.state()
+  assert vertices[graph_writer.owner_person_id('pororo')]['job_title'] == ('Principal SA',)
+  assert all([len(vals) == 1 for props in vertices.values() for vals in props.values()])
+
+
+def test_upsert_persons_matches_upsert_person():
+  graph, g = make_graph()
+  for person in PERSONS + PERSONS:
+    graph_writer.upsert_person(g, person)
+
+  batch_graph, batch_g = make_graph()
+  stats, failed_person_ids, created_edges, affected_names = graph_writer.upsert_persons(batch_g, PERSONS, chunk_size=2)
+  assert not failed_person_ids
+  assert batch_graph.state() == graph.state()
+  assert len(created_edges) == stats['created_edges'] == len(graph.state()[1])
+  assert 'pororo kim' in affected_names
+
+  #XXX: a replay creates no edges, so it affects nobody's people-you-may-know
+  stats, failed_person_ids, created_edges, affected_names = graph_writer.upsert_persons(batch_g, PERSONS, chunk_size=2)
+  assert batch_graph.state() == graph.state()
+  assert not created_edges and not affected_names
+
+
+def test_upsert_persons_retries_concurrent_modifications():
+  graph, g = make_graph()
+  graph.fail_next = 2
+  stats, failed_person_ids, _, _ = graph_writer.upsert_persons(g, PERSONS)
+  assert stats['retries'] == 2 and not failed_person_ids
+
+  expected, expected_g = make_graph()
+  graph_writer.upsert_persons(expected_g, PERSONS)
+  assert graph.state() == expected.state()
+
+
+def test_upsert_persons_skips_edges_to_failed_vertices():
+  graph, g = make_graph()
+  owner = make_person('Edy Kim', 'edy')
+  persons = [owner] + [make_person('Person{} Kim'.format(i), 'edy') for i in range(6)]
+  failed = persons[4]['id']
+
+  upsert_vertex_traversal = graph_writer.upsert_vertex_traversal
+  try:
+    #XXX: a step the stand-in does not know fails the request of that vertex chunk
+    graph_writer.upsert_vertex_traversal = lambda t, person: (upsert_vertex_traversal(t, person).timeLimit(1)
+      if person['id'] == failed else upsert_vertex_traversal(t, person))
+    stats, failed_person_ids, created_edges, _ = graph_writer.upsert_persons(g, persons, chunk_size=3)
+  finally:
+    graph_writer.upsert_vertex_traversal = upsert_vertex_traversal
+
+  chunk_ids = set([person['id'] for person in persons[3:6]])
+  assert failed_person_ids == chunk_ids
+  written = [person['id'] for person in persons[1:] if person['id'] not in chunk_ids]
+  assert sorted([to_id for _, to_id in created_edges]) == sorted(written)
+  assert len(graph.E) == len(written)
+
+
+def test_upsert_persons_with_cache_recreates_deleted_vertices():
+  graph, g = make_graph()
+  expected, expected_g = make_graph()
+  cache = graph_writer.KnownGraphCache()
+  graph_writer.upsert_persons(g, PERSONS, cache=cache)
+
+  #XXX: an unchanged batch skips its known edges, and still writes its vertices in one request
+  requests = graph.requests
+  stats, _, _, _ = graph_writer.upsert_persons(g, PERSONS, cache=cache)
+  assert graph.requests - requests == 1
+  assert stats['skipped'] == stats['edges'] and stats['stale'] == 0
+
+  #XXX: vertices deleted behind the back of the cache, ex: by clear_graph(), come back on the next batch
+  for person_id in (graph_writer.owner_person_id('edy'), graph_writer.owner_person_id('pororo')):
+    graph.drop_vertex(person_id)
+  stats, failed_person_ids, _, _ = graph_writer.upsert_persons(g, PERSONS, cache=cache)
+  assert stats['stale'] == 2 and not failed_person_ids
+
+  graph_writer.upsert_persons(expected_g, PERSONS)
+  assert graph.state() == expected.state()
+
+
+def test_known_graph_cache_has_ignores_expired_entries():
+  cache = graph_writer.KnownGraphCache(ttl=-1)
+  cache.put(('v', 'edy'), 'digest')
+  assert not cache.has(('v', 'edy'))
+  assert graph_writer.KnownGraphCache().has(('v', 'edy')) is False
+
+
+def test_upsert_persons_with_cache_overwrites_what_another_container_wrote():
+  graph, g = make_graph()
+  cache = graph_writer.KnownGraphCache()
+  graph_writer.upsert_persons(g, PERSONS, cache=cache)
+
+  #XXX: the person changed through another container, then back to what this one has cached
+  graph_writer.upsert_persons(g, [make_person('Pororo Kim', 'poby', 'Principal SA')])
+  graph_writer.upsert_persons(g, PERSONS, cache=cache)
+  vertices, _ = graph.state()
+  assert vertices[graph_writer.owner_person_id('pororo')]['job_title'] == ('SA Manager',)
+
+
+def test_upsert_persons_with_cache_rewrites_edges_of_deleted_owners():
+  graph, g = make_graph()
+  cache = graph_writer.KnownGraphCache()
+  graph_writer.upsert_persons(g, PERSONS, cache=cache)
+  expected = graph.state()
+
+  #XXX: the owner of the edges is not in the batch, so it is looked up with the vertex writes
+  graph.drop_vertex(graph_writer.owner_person_id('edy'))
+  stats, failed_person_ids, _, _ = graph_writer.upsert_persons(g, PERSONS[1:3], cache=cache)
+  assert stats['stale'] == 1 and stats['skipped'] == 0 and not failed_person_ids
+
+  stats, _, created_edges, _ = graph_writer.upsert_persons(g, PERSONS, cache=cache)
+  assert sorted(created_edges) == sorted([(graph_writer.owner_person_id('edy'), person['id']) for person in PERSONS[1:3]])
+  assert graph.state() == expected
+
+
+def test_clear_graph_drops_every_partition(monkeypatch):
+  graph, g = make_graph()
+  persons = [make_person('Person{} Kim'.format(i), owner) for owner in ('edy', 'poby', 'pororo') for i in range(40)]
+  graph_writer.upsert_persons(g, PERSONS + persons)
+  vertices, edges = graph.state()
+
+  monkeypatch.setattr(graph_writer, 'remote_connection', lambda *args, **kwargs: gremlin_stand_in.LocalConnection(graph))
+  counts = graph_writer.clear_graph(batch_size=10, workers=4, chunk_size=8)
+  assert graph.state() == ({}, [])
+  assert counts == {'edges': len(edges), 'vertices': len(vertices)}
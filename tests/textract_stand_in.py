@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""In-memory stand-in for the Textract client calls of GetTextFromS3Image.
+
+  textract_client = Textract(pages={('octember-use1', 'bizcard-raw-img/edy_bizcard.pdf'): [[line, ...], ...]})
+
+Like Textract, start_document_text_detection returns the JobId of the earlier job for a
+ClientRequestToken it has seen, and get_document_text_detection returns the Blocks of a job
+at most page_size at a time, with a NextToken for the rest. complete_job() returns the SNS
+event of the completion message.
+"""
+
+import json
+import uuid
+
+
+class Textract:
+  class exceptions:
+    class ProvisionedThroughputExceededException(Exception):
+      pass
+
+    class ThrottlingException(Exception):
+      pass
+
+  def __init__(self, pages=None, page_size=3):
+    self.pages = pages or {}
+    self.page_size = page_size
+    self.jobs = {}
+    self.tokens = {}
+    self.calls = []
+
+  def start_document_text_detection(self, DocumentLocation, ClientRequestToken=None, JobTag=None, **kwargs):
+    self.calls.append('start_document_text_detection')
+    if ClientRequestToken in self.tokens:
+      return {'JobId': self.tokens[ClientRequestToken]}
+
+    s3_object = DocumentLocation['S3Object']
+    job_id = uuid.uuid4().hex
+    self.jobs[job_id] = {'location': (s3_object['Bucket'], s3_object['Name']), 'job_tag': JobTag}
+    if ClientRequestToken:
+      self.tokens[ClientRequestToken] = job_id
+    return {'JobId': job_id}
+
+  def get_document_text_detection(self, JobId, MaxResults=1000, NextToken=None):
+    self.calls.append('get_document_text_detection')
+    blocks = [{'BlockType': 'PAGE', 'Page': i + 1} for i in range(len(self.pages[self.jobs[JobId]['location']]))]
+    for i, lines in enumerate(self.pages[self.jobs[JobId]['location']]):
+      blocks.extend([{'BlockType': 'LINE', 'Page': i + 1, 'Text': line} for line in lines])
+
+    start = int(NextToken or 0)
+    end = start + min(MaxResults, self.page_size)
+    response = {'JobStatus': 'SUCCEEDED', 'DocumentMetadata': {'Pages': len(self.pages[self.jobs[JobId]['location']])},
+      'Blocks': blocks[start:end]}
+    if end < len(blocks):
+      response['NextToken'] = str(end)
+    return response
+
+  def complete_job(self, job_id, status='SUCCEEDED'):
+    bucket, key = self.jobs[job_id]['location']
+    message = {'JobId': job_id, 'Status': status, 'API': 'StartDocumentTextDetection',
+      'DocumentLocation': {'S3Bucket': bucket, 'S3ObjectName': key}}
+    if self.jobs[job_id]['job_tag']:
+      message['JobTag'] = self.jobs[job_id]['job_tag']
+    return {'Records': [{'Sns': {'Message': json.dumps(message)}}]}
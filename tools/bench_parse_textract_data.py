@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import sys
+import os
+import re
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+  '..', 'src', 'main', 'python', 'GetTextFromS3Image'))
+
+from get_text_from_s3_image import parse_textract_data
+
+FIRST_NAMES = ['Edy', 'Poby', 'Pororo', 'Crong', 'Harry', 'Rody', 'Loopy', 'Petty', 'Eddy', 'Sungmin', 'Hyouk', 'Jiyoung']
+LAST_NAMES = ['Kim', 'Lee', 'Park', 'Jang', 'Choi', 'Jung', 'Kang', 'Cho', 'Yoon']
+COMPANIES = ['aws', 'Amazon Web Services Korea LLC', 'Octember Inc.', 'Pororo Studio', 'Seoul Robotics', 'Hanbit Media']
+JOB_TITLES = ['Solutions Architect', 'Specialist Solutions Architect', 'Partner Solutions Architect',
+  'Associate Solutions Architect', 'SA Manager', 'Software Engineer', 'Account Manager', 'CTO']
+KO_STREETS = ['Nonhyeon-ro', 'Teheran-ro', 'Gangnam-daero', 'Sejong-daero', 'Olympic-ro']
+KO_DISTRICTS = ['Gangnam-gu', 'Jung-gu', 'Seocho-gu', 'Songpa-gu', 'Mapo-gu']
+US_ADDRS = ['410 Terry Ave N, Seattle, WA 98109', '2121 7th Ave, Seattle, WA 98121', '1 Infinite Loop, Cupertino, CA 95014']
+MISC_LINES = ['www.amazon.com', 'aws.amazon.com', 'Fax. 02-1234-5678', 'Building 7, Level 12', 'Mobile']
+
+
+def gen_phone_number(rnd):
+  formats = ['(+82 10) {a:04} {b:04}', '+82 10 {a:04} {b:04}', '010-{a:04}-{b:04}', 'T +82 2 {a:04}-{b:04}', 'M 82.10.{a:04}.{b:04}']
+  return rnd.choice(formats).format(a=rnd.randint(0, 9999), b=rnd.randint(0, 9999))
+
+
+def gen_card(rnd):
+  first_name, last_name = rnd.choice(FIRST_NAMES), rnd.choice(LAST_NAMES)
+  lines = [rnd.choice(COMPANIES), '{} {}'.format(first_name, last_name), rnd.choice(JOB_TITLES)]
+  extra = []
+  if rnd.random() < 0.8:
+    extra.append('{}F {} Tower, {} {}, {}, Seoul {:05}, Korea'.format(rnd.randint(1, 40), rnd.choice(['GS', 'Gangnam Finance', 'Centerfield']),
+      rnd.randint(1, 999), rnd.choice(KO_STREETS), rnd.choice(KO_DISTRICTS), rnd.randint(0, 99999)))
+  else:
+    extra.append(rnd.choice(US_ADDRS))
+  if rnd.random() < 0.95:
+    extra.append('{}{}@{}'.format(first_name.lower(), rnd.choice(['', '.' + last_name.lower(), str(rnd.randint(1, 99))]),
+      rnd.choice(['amazon.com', 'octember.io', 'example.co.kr'])))
+  for _ in range(rnd.randint(1, 2)):
+    extra.append(gen_phone_number(rnd))
+  extra.extend(rnd.sample(MISC_LINES, rnd.randint(0, 2)))
+  rnd.shuffle(extra)
+  return lines + extra
+
+
+def gen_corpus(card_count, seed=47):
+  rnd = random.Random(seed)
+  return [gen_card(rnd) for _ in range(card_count)]
+
+
+def legacy_parse_textract_data(lines):
+  # the parser before the compiled extraction engine, kept as the baseline
+  def _get_email(s):
+    email_re = re.compile(r'[a-zA-Z0-9+_\-\.]+@[0-9a-zA-Z][.-0-9a-zA-Z]*.[a-zA-Z]+')
+    emails = email_re.findall(s)
+    return emails[0] if emails else ''
+
+  def _get_addr(s):
+    ko_addr_stopwords = ['-gu', '-ro', '-do', ' gu', ' ro', ' do', ' seoul', ' korea']
+    addr_txt = s.lower()
+    score = sum([1 if e in addr_txt else 0 for e in ko_addr_stopwords])
+    return s if score >= 3 else ''
+
+  def _get_phone_number(s):
+    phone_number_re = re.compile(r'\({0,1}\+{0,1}[\d ]*[\d]{2,}\){0,1}[\d\- ]{7,}')
+    phones = phone_number_re.findall(s)
+    return phones[0] if phones else ''
+
+  funcs = {
+    'email': _get_email,
+    'addr': _get_addr,
+    'phone_number': _get_phone_number
+  }
+
+  doc = {}
+  for line in lines:
+    for k in ['email', 'addr', 'phone_number']:
+      ret = funcs[k](line)
+      if ret:
+        doc[k] = ret
+
+  company_name, name, job_title = lines[:3]
+  doc['company'] = company_name
+  doc['name'] = name
+  doc['job_title'] = job_title
+
+  return doc
+
+
+def bench(parse_func, corpus, repeat):
+  line_count = sum([len(card) for card in corpus])
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    for card in corpus:
+      parse_func(card)
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return line_count / best
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark parse_textract_data on a synthetic bizcard corpus')
+  parser.add_argument('--cards', type=int, default=100000)
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--seed', type=int, default=47)
+  parser.add_argument('--dump', help='write the corpus as JSON lines (one card per line) and exit')
+  options = parser.parse_args()
+
+  corpus = gen_corpus(options.cards, options.seed)
+  if options.dump:
+    with open(options.dump, 'w', encoding='utf-8') as fp:
+      for card in corpus:
+        fp.write(json.dumps(card, ensure_ascii=False) + '\n')
+    return
+
+  mismatches = sum([1 for card in corpus if parse_textract_data(card) != legacy_parse_textract_data(card)])
+  print('[INFO] cards={}, lines={}, mismatches={}'.format(len(corpus), sum([len(card) for card in corpus]), mismatches))
+
+  before = bench(legacy_parse_textract_data, corpus, options.repeat)
+  after = bench(parse_textract_data, corpus, options.repeat)
+  print('[INFO] before: {:,.0f} lines/sec'.format(before))
+  print('[INFO] after: {:,.0f} lines/sec ({:.2f}x)'.format(after, after / before))
+  if mismatches:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Compare the size and the encode/decode time of the query cache entry formats.
+
+Builds synthetic search and PYMK rankings of SEARCH_CACHE_DEPTH results, shaped like the responses
+documented in README.md, and encodes each as the plain json entries written before the compact
+format and with every codec of query_cache.encode_entry():
+
+  python tools/bench_query_cache_encoding.py --queries 200
+  python tools/bench_query_cache_encoding.py --redis-host localhost
+
+With --redis-host, every payload is also written to and read back from that Redis, to measure the
+transfer time; the keys are deleted afterwards.
+"""
+
+import sys
+import os
+import json
+import time
+import random
+import hashlib
+import argparse
+
+LAMBDA_SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'main', 'python')
+sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'CommonLib', 'python'))
+sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'SearchBizcard'))
+
+import query_cache
+from query_cache import encode_entry, decode_entry, pack_records, unpack_records
+from es_search_bizcard import pack_hits, unpack_hits
+
+FIRST_NAMES = ['Edy', 'Poby', 'Pororo', 'Crong', 'Harry', 'Rody', 'Loopy', 'Petty', 'Eddy', 'Sungmin', 'Hyouk', 'Jiyoung']
+LAST_NAMES = ['Kim', 'Lee', 'Park', 'Jang', 'Choi', 'Jung', 'Kang', 'Cho', 'Yoon']
+COMPANIES = ['aws', 'Amazon Web Services Korea LLC', 'Octember Inc.', 'Pororo Studio', 'Seoul Robotics', 'Hanbit Media']
+JOB_TITLES = ['Solutions Architect', 'Specialist Solutions Architect', 'Partner Solutions Architect',
+  'Associate Solutions Architect', 'SA Manager', 'Software Engineer', 'Account Manager', 'CTO']
+OWNERS = ['edy', 'poby', 'pororo', 'crong', 'harry', 'rody']
+
+
+def gen_person(rnd):
+  first_name, last_name = rnd.choice(FIRST_NAMES), rnd.choice(LAST_NAMES)
+  return {
+    'name': '{} {}'.format(first_name, last_name),
+    'email': '{}.{}{}@{}'.format(first_name.lower(), last_name.lower(), rnd.randint(1, 99), rnd.choice(['amazon.com', 'octember.io'])),
+    'phone_number': '(+82 10) {:04} {:04} '.format(rnd.randint(0, 9999), rnd.randint(0, 9999)),
+    'company': rnd.choice(COMPANIES),
+    'job_title': rnd.choice(JOB_TITLES)
+  }
+
+
+def gen_search_ranking(rnd, depth):
+  hits = []
+  score = rnd.uniform(2.0, 8.0)
+  for _ in range(depth):
+    source = gen_person(rnd)
+    image_id = '{}_bizcard_{:04}.jpg'.format(rnd.choice(OWNERS), rnd.randint(0, 9999))
+    doc_id = hashlib.md5(image_id.encode('utf-8')).hexdigest()[:8]
+    source.update({
+      'addr': '{}F GS Tower, 508 Nonhyeon-ro, Gangnam-gu, Seoul {:05}, Korea'.format(rnd.randint(1, 40), rnd.randint(0, 99999)),
+      'created_at': '2019-11-05T05:{:02}:{:02}Z'.format(rnd.randint(0, 59), rnd.randint(0, 59)),
+      'doc_id': doc_id,
+      'image_id': image_id,
+      'owner': rnd.choice(OWNERS),
+      'is_alive': 1,
+      'content_id': hashlib.md5(source['email'].encode('utf-8')).hexdigest()[:8]
+    })
+    score *= rnd.uniform(0.9, 1.0)
+    hits.append({'_index': 'octember_bizcard', '_type': 'bizcard', '_id': doc_id, '_score': score, '_source': source})
+  return hits
+
+
+def gen_pymk_ranking(rnd, depth):
+  ranking = []
+  for i in range(depth):
+    #XXX: valueMap() wraps every property in a list
+    ranking.append(dict({k: [v] for k, v in gen_person(rnd).items()}, score=float(depth - i + rnd.randint(0, 3))))
+  return ranking
+
+
+def legacy_payload(value):
+  # the entries before the compact format: the json of the envelope with the ranking as it is
+  return json.dumps({'refresh_at': time.time(), 'versions': ['0123456789abcdef0123456789abcdef'], 'value': value}).encode('utf-8')
+
+
+def compact_codecs():
+  codecs = [('json', False, sys.maxsize), ('json+zlib', False, 0)]
+  if query_cache.msgpack is not None:
+    codecs.extend([('msgpack', True, sys.maxsize), ('msgpack+zlib', True, 0)])
+  return codecs
+
+
+def bench(rankings, pack, unpack, repeat):
+  """Returns (format, bytes per entry, payloads, encode us, decode us) of the legacy and every compact format."""
+  res = []
+  best_encode, best_decode = (float('inf'), float('inf'))
+  for _ in range(repeat):
+    start = time.perf_counter()
+    payloads = [legacy_payload(ranking) for ranking in rankings]
+    encoded = time.perf_counter()
+    for payload in payloads:
+      json.loads(payload.decode('utf-8'))['value']
+    decoded = time.perf_counter()
+    best_encode = min(best_encode, encoded - start)
+    best_decode = min(best_decode, decoded - encoded)
+  res.append(('legacy json', sum([len(p) for p in payloads]) / len(payloads), payloads,
+    best_encode / len(rankings) * 1e6, best_decode / len(rankings) * 1e6))
+
+  for name, use_msgpack, compress_threshold in compact_codecs():
+    best_encode, best_decode = (float('inf'), float('inf'))
+    for _ in range(repeat):
+      start = time.perf_counter()
+      payloads = [encode_entry({'refresh_at': time.time(), 'versions': ['0123456789abcdef0123456789abcdef'], 'value': pack(ranking)},
+        use_msgpack, compress_threshold)[0] for ranking in rankings]
+      encoded = time.perf_counter()
+      values = [unpack(decode_entry(payload)[0]['value']) for payload in payloads]
+      decoded = time.perf_counter()
+      best_encode = min(best_encode, encoded - start)
+      best_decode = min(best_decode, decoded - encoded)
+    mismatches = sum([1 for value, ranking in zip(values, rankings) if value != ranking])
+    if mismatches:
+      print('[ERROR] {}: {} rankings did not round trip'.format(name, mismatches), file=sys.stderr)
+      sys.exit(1)
+    res.append((name, sum([len(p) for p in payloads]) / len(payloads), payloads,
+      best_encode / len(rankings) * 1e6, best_decode / len(rankings) * 1e6))
+  return res
+
+
+def bench_transfer(redis_client, payloads, repeat):
+  """Returns the mean GET time in us of the payloads from Redis."""
+  keys = ['bench:query_cache:{}'.format(i) for i in range(len(payloads))]
+  pipe = redis_client.pipeline(transaction=False)
+  for key, payload in zip(keys, payloads):
+    pipe.set(key, payload, ex=600)
+  pipe.execute()
+  try:
+    best = float('inf')
+    for _ in range(repeat):
+      start = time.perf_counter()
+      for key in keys:
+        redis_client.get(key)
+      best = min(best, time.perf_counter() - start)
+    return best / len(keys) * 1e6
+  finally:
+    redis_client.delete(*keys)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the query cache entry formats on synthetic rankings')
+  parser.add_argument('--queries', type=int, default=200, help='rankings of each kind')
+  parser.add_argument('--depth', type=int, default=100, help='results per ranking, like SEARCH_CACHE_DEPTH and PYMK_CACHE_DEPTH')
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--seed', type=int, default=47)
+  parser.add_argument('--redis-host', help='also measure the GET time of every format against this Redis')
+  parser.add_argument('--redis-port', type=int, default=6379)
+  options = parser.parse_args()
+
+  redis_client = None
+  if options.redis_host:
+    import redis
+    redis_client = redis.Redis(host=options.redis_host, port=options.redis_port, db=0)
+
+  if query_cache.msgpack is None:
+    print('[WARNING] msgpack is not installed, only the json codecs are measured', file=sys.stderr)
+
+  rnd = random.Random(options.seed)
+  workloads = [
+    ('search', [gen_search_ranking(rnd, options.depth) for _ in range(options.queries)],
+      pack_hits, lambda packed: unpack_hits(packed, 0, None)),
+    ('pymk', [gen_pymk_ranking(rnd, options.depth) for _ in range(options.queries)],
+      pack_records, unpack_records)
+  ]
+  for kind, rankings, pack, unpack in workloads:
+    print('[INFO] {}: {} rankings of {} results'.format(kind, len(rankings), options.depth))
+    res = bench(rankings, pack, unpack, options.repeat)
+    legacy_size = res[0][1]
+    for name, size, payloads, encode_us, decode_us in res:
+      line = '  {:<14} {:>9,.0f} bytes ({:>5.1f}%)  encode {:>8,.1f} us  decode {:>8,.1f} us'.format(name, size,
+        size / legacy_size * 100, encode_us, decode_us)
+      if redis_client is not None:
+        line += '  get {:>8,.1f} us'.format(bench_transfer(redis_client, payloads, options.repeat))
+      print(line)
+
+
+if __name__ == '__main__':
+  main()
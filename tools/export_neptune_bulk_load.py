@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Build Neptune bulk-load CSV files from the bizcard text archive written by Firehose.
+
+Reads the gzip objects that the BizcardTextToS3 delivery stream writes under bizcard-text/,
+or a local copy of them, and writes deduplicated person vertices and 'knows' edges with the
+same md5-derived ids as UpsertBizcardToGraphDB:
+
+  python tools/export_neptune_bulk_load.py --bucket octember-bizcard-use1 --output-dir /tmp/bulk
+  python tools/export_neptune_bulk_load.py --local-dir ./bizcard-text --output-s3 s3://octember-bizcard-use1/bulk-load/
+
+The output is meant for an empty graph (initial loads and rebuilds): edges get stable ids,
+but the ones written by the Lambda function have generated ids and would be duplicated.
+"""
+
+import sys
+import os
+import io
+import csv
+import json
+import gzip
+import time
+import hashlib
+import argparse
+import collections
+
+import boto3
+
+AWS_REGION = os.getenv('REGION_NAME', 'us-east-1')
+
+VERTEX_HEADER = ['~id', '~label', 'id:String(single)', 'name:String(single)', 'email:String(single)',
+  'phone_number:String(single)', 'company:String(single)', 'job_title:String(single)', '_name:String(single)']
+EDGE_HEADER = ['~id', '~from', '~to', '~label', 'weight:Double']
+
+#XXX: ids must stay in sync with upsert_bizcard_to_graph_db.lambda_handler() and owner_person_id()
+def person_id(email):
+  return hashlib.md5(email.split('@')[0].encode('utf-8')).hexdigest()[:8]
+
+
+def owner_person_id(owner):
+  return hashlib.md5(owner.encode('utf-8')).hexdigest()[:8]
+
+
+def list_archives(s3_client, bucket, prefix):
+  paginator = s3_client.get_paginator('list_objects_v2')
+  for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+    for obj in page.get('Contents', []):
+      yield 's3://{}/{}'.format(bucket, obj['Key'])
+
+
+def list_local_archives(local_dir):
+  for root, _, files in os.walk(local_dir):
+    for name in sorted(files):
+      yield os.path.join(root, name)
+
+
+def load_archive(s3_client, location):
+  if location.startswith('s3://'):
+    bucket, key = location[len('s3://'):].split('/', 1)
+    body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+  else:
+    with open(location, 'rb') as fp:
+      body = fp.read()
+  if body[:2] == b'\x1f\x8b':
+    body = gzip.decompress(body)
+  return body.decode('utf-8')
+
+
+def iter_json_records(text):
+  """Firehose concatenates the records without a delimiter, so decode them one by one."""
+  decoder = json.JSONDecoder()
+  pos, end = (0, len(text))
+  while pos < end:
+    while pos < end and text[pos].isspace():
+      pos += 1
+    if pos >= end:
+      break
+    rec, pos = decoder.raw_decode(text, pos)
+    yield rec
+
+
+class BulkLoadGraph:
+  """Persons and 'knows' edges of the archive; the last record of a person wins, as in the Lambda function."""
+
+  def __init__(self):
+    self.vertices = collections.OrderedDict()
+    self.edges = collections.OrderedDict()
+    self.counter = collections.OrderedDict([('reads', 0), ('invalid', 0), ('errors', 0)])
+
+  def add(self, json_data):
+    self.counter['reads'] += 1
+    if not all([json_data.get(k, None) for k in ('data', 'owner', 's3_key')]):
+      self.counter['invalid'] += 1
+      return
+    try:
+      record = json_data['data']
+      person = {
+        "id": person_id(record['email']),
+        "name": record['name'],
+        "email": record['email'],
+        "phone_number": record['phone_number'],
+        "company": record['company'],
+        "job_title": record['job_title']
+      }
+    except Exception as ex:
+      self.counter['errors'] += 1
+      return
+    self.vertices[person['id']] = person
+    _from_person_id = owner_person_id(json_data['owner'])
+    if _from_person_id != person['id']:
+      self.edges[(_from_person_id, person['id'])] = 1.0
+
+  def vertex_rows(self):
+    for vid, person in self.vertices.items():
+      yield [vid, 'person', person['id'], person['name'], person['email'], person['phone_number'],
+        person['company'], person['job_title'], person['name'].lower()]
+
+  def edge_rows(self):
+    #XXX: like the Lambda function, an edge needs its owner in the graph
+    for (from_id, to_id), weight in self.edges.items():
+      if from_id in self.vertices:
+        yield ['{}-knows-{}'.format(from_id, to_id), from_id, to_id, 'knows', weight]
+
+
+def write_csv_chunks(rows, header, name, chunk_rows, write_file):
+  """Write rows as gzip csv files of at most chunk_rows rows, each with the header; returns (files, rows)."""
+  file_count, row_count = (0, 0)
+  buf, writer, rows_in_chunk = (None, None, 0)
+
+  def _flush():
+    write_file('{}-{:05d}.csv.gz'.format(name, file_count), gzip.compress(buf.getvalue().encode('utf-8')))
+
+  for row in rows:
+    if writer is None:
+      buf = io.StringIO()
+      writer = csv.writer(buf, lineterminator='\n')
+      writer.writerow(header)
+    writer.writerow(row)
+    rows_in_chunk += 1
+    row_count += 1
+    if rows_in_chunk >= chunk_rows:
+      _flush()
+      file_count += 1
+      buf, writer, rows_in_chunk = (None, None, 0)
+  if writer is not None:
+    _flush()
+    file_count += 1
+  return file_count, row_count
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Build Neptune bulk-load CSV files from the Firehose bizcard text archive')
+  source = parser.add_mutually_exclusive_group(required=True)
+  source.add_argument('--bucket', help='S3 bucket of the Firehose archive')
+  source.add_argument('--local-dir', help='local directory with a copy of the archive')
+  parser.add_argument('--prefix', default='bizcard-text/')
+  target = parser.add_mutually_exclusive_group(required=True)
+  target.add_argument('--output-dir', help='local directory for the csv files')
+  target.add_argument('--output-s3', help='s3://bucket/prefix/ for the csv files')
+  parser.add_argument('--chunk-rows', type=int, default=100000, help='rows per csv file')
+  parser.add_argument('--region-name', default=AWS_REGION)
+  options = parser.parse_args()
+
+  s3_client = boto3.client('s3', region_name=options.region_name) if (options.bucket or options.output_s3) else None
+  if options.bucket:
+    locations = list_archives(s3_client, options.bucket, options.prefix)
+  else:
+    locations = list_local_archives(options.local_dir)
+
+  start = time.perf_counter()
+  graph = BulkLoadGraph()
+  archive_count = 0
+  #XXX: Firehose object keys start with the delivery time, so sorted keys replay the records in order
+  for location in sorted(locations):
+    archive_count += 1
+    try:
+      for json_data in iter_json_records(load_archive(s3_client, location)):
+        graph.add(json_data)
+    except Exception as ex:
+      graph.counter['errors'] += 1
+      print('[ERROR] failed to read {}: {}'.format(location, ex), file=sys.stderr)
+
+  if options.output_dir:
+    os.makedirs(options.output_dir, exist_ok=True)
+
+    def write_file(name, body):
+      with open(os.path.join(options.output_dir, name), 'wb') as fp:
+        fp.write(body)
+    load_source = os.path.abspath(options.output_dir)
+  else:
+    out_bucket, out_prefix = options.output_s3[len('s3://'):].split('/', 1)
+
+    def write_file(name, body):
+      s3_client.put_object(Bucket=out_bucket, Key=out_prefix + name, Body=body)
+    load_source = options.output_s3
+
+  vertex_files, vertex_rows = write_csv_chunks(graph.vertex_rows(), VERTEX_HEADER, 'vertices', options.chunk_rows, write_file)
+  edge_files, edge_rows = write_csv_chunks(graph.edge_rows(), EDGE_HEADER, 'edges', options.chunk_rows, write_file)
+
+  elapsed = time.perf_counter() - start
+  print('[INFO] archives={},'.format(archive_count), ', '.join(['{}={}'.format(k, v) for k, v in graph.counter.items()]) + ',',
+    'vertices={} in {} files, edges={} in {} files, elapsed={:.1f}s'.format(vertex_rows, vertex_files,
+      edge_rows, edge_files, elapsed), file=sys.stderr)
+
+  print('[INFO] request body for POST https://<neptune-endpoint>:8182/loader', file=sys.stderr)
+  print(json.dumps({
+    "source": load_source,
+    "format": "csv",
+    "iamRoleArn": "arn:aws:iam::<account-id>:role/<neptune-load-from-s3-role>",
+    "region": options.region_name,
+    "failOnError": "FALSE",
+    "parallelism": "HIGH"
+  }, indent=2))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import sys
+import os
+import json
+import hashlib
+import random
+import argparse
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+  '..', 'src', 'main', 'python', 'CommonLib', 'python'))
+
+from kinesis_producer import gen_partition_key, PARTITION_KEY_STRATEGIES
+
+HASH_KEY_SPACE = 2 ** 128
+
+
+def _legacy_partition_key(rec):
+  #XXX: the old producer re-seeded the RNG on every single-record put_records call
+  random.seed(47)
+  return 'part-{:05}'.format(random.randint(1, 1024))
+
+
+def shard_of(partition_key, shard_count):
+  # Kinesis maps the MD5 hash of the partition key onto evenly split hash key ranges
+  hash_key = int(hashlib.md5(partition_key.encode('utf-8')).hexdigest(), 16)
+  return hash_key * shard_count // HASH_KEY_SPACE
+
+
+def load_records(input_path):
+  records = []
+  with open(input_path, encoding='utf-8') as fp:
+    for line in fp:
+      line = line.strip()
+      if not line:
+        continue
+      records.append(json.loads(line) if line.startswith('{') else {'s3_key': line})
+  return records
+
+
+def gen_synthetic_records(count, owner_count, skew):
+  # a few heavy owners upload most of the cards (zipf-like)
+  owners = ['user{:04}'.format(i) for i in range(owner_count)]
+  weights = [1.0 / (rank + 1) ** skew for rank in range(owner_count)]
+  records = []
+  for i, owner in enumerate(random.choices(owners, weights=weights, k=count)):
+    s3_key = 'bizcard-raw-img/{}_{:010}.jpg'.format(owner, i)
+    records.append({'s3_bucket': 'octember-use1', 's3_key': s3_key, 'owner': owner})
+  return records
+
+
+def shard_distribution(records, strategy, shard_count):
+  counter = collections.Counter()
+  for rec in records:
+    partition_key = _legacy_partition_key(rec) if strategy == 'legacy' else gen_partition_key(rec, strategy)
+    counter[shard_of(partition_key, shard_count)] += 1
+  return [counter[i] for i in range(shard_count)]
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Replay records and report how they spread across simulated Kinesis shards')
+  parser.add_argument('--input', help='file with one s3 key or one JSON record per line (default: synthetic records)')
+  parser.add_argument('--shards', type=int, nargs='+', default=[2, 4, 8, 16])
+  parser.add_argument('--records', type=int, default=100000, help='number of synthetic records')
+  parser.add_argument('--owners', type=int, default=1000, help='number of synthetic owners')
+  parser.add_argument('--skew', type=float, default=1.1, help='zipf exponent of the synthetic owner distribution')
+  parser.add_argument('--seed', type=int, default=47)
+  options = parser.parse_args()
+
+  random.seed(options.seed)
+  records = load_records(options.input) if options.input else gen_synthetic_records(options.records, options.owners, options.skew)
+  print('[INFO] replaying {} records'.format(len(records)), file=sys.stderr)
+
+  strategies = ['legacy'] + sorted(PARTITION_KEY_STRATEGIES.keys())
+  print('{:<8} {:>6} {:>10} {:>10} {:>10} {:>9}'.format('strategy', 'shards', 'hottest', 'coldest', 'mean', 'hot/mean'))
+  for shard_count in options.shards:
+    for strategy in strategies:
+      dist = shard_distribution(records, strategy, shard_count)
+      mean = len(records) / shard_count
+      print('{:<8} {:>6} {:>10} {:>10} {:>10.1f} {:>9.2f}'.format(strategy, shard_count,
+        max(dist), min(dist), mean, max(dist) / mean))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Precompute People You May Know for every person and store the top-K in Redis.
+
+The 'knows' edge list is read from Neptune, or from the csv files written by
+export_neptune_bulk_load.py. Friends-of-friends scores for all persons are A·A, where A is
+the undirected adjacency matrix (A = M + Mᵀ). That is the number of both('knows').both('knows')
+paths that RecommendBizcard counts with groupCount(). The person and their friends are masked
+out. Run it on a schedule from a host that can reach Neptune and ElastiCache:
+
+  python tools/materialize_pymk.py --neptune-endpoint octember-bizcard.cluster-xxx.us-east-1.neptune.amazonaws.com \\
+    --redis-host octember-neptune-cache.2rb5x2.0001.use1.cache.amazonaws.com
+  python tools/materialize_pymk.py --bulk-load-dir /tmp/bulk --dry-run
+
+Redis keys, read by neptune_recommend_bizcard.materialized_people_you_may_know():
+
+  pymk:zset:<person id>     sorted set of recommended person ids by score, top-K only
+  pymk:name:<name hash>     set of person ids with that name; md5(name.lower())[:8] like the query id
+  pymk:profile:<person id>  json of the person's properties, as returned by the live traversal
+  pymk:adj:<person id>      hash of neighbour id -> number of 'knows' edges in either direction
+  pymk:materialized         hash of the top_k and ttl of the last run
+  pymk:version:all          random stamp, renewed by every run to invalidate the cached PYMK responses
+
+UpdatePymkScores keeps the sorted sets and adjacency hashes up to date between runs with the
+edge deltas that UpsertBizcardToGraphDB publishes to pymk:edge_deltas.
+
+The fast path uses scipy.sparse and numpy, which are not needed by the Lambda functions and are
+not installed with them; install them on the host that runs this tool:
+
+  pip install scipy numpy
+
+Without them the scores are computed in pure Python, which is fine for tens of thousands of persons.
+"""
+
+import sys
+import os
+import csv
+import json
+import gzip
+import glob
+import time
+import heapq
+import hashlib
+import argparse
+import operator
+import collections
+import uuid
+
+LAMBDA_SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'main', 'python')
+
+#XXX: key formats must stay in sync with neptune_recommend_bizcard.materialized_people_you_may_know()
+PYMK_ZSET_KEY = 'pymk:zset:{}'
+PYMK_NAME_KEY = 'pymk:name:{}'
+PYMK_PROFILE_KEY = 'pymk:profile:{}'
+PYMK_ADJACENCY_KEY = 'pymk:adj:{}'
+PYMK_SETTINGS_KEY = 'pymk:materialized'
+PYMK_EDGE_DELTAS_KEY = 'pymk:edge_deltas'
+PYMK_VERSION_ALL_KEY = 'pymk:version:all'
+#XXX: like CACHE_VERSION_TTL of UpsertBizcardToGraphDB, longer than any cached response lives
+CACHE_VERSION_TTL = 7*24*60*60
+
+
+def name_hash_code(name):
+  return hashlib.md5(name.lower().encode('utf-8')).hexdigest()[:8]
+
+
+def load_graph_from_neptune(neptune_endpoint, neptune_port, prefix_length=2):
+  """Read person vertices and 'knows' edges one id prefix at a time, so no single request scans the graph."""
+  sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'CommonLib', 'python'))
+  from gremlin_python.process.graph_traversal import __
+  from gremlin_python.process.traversal import TextP
+  from neptune_connection import remote_connection, graph_traversal
+
+  vertices, edges = (collections.OrderedDict(), [])
+  connection = remote_connection(neptune_endpoint, neptune_port)
+  try:
+    g = graph_traversal(connection=connection)
+    prefixes = ['{:0{}x}'.format(i, prefix_length) for i in range(16 ** prefix_length)]
+    for prefix in prefixes:
+      for value_map in g.V().hasLabel('person').has('id', TextP.startingWith(prefix)).valueMap().toList():
+        vertices[value_map['id'][0]] = value_map
+      for edge in (g.V().has('id', TextP.startingWith(prefix)).outE('knows').
+          project('from', 'to').by(__.outV().id()).by(__.inV().id()).toList()):
+        edges.append((edge['from'], edge['to']))
+  finally:
+    connection.close()
+  return vertices, edges
+
+
+def load_graph_from_bulk_load_dir(bulk_load_dir):
+  """Read the vertices-*.csv.gz and edges-*.csv.gz files of export_neptune_bulk_load.py."""
+  vertices, edges = (collections.OrderedDict(), [])
+  for path in sorted(glob.glob(os.path.join(bulk_load_dir, 'vertices-*.csv.gz'))):
+    with gzip.open(path, 'rt', encoding='utf-8') as fp:
+      for row in csv.DictReader(fp):
+        #XXX: 'name:String(single)' -> 'name'; lists like valueMap() in the live traversal
+        vertices[row['~id']] = {k.split(':')[0]: [v] for k, v in row.items() if not k.startswith('~')}
+  for path in sorted(glob.glob(os.path.join(bulk_load_dir, 'edges-*.csv.gz'))):
+    with gzip.open(path, 'rt', encoding='utf-8') as fp:
+      for row in csv.DictReader(fp):
+        if row['~label'] == 'knows':
+          edges.append((row['~from'], row['~to']))
+  return vertices, edges
+
+
+def friends_of_friends_scipy(n, edges, top_k, block_rows=2048):
+  """Yield (row, [(column, score), ...]) with the top_k scores of every row of A·A."""
+  import numpy as np
+  from scipy import sparse
+
+  rows, cols = (np.array([e[0] for e in edges], dtype=np.int64), np.array([e[1] for e in edges], dtype=np.int64))
+  m = sparse.csr_matrix((np.ones(len(edges), dtype=np.float64), (rows, cols)), shape=(n, n))
+  a = (m + m.T).tocsr()
+
+  #XXX: A·A of hubs is dense, so multiply a block of rows at a time to bound the memory
+  for start in range(0, n, block_rows):
+    end = min(n, start + block_rows)
+    c = (a[start:end] @ a).tocsr()
+    for r in range(end - start):
+      u = start + r
+      cand = c.indices[c.indptr[r]:c.indptr[r + 1]]
+      score = c.data[c.indptr[r]:c.indptr[r + 1]]
+      friends = a.indices[a.indptr[u]:a.indptr[u + 1]]
+      keep = (cand != u) & ~np.isin(cand, friends)
+      cand, score = (cand[keep], score[keep])
+      if len(cand) > top_k:
+        top = np.argpartition(-score, top_k - 1)[:top_k]
+        cand, score = (cand[top], score[top])
+      order = np.argsort(-score, kind='stable')
+      yield u, [(int(cand[i]), float(score[i])) for i in order]
+
+
+def friends_of_friends_python(n, edges, top_k):
+  adjacency = [collections.Counter() for _ in range(n)]
+  for from_idx, to_idx in edges:
+    adjacency[from_idx][to_idx] += 1
+    adjacency[to_idx][from_idx] += 1
+
+  for u in range(n):
+    scores = collections.Counter()
+    for v, w1 in adjacency[u].items():
+      for x, w2 in adjacency[v].items():
+        scores[x] += w1 * w2
+    scores.pop(u, None)
+    for v in adjacency[u]:
+      scores.pop(v, None)
+    yield u, [(x, float(s)) for x, s in heapq.nlargest(top_k, scores.items(), key=operator.itemgetter(1))]
+
+
+def materialize(vertices, edges, top_k, block_rows=2048):
+  """Returns {person id: [(person id, score), ...]} for every vertex, best first."""
+  vertex_ids = list(vertices.keys())
+  index = {vid: i for i, vid in enumerate(vertex_ids)}
+  #XXX: edges to vertices that are not persons (or no longer exist) can not be recommended
+  indexed_edges = [(index[f], index[t]) for f, t in edges if f in index and t in index]
+
+  try:
+    import numpy
+    import scipy.sparse
+    scores = friends_of_friends_scipy(len(vertex_ids), indexed_edges, top_k, block_rows)
+  except ImportError:
+    print('[WARNING] scipy or numpy is not installed (pip install scipy numpy), computing the scores in pure Python', file=sys.stderr)
+    scores = friends_of_friends_python(len(vertex_ids), indexed_edges, top_k)
+
+  return {vertex_ids[u]: [(vertex_ids[x], s) for x, s in top] for u, top in scores}
+
+
+def profile_of(value_map):
+  #XXX: the same properties as people_you_may_know() returns for a live traversal
+  return {k: v for k, v in value_map.items() if not (k == 'id' or k.startswith('_'))}
+
+
+def adjacency_of(vertices, edges):
+  adjacency = collections.defaultdict(collections.Counter)
+  for from_id, to_id in edges:
+    if from_id in vertices and to_id in vertices:
+      adjacency[from_id][to_id] += 1
+      adjacency[to_id][from_id] += 1
+  return adjacency
+
+
+def write_to_redis(redis_client, vertices, edges, recommendations, top_k, ttl, batch_size=500):
+  """Replace the sorted set, profile, adjacency and name index of every person; each batch is one MULTI/EXEC."""
+  name_index = collections.defaultdict(list)
+  for vid, value_map in vertices.items():
+    name = (value_map.get('_name') or value_map.get('name') or [''])[0]
+    if name:
+      name_index[name_hash_code(name)].append(vid)
+  adjacency = adjacency_of(vertices, edges)
+
+  counter = collections.OrderedDict([('persons', 0), ('recommendations', 0), ('names', 0)])
+  pipe = redis_client.pipeline(transaction=True)
+  pending = 0
+
+  def _flush(pending):
+    if pending >= batch_size:
+      pipe.execute()
+      return 0
+    return pending
+
+  for vid, value_map in vertices.items():
+    zset_key = PYMK_ZSET_KEY.format(vid)
+    top = recommendations.get(vid, [])
+    pipe.delete(zset_key)
+    if top:
+      pipe.zadd(zset_key, {k: s for k, s in top})
+      pipe.expire(zset_key, ttl)
+    pipe.set(PYMK_PROFILE_KEY.format(vid), json.dumps(profile_of(value_map)), ex=ttl)
+    adjacency_key = PYMK_ADJACENCY_KEY.format(vid)
+    pipe.delete(adjacency_key)
+    if adjacency[vid]:
+      pipe.hmset(adjacency_key, dict(adjacency[vid]))
+      pipe.expire(adjacency_key, ttl)
+    counter['persons'] += 1
+    counter['recommendations'] += len(top)
+    pending = _flush(pending + 1)
+
+  for name_hash, person_ids in name_index.items():
+    name_key = PYMK_NAME_KEY.format(name_hash)
+    pipe.delete(name_key)
+    pipe.sadd(name_key, *person_ids)
+    pipe.expire(name_key, ttl)
+    counter['names'] += 1
+    pending = _flush(pending + 1)
+
+  pipe.hmset(PYMK_SETTINGS_KEY, {'top_k': top_k, 'ttl': ttl, 'materialized_at': int(time.time())})
+  pipe.set(PYMK_VERSION_ALL_KEY, uuid.uuid4().hex, ex=CACHE_VERSION_TTL)
+  pipe.execute()
+  return counter
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Precompute People You May Know into Redis sorted sets',
+    epilog='The scores are computed with scipy and numpy when they are installed (pip install scipy numpy), in pure Python otherwise.')
+  source = parser.add_mutually_exclusive_group(required=True)
+  source.add_argument('--neptune-endpoint', help='read the graph from Neptune')
+  source.add_argument('--bulk-load-dir', help='read the csv files of export_neptune_bulk_load.py')
+  parser.add_argument('--neptune-port', type=int, default=8182)
+  parser.add_argument('--redis-host', help='ElastiCache endpoint of RecommendBizcard')
+  parser.add_argument('--redis-port', type=int, default=6379)
+  parser.add_argument('--top-k', type=int, default=100, help='recommendations kept per person')
+  parser.add_argument('--ttl', type=int, default=2*24*60*60,
+    help='seconds the results live; longer than the schedule, so persons that are gone age out')
+  parser.add_argument('--block-rows', type=int, default=2048, help='rows of A·A computed at once by the scipy fast path')
+  parser.add_argument('--dry-run', action='store_true', help='compute the scores without writing to Redis')
+  options = parser.parse_args()
+
+  if not (options.redis_host or options.dry_run):
+    parser.error('--redis-host is required unless --dry-run is given')
+
+  redis_client = None
+  if not options.dry_run:
+    import redis
+
+    redis_client = redis.Redis(host=options.redis_host, port=options.redis_port, db=0)
+    #XXX: every edge published so far is in the graph that is about to be read, so its delta is not needed
+    # anymore; an edge written while the graph is read may still be counted twice until the next run
+    redis_client.delete(PYMK_EDGE_DELTAS_KEY)
+
+  start = time.perf_counter()
+  if options.neptune_endpoint:
+    vertices, edges = load_graph_from_neptune(options.neptune_endpoint, options.neptune_port)
+  else:
+    vertices, edges = load_graph_from_bulk_load_dir(options.bulk_load_dir)
+  loaded_at = time.perf_counter()
+  print('[INFO] loaded vertices={}, edges={} in {:.1f}s'.format(len(vertices), len(edges), loaded_at - start), file=sys.stderr)
+
+  recommendations = materialize(vertices, edges, options.top_k, options.block_rows)
+  computed_at = time.perf_counter()
+  print('[INFO] computed recommendations for {} persons in {:.1f}s'.format(len(recommendations), computed_at - loaded_at),
+    file=sys.stderr)
+
+  if options.dry_run:
+    for vid, top in list(recommendations.items())[:5]:
+      print('[DEBUG] {}: {}'.format(vid, top[:5]), file=sys.stderr)
+    return
+
+  counter = write_to_redis(redis_client, vertices, edges, recommendations, options.top_k, options.ttl)
+  print('[INFO]', ', '.join(['{}={}'.format(k, v) for k, v in counter.items()]),
+    'written in {:.1f}s'.format(time.perf_counter() - computed_at), file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
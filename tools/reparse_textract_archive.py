@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import sys
+import os
+import json
+import gzip
+import time
+import datetime
+import argparse
+import importlib
+import traceback
+import multiprocessing
+
+LAMBDA_SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'main', 'python')
+sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'GetTextFromS3Image'))
+sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'CommonLib', 'python'))
+
+import boto3
+
+from get_text_from_s3_image import get_text_lines_by_page, TEXTRACT_ARCHIVE_PREFIX
+from kinesis_producer import write_records_to_kinesis
+
+AWS_REGION = os.getenv('REGION_NAME', 'us-east-1')
+
+# per-process state, set by _init_worker()
+_s3_client = None
+_parse_func = None
+
+
+def load_parser(parser_spec):
+  """Load a parser given as 'module:function', ex: 'get_text_from_s3_image:parse_textract_data'."""
+  module_name, func_name = parser_spec.split(':')
+  return getattr(importlib.import_module(module_name), func_name)
+
+
+def _init_worker(parser_spec, region_name):
+  global _s3_client, _parse_func
+
+  _s3_client = boto3.client('s3', region_name=region_name) if region_name else None
+  _parse_func = load_parser(parser_spec)
+
+
+def list_archives(s3_client, bucket, prefix):
+  paginator = s3_client.get_paginator('list_objects_v2')
+  for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+    for obj in page.get('Contents', []):
+      if obj['Key'].endswith('.json.gz'):
+        yield 's3://{}/{}'.format(bucket, obj['Key'])
+
+
+def list_local_archives(local_dir):
+  for root, _, files in os.walk(local_dir):
+    for name in sorted(files):
+      if name.endswith('.json.gz'):
+        yield os.path.join(root, name)
+
+
+def load_archive(location):
+  if location.startswith('s3://'):
+    bucket, key = location[len('s3://'):].split('/', 1)
+    body = _s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+  else:
+    with open(location, 'rb') as fp:
+      body = fp.read()
+  return json.loads(gzip.decompress(body).decode('utf-8'))
+
+
+def reparse_archive(location):
+  """Returns the text records of an archive, one per page like emit_bizcard_text(), or None on error."""
+  try:
+    archive = load_archive(location)
+    pages = [lines for lines in get_text_lines_by_page(archive['Blocks']) if len(lines) >= 3]
+    if not pages:
+      raise RuntimeError('not enough text in {}'.format(archive['s3_key']))
+
+    text_data_list = []
+    for i, lines in enumerate(pages):
+      doc = _parse_func(lines)
+      doc['created_at'] = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+      text_data = {'s3_bucket': archive['s3_bucket'], 's3_key': archive['s3_key'], 'owner': archive['owner'], 'data': doc}
+      if len(pages) > 1:
+        text_data['page'] = i + 1
+      text_data_list.append(text_data)
+    return text_data_list
+  except Exception as ex:
+    print('[ERROR] failed to re-parse {}'.format(location), file=sys.stderr)
+    traceback.print_exc()
+    return None
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Re-parse archived Textract responses without running OCR again')
+  source = parser.add_mutually_exclusive_group(required=True)
+  source.add_argument('--bucket', help='S3 bucket of the archived Textract responses')
+  source.add_argument('--local-dir', help='local directory with *.json.gz archives')
+  parser.add_argument('--prefix', default=TEXTRACT_ARCHIVE_PREFIX)
+  parser.add_argument('--parser', default='get_text_from_s3_image:parse_textract_data',
+    help='parser to apply, as module:function (default: %(default)s)')
+  parser.add_argument('--processes', type=int, default=os.cpu_count())
+  parser.add_argument('--batch-size', type=int, default=500, help='records per write to the text stream')
+  parser.add_argument('--stream-name', help='Kinesis stream to re-emit to; results go to stdout as JSON lines if omitted')
+  parser.add_argument('--region-name', default=AWS_REGION)
+  options = parser.parse_args()
+
+  if options.bucket:
+    locations = list(list_archives(boto3.client('s3', region_name=options.region_name), options.bucket, options.prefix))
+  else:
+    locations = list(list_local_archives(options.local_dir))
+  print('[INFO] re-parsing {} archives with {} processes'.format(len(locations), options.processes), file=sys.stderr)
+
+  kinesis_client = boto3.client('kinesis', region_name=options.region_name) if options.stream_name else None
+  counter = {'reads': 0, 'writes': 0, 'errors': 0}
+  batch = []
+
+  def flush():
+    if options.stream_name:
+      failed_records = write_records_to_kinesis(kinesis_client, options.stream_name, batch, partition_key_strategy='owner')
+      counter['errors'] += len(failed_records)
+      counter['writes'] += len(batch) - len(failed_records)
+    else:
+      for rec in batch:
+        print(json.dumps(rec, ensure_ascii=False))
+      counter['writes'] += len(batch)
+    del batch[:]
+
+  start = time.perf_counter()
+  region_name = options.region_name if options.bucket else None
+  with multiprocessing.Pool(options.processes, initializer=_init_worker, initargs=(options.parser, region_name)) as pool:
+    for text_data_list in pool.imap_unordered(reparse_archive, locations, chunksize=64):
+      counter['reads'] += 1
+      if text_data_list is None:
+        counter['errors'] += 1
+        continue
+      batch.extend(text_data_list)
+      if len(batch) >= options.batch_size:
+        flush()
+  if batch:
+    flush()
+
+  elapsed = time.perf_counter() - start
+  print('[INFO]', ', '.join(['{}={}'.format(k, v) for k, v in counter.items()]),
+    'elapsed={:.1f}s, cards/sec={:.0f}'.format(elapsed, counter['reads'] / max(elapsed, 1e-9)), file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Replay a search query log against simulated SearchBizcard caches and compare their hit ratios.
+
+The log has one json object per line, either a SearchBizcard event or its queryStringParameters,
+with optional "timestamp" (epoch seconds) and "hits" (the total the query returned; 0 for no hits):
+
+  {"query": "Kim  architect", "user": "edy", "timestamp": 1572931224, "hits": 3}
+  {"queryStringParameters": {"query": "KIM"}, "hits": 0}
+
+  python tools/replay_search_cache_log.py --log search-queries.jsonl
+  python tools/replay_search_cache_log.py --synthetic 100000
+
+Three caches are compared: the key of the raw query body without negative caching, as before
+the canonicalizer, the canonical key, and the canonical key with negative caching. Entries are
+fresh for CACHE_SOFT_TTL, and empty results for CACHE_NEGATIVE_TTL; writes are not replayed, so
+the version keys are left out.
+"""
+
+import sys
+import os
+import json
+import random
+import hashlib
+import argparse
+import collections
+
+LAMBDA_SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'main', 'python')
+sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'CommonLib', 'python'))
+sys.path.insert(0, os.path.join(LAMBDA_SRC_DIR, 'SearchBizcard'))
+
+from query_cache import CACHE_SOFT_TTL, CACHE_NEGATIVE_TTL
+from es_search_bizcard import canonical_keywords, build_query_body, query_cache_key
+
+KEYWORDS = ['kim', 'lee', 'park', 'jang', 'architect', 'solutions architect', 'aws', 'manager', 'engineer',
+  'gangnam', 'seoul', 'octember', 'partner', 'specialist', 'cto', 'edy kim', 'poby kim', 'crong lee']
+OWNERS = ['edy', 'poby', 'pororo', 'crong', 'harry', 'rody']
+FULL_WIDTH_OFFSET = 0xfee0
+
+
+def legacy_query_cache_key(query_params):
+  # the key before the canonicalizer: the hash of the body built from the raw parameters
+  es_query_body = build_query_body(query_params.get('query', ''), query_params.get('user', ''))
+  return 'es:query_id:{}'.format(hashlib.md5(json.dumps(es_query_body).encode('utf-8')).hexdigest()[:8])
+
+
+def canonical_query_cache_key(query_params):
+  #XXX: the same normalization as es_search_bizcard.lambda_handler()
+  return query_cache_key(build_query_body(canonical_keywords(query_params.get('query', '')),
+    query_params.get('user', '').strip()))
+
+
+def vary(rnd, keywords):
+  """Spell the keywords the way users type them: case, spacing, word order and full-width letters."""
+  words = keywords.split()
+  if len(words) > 1 and rnd.random() < 0.3:
+    rnd.shuffle(words)
+  words = [w.upper() if rnd.random() < 0.2 else (w.capitalize() if rnd.random() < 0.4 else w) for w in words]
+  text = (' ' * rnd.choice([1, 1, 1, 2])).join(words)
+  if rnd.random() < 0.05:
+    text = ''.join([chr(ord(c) + FULL_WIDTH_OFFSET) if '!' <= c <= '~' else c for c in text])
+  return text + (' ' if rnd.random() < 0.1 else '')
+
+
+def gen_log(event_count, seed=47, qps=20.0):
+  """Zipf-distributed queries in spelling variants, about 15% of them misspelled and without hits."""
+  rnd = random.Random(seed)
+  base = [(keywords, owner) for keywords in KEYWORDS for owner in [''] + OWNERS]
+  weights = [1.0 / (rank + 1) for rank in range(len(base))]
+  timestamp = 0.0
+  for _ in range(event_count):
+    keywords, owner = rnd.choices(base, weights)[0]
+    hits = rnd.randint(1, 50)
+    if rnd.random() < 0.15:
+      #XXX: a handful of common typos, so that the same no-hit query comes back
+      keywords, hits = (keywords[:-1] + rnd.choice('xq'), 0)
+    timestamp += rnd.expovariate(qps)
+    query_params = {'query': vary(rnd, keywords)}
+    if owner:
+      query_params['user'] = owner
+    yield {'timestamp': timestamp, 'hits': hits, 'query_params': query_params}
+
+
+def read_log(path, interval=1.0):
+  with open(path, encoding='utf-8') as fp:
+    for i, line in enumerate(fp):
+      line = line.strip()
+      if not line:
+        continue
+      rec = json.loads(line)
+      query_params = rec.get('queryStringParameters', rec)
+      yield {'timestamp': float(rec.get('timestamp', i * interval)), 'hits': int(rec.get('hits', 1)),
+        'query_params': {k: query_params[k] for k in ('query', 'user') if query_params.get(k)}}
+
+
+class SimulatedCache:
+  def __init__(self, key_func, soft_ttl, negative_ttl=None):
+    self.key_func = key_func
+    self.soft_ttl = soft_ttl
+    self.negative_ttl = negative_ttl
+    self.expires_at = {}
+    self.stats = collections.OrderedDict([('requests', 0), ('hits', 0), ('negative_hits', 0), ('es_queries', 0)])
+
+  def request(self, timestamp, query_params, hits):
+    self.stats['requests'] += 1
+    key = self.key_func(query_params)
+    if self.expires_at.get(key, -1) > timestamp:
+      self.stats['hits'] += 1
+      self.stats['negative_hits'] += 1 if hits == 0 else 0
+      return
+    self.stats['es_queries'] += 1
+    if hits > 0:
+      self.expires_at[key] = timestamp + self.soft_ttl
+    elif self.negative_ttl:
+      self.expires_at[key] = timestamp + self.negative_ttl
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Replay a search query log and compare the cache hit ratios of the query keys')
+  source = parser.add_mutually_exclusive_group(required=True)
+  source.add_argument('--log', help='json lines of SearchBizcard query parameters')
+  source.add_argument('--synthetic', type=int, help='replay this many generated queries instead')
+  parser.add_argument('--seed', type=int, default=47)
+  parser.add_argument('--interval', type=float, default=1.0, help='seconds between log lines without a timestamp')
+  parser.add_argument('--soft-ttl', type=float, default=CACHE_SOFT_TTL)
+  parser.add_argument('--negative-ttl', type=float, default=CACHE_NEGATIVE_TTL)
+  options = parser.parse_args()
+
+  events = read_log(options.log, options.interval) if options.log else gen_log(options.synthetic, options.seed)
+  caches = collections.OrderedDict([
+    ('raw key', SimulatedCache(legacy_query_cache_key, options.soft_ttl)),
+    ('canonical key', SimulatedCache(canonical_query_cache_key, options.soft_ttl)),
+    ('canonical key + negative', SimulatedCache(canonical_query_cache_key, options.soft_ttl, options.negative_ttl))
+  ])
+  distinct_keys = collections.defaultdict(set)
+  for event in events:
+    if not (event['query_params'].get('query', '').strip() or event['query_params'].get('user', '').strip()):
+      continue
+    for name, cache in caches.items():
+      cache.request(event['timestamp'], event['query_params'], event['hits'])
+      distinct_keys[name].add(cache.key_func(event['query_params']))
+
+  baseline = caches['raw key'].stats
+  for name, cache in caches.items():
+    stats = cache.stats
+    print('[INFO] {:<26} hit ratio {:>5.1f}%, keys={}, es queries={} ({:.1f}% of before),'.format(name,
+      stats['hits'] / max(stats['requests'], 1) * 100, len(distinct_keys[name]), stats['es_queries'],
+      stats['es_queries'] / max(baseline['es_queries'], 1) * 100),
+      ', '.join(['{}={}'.format(k, v) for k, v in stats.items()]))
+
+
+if __name__ == '__main__':
+  main()